@@ -1,7 +1,16 @@
 import torch
 import torch.nn as nn
 
-from layers import TextEncoder, GraphEncoder, ReprAggregator, EncoderMixin
+from typing import Optional
+
+from layers import (
+    TextEncoder,
+    GraphEncoder,
+    ReprAggregator,
+    EncoderMixin,
+    ActiveNodes,
+    MaskedMultiheadAttention,
+)
 from utils import masked_mean
 
 
@@ -13,8 +22,8 @@ class ActionScorer(nn.Module):
         self.num_heads = num_heads
 
         # self attention layers
-        self.self_attn_text = nn.MultiheadAttention(hidden_dim, num_heads)
-        self.self_attn_graph = nn.MultiheadAttention(hidden_dim, num_heads)
+        self.self_attn_text = MaskedMultiheadAttention(hidden_dim, num_heads)
+        self.self_attn_graph = MaskedMultiheadAttention(hidden_dim, num_heads)
 
         # linear layers
         self.linear1 = nn.Sequential(nn.Linear(3 * hidden_dim, hidden_dim), nn.ReLU())
@@ -28,6 +37,7 @@ class ActionScorer(nn.Module):
         h_og: torch.Tensor,
         h_go: torch.Tensor,
         obs_mask: torch.Tensor,
+        node_mask: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """
         enc_action_cands: encoded action candidates produced by TextEncoder.
@@ -40,6 +50,8 @@ class ActionScorer(nn.Module):
         h_go: aggregated node representation of the current graph with the observation.
             (batch, num_node, hidden_dim)
         obs_mask: mask for the observations. (batch, obs_len)
+        node_mask: mask for the nodes, only necessary for active node subgraphs.
+            (batch, num_node)
 
         output: action scores of shape (batch, num_action_cands)
         """
@@ -58,25 +70,21 @@ class ActionScorer(nn.Module):
         # (batch, num_action_cands, hidden_dim)
 
         # get the obs representation
-        h_og_t = h_og.transpose(0, 1)
-        obs_repr, _ = self.self_attn_text(
-            h_og_t, h_og_t, h_og_t, key_padding_mask=obs_mask == 0
-        )
-        # (obs_len, batch, hidden_dim)
-        obs_repr = obs_repr.transpose(0, 1)
+        obs_repr = self.self_attn_text(h_og, h_og, h_og, key_mask=obs_mask)
         # (batch, obs_len, hidden_dim)
         # masked mean pooling.
         obs_repr = masked_mean(obs_repr, obs_mask)
         # (batch, hidden_dim)
 
         # get the graph representation
-        h_go_t = h_go.transpose(0, 1)
-        graph_repr, _ = self.self_attn_graph(h_go_t, h_go_t, h_go_t)
-        # (num_node, batch, hidden_dim)
-        graph_repr = graph_repr.transpose(0, 1)
+        graph_repr = self.self_attn_graph(h_go, h_go, h_go, key_mask=node_mask)
         # (batch, num_node, hidden_dim)
-        # mean pooling. no masks necessary as we use all the nodes
-        graph_repr = graph_repr.mean(dim=1)
+        if node_mask is None:
+            # mean pooling. no masks necessary as we use all the nodes
+            graph_repr = graph_repr.mean(dim=1)
+        else:
+            # masked mean pooling.
+            graph_repr = masked_mean(graph_repr, node_mask)
         # (batch, hidden_dim)
 
         # expand the graph and obs representations
@@ -125,6 +133,8 @@ class ActionSelector(EncoderMixin, nn.Module):
         node_name_mask: torch.Tensor,
         rel_name_word_ids: torch.Tensor,
         rel_name_mask: torch.Tensor,
+        basis_first: bool = False,
+        channels_last: bool = False,
     ) -> None:
         super().__init__()
 
@@ -144,6 +154,7 @@ class ActionSelector(EncoderMixin, nn.Module):
             text_encoder_kernel_size,
             hidden_dim,
             text_encoder_num_heads,
+            channels_last=channels_last,
         )
 
         # node and relation embeddings
@@ -175,6 +186,7 @@ class ActionSelector(EncoderMixin, nn.Module):
             num_relations,
             [hidden_dim] * graph_encoder_num_cov_layers,
             graph_encoder_num_bases,
+            basis_first=basis_first,
         )
 
         # representation aggregator
@@ -191,14 +203,18 @@ class ActionSelector(EncoderMixin, nn.Module):
         action_cand_word_ids: torch.Tensor,
         action_cand_mask: torch.Tensor,
         action_mask: torch.Tensor,
+        active_nodes: Optional[ActiveNodes] = None,
     ) -> torch.Tensor:
         """
         obs_word_ids: (batch, obs_len)
         obs_mask: (batch, obs_len)
         current_graph: (batch, num_relation, num_node, num_node)
+            or (batch, num_relation // 2, num_node, num_node)
         action_cand_word_ids: (batch, num_action_cands, action_cand_len)
         action_cand_mask: (batch, num_action_cands, action_cand_len)
         action_mask: (batch, num_action_cands)
+        active_nodes: if given, current_graph is the subgraph of the active nodes,
+            so num_node is max_active_node.
 
         output:
             action scores of shape (batch, num_action_cands)
@@ -208,7 +224,7 @@ class ActionSelector(EncoderMixin, nn.Module):
         # (batch, obs_len, hidden_dim)
 
         # encode the current graph
-        encoded_curr_graph = self.encode_graph(current_graph)
+        encoded_curr_graph = self.encode_graph(current_graph, active_nodes=active_nodes)
         # (batch, num_node, hidden_dim)
 
         # aggregate obs and current graph representations
@@ -218,20 +234,38 @@ class ActionSelector(EncoderMixin, nn.Module):
             encoded_curr_graph,
             obs_mask,
             # no masks necessary for the graph
-            torch.ones(batch_size, self.num_nodes, device=encoded_obs.device),
+            torch.ones(batch_size, self.num_nodes, device=encoded_obs.device)
+            if active_nodes is None
+            else active_nodes.mask,
         )
         # h_og: (batch, obs_len, hidden_dim)
         # h_go: (batch, num_node, hidden_dim)
 
         # encode candidate actions
+        # skip the padded action candidates, their encodings are zeros
         _, num_action_cands, action_cand_len = action_cand_word_ids.size()
-        enc_action_cands = self.encode_text(
-            action_cand_word_ids.flatten(end_dim=1), action_cand_mask.flatten(end_dim=1)
-        ).view(batch_size, num_action_cands, action_cand_len, -1)
+        flat_action_mask = action_mask.flatten().bool()
+        # (batch * num_action_cands)
+        flat_enc_action_cands = encoded_obs.new_zeros(
+            batch_size * num_action_cands, action_cand_len, encoded_obs.size(-1)
+        )
+        flat_enc_action_cands[flat_action_mask] = self.encode_text(
+            action_cand_word_ids.flatten(end_dim=1)[flat_action_mask],
+            action_cand_mask.flatten(end_dim=1)[flat_action_mask],
+        )
+        enc_action_cands = flat_enc_action_cands.view(
+            batch_size, num_action_cands, action_cand_len, -1
+        )
         # (batch, num_action_cands, action_cand_len, hidden_dim)
 
         return self.action_scorer(
-            enc_action_cands, action_cand_mask, action_mask, h_og, h_go, obs_mask
+            enc_action_cands,
+            action_cand_mask,
+            action_mask,
+            h_og,
+            h_go,
+            obs_mask,
+            node_mask=None if active_nodes is None else active_nodes.mask,
         )
 
     @staticmethod
@@ -1,11 +1,14 @@
 import torch
 
-from typing import List, Optional, Tuple, Dict
+from dataclasses import replace
+from typing import List, Optional, Tuple, Dict, Any
 from itertools import chain
 
-from graph_updater import GraphUpdater
+from graph_updater import GraphUpdater, GraphUpdaterState
 from action_selector import ActionSelector
 from preprocessor import SpacyPreprocessor
+from layers import ActiveNodes, QuantizedAdjacency
+from utils import bf16_autocast
 
 
 class Agent:
@@ -23,6 +26,15 @@ class Agent:
         self.action_selector = action_selector
         self.preprocessor = preprocessor
 
+        # if True, the graphs are decoded and encoded only for the active nodes,
+        # which are the nodes mentioned so far in the observations, previous actions
+        # and action candidates. See calculate_action_scores() for more details.
+        self.active_node_mode = False
+
+        # if True, the graph updater and action selector are run under bfloat16
+        # autocast, and their outputs are cast back to float32.
+        self.bf16_autocast = False
+
     def get_device(self) -> torch.device:
         return self.graph_updater.node_embeddings.weight.device
 
@@ -33,15 +45,33 @@ class Agent:
         action_cands: List[List[str]],
         prev_actions: Optional[List[str]] = None,
         rnn_prev_hidden: Optional[torch.Tensor] = None,
-    ) -> Dict[str, torch.Tensor]:
+        prev_active_node_mask: Optional[torch.Tensor] = None,
+        prev_state: Optional[GraphUpdaterState] = None,
+    ) -> Dict[str, Any]:
         """
         If prev_actions is None, use ['restart', ...]
 
+        prev_state, the 'state' of the previous step, can be given instead of
+        rnn_prev_hidden, so that the graph updater reuses the previous graph.
+        Its active_node_mask is used if prev_active_node_mask is not given.
+
+        If active_node_mode is True, only the subgraphs of the active nodes are
+        decoded and encoded. The active nodes are the nodes mentioned in the
+        observations, previous actions and action candidates, as well as
+        prev_active_node_mask (batch, num_node), which should be the
+        'active_node_mask' of the previous step. The inactive nodes don't have
+        any edges in curr_graph.
+
         output: {
             'action_scores': (batch, num_action_cands)
             'action_mask': (batch, num_action_cands)
             'rnn_curr_hidden': (batch, hidden_dim)
             'curr_graph': (batch, num_relation, num_node, num_node)
+                or QuantizedAdjacency if graph_updater.quantized_graph_dtype is set
+                and active_node_mode is False
+            'active_node_mask': (batch, num_node), only if active_node_mode is True.
+            'state': GraphUpdaterState of the graph updater, whose h_t is
+                rnn_curr_hidden, and active_node_mask is 'active_node_mask'
         }
         """
         device = self.get_device()
@@ -64,31 +94,119 @@ class Agent:
             action_mask,
         ) = self.preprocess_action_cands(action_cands)
 
-        # calculate the current graph
-        graph_updater_results = self.graph_updater(
-            obs_word_ids,
-            prev_action_word_ids,
-            obs_mask,
-            prev_action_mask,
-            rnn_prev_hidden=rnn_prev_hidden,
-        )
+        active_nodes: Optional[ActiveNodes] = None
+        active_node_mask: Optional[torch.Tensor] = None
+        if self.active_node_mode:
+            if prev_active_node_mask is None and prev_state is not None:
+                # carry over the active nodes of the previous steps
+                prev_active_node_mask = prev_state.active_node_mask
+            mentioned_node_mask = self.find_mentioned_nodes(
+                obs_word_ids,
+                obs_mask,
+                prev_action_word_ids,
+                prev_action_mask,
+                action_cand_word_ids,
+                action_cand_mask,
+            )
+            # (batch, num_node)
+            active_node_mask = (
+                mentioned_node_mask
+                if prev_active_node_mask is None
+                else mentioned_node_mask | prev_active_node_mask.bool()
+            )
+            # (batch, num_node)
+            active_nodes = ActiveNodes.from_mask(active_node_mask)
+
+        with bf16_autocast(device, enabled=self.bf16_autocast):
+            # calculate the current graph
+            graph_updater_results = self.graph_updater(
+                obs_word_ids,
+                prev_action_word_ids,
+                obs_mask,
+                prev_action_mask,
+                rnn_prev_hidden=rnn_prev_hidden,
+                active_nodes=active_nodes,
+                prev_state=prev_state,
+            )
 
-        # based on the current graph, calculate the q values
-        action_scores = self.action_selector(
-            obs_word_ids,
-            obs_mask,
-            graph_updater_results["g_t"],
-            action_cand_word_ids,
-            action_cand_mask,
-            action_mask,
-        )
+            # based on the current graph, calculate the q values
+            action_scores = self.action_selector(
+                obs_word_ids,
+                obs_mask,
+                graph_updater_results["g_t"],
+                action_cand_word_ids,
+                action_cand_mask,
+                action_mask,
+                active_nodes=active_nodes,
+            )
 
-        return {
-            "action_scores": action_scores,
+        curr_graph = graph_updater_results["g_t"]
+        if isinstance(curr_graph, torch.Tensor):
+            curr_graph = curr_graph.float()
+        rnn_curr_hidden = graph_updater_results["h_t"].float()
+        results = {
+            "action_scores": action_scores.float(),
             "action_mask": action_mask,
-            "rnn_curr_hidden": graph_updater_results["h_t"],
-            "curr_graph": graph_updater_results["g_t"],
+            "rnn_curr_hidden": rnn_curr_hidden,
+            "curr_graph": curr_graph,
+            "state": replace(
+                graph_updater_results["state"],
+                h_t=rnn_curr_hidden,
+                active_node_mask=active_node_mask,
+            ),
         }
+        if active_nodes is not None:
+            # scatter the subgraphs back to the full graphs
+            subgraph = curr_graph
+            if isinstance(subgraph, QuantizedAdjacency):
+                subgraph = subgraph.to_dense()
+            results["curr_graph"] = active_nodes.scatter_graph(
+                subgraph, self.graph_updater.num_nodes
+            )
+            # (batch, num_relation, num_node, num_node)
+            results["active_node_mask"] = active_node_mask
+        return results
+
+    def find_mentioned_nodes(
+        self,
+        obs_word_ids: torch.Tensor,
+        obs_mask: torch.Tensor,
+        prev_action_word_ids: torch.Tensor,
+        prev_action_mask: torch.Tensor,
+        action_cand_word_ids: torch.Tensor,
+        action_cand_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Find the nodes mentioned in the observations, previous actions and
+        action candidates.
+
+        obs_word_ids: (batch, obs_len)
+        obs_mask: (batch, obs_len)
+        prev_action_word_ids: (batch, prev_action_len)
+        prev_action_mask: (batch, prev_action_len)
+        action_cand_word_ids: (batch, num_action_cands, action_cand_len)
+        action_cand_mask: (batch, num_action_cands, action_cand_len)
+
+        output: (batch, num_node)
+        """
+        batch_size = obs_word_ids.size(0)
+        mentioned_in_action_cands = (
+            self.graph_updater.find_mentioned_nodes(
+                action_cand_word_ids.flatten(end_dim=1),
+                action_cand_mask.flatten(end_dim=1),
+            )
+            .view(batch_size, -1, self.graph_updater.num_nodes)
+            .any(dim=1)
+        )
+        # (batch, num_node)
+        return (
+            self.graph_updater.find_mentioned_nodes(obs_word_ids, obs_mask)
+            | self.graph_updater.find_mentioned_nodes(
+                prev_action_word_ids, prev_action_mask
+            )
+            | mentioned_in_action_cands
+        )
+        # (batch, num_node)
 
     @torch.no_grad()
     def act(
@@ -103,6 +221,29 @@ class Agent:
         and previous rnn hidden states and return a matching batch of actions that
         maximizes the q value, as well as the new hidden state for the RNN cell.
         """
+        actions, state = self.act_with_state(
+            raw_obs,
+            raw_action_cands,
+            prev_actions=prev_actions,
+            prev_state=None
+            if rnn_prev_hidden is None
+            else GraphUpdaterState(rnn_prev_hidden),
+        )
+        return actions, state.h_t
+
+    @torch.no_grad()
+    def act_with_state(
+        self,
+        raw_obs: List[str],
+        raw_action_cands: List[List[str]],
+        prev_actions: Optional[List[str]] = None,
+        prev_state: Optional[GraphUpdaterState] = None,
+    ) -> Tuple[List[str], GraphUpdaterState]:
+        """
+        Same as act(), but take and return the state of the graph updater instead
+        of the rnn hidden states, so that the graph updater doesn't have to decode
+        and encode the previous graph again.
+        """
         # clean observations
         obs = self.preprocessor.batch_clean(raw_obs)
 
@@ -113,7 +254,7 @@ class Agent:
             obs,
             action_cands,
             prev_actions,
-            rnn_prev_hidden=rnn_prev_hidden,
+            prev_state=prev_state,
         )
         actions_idx = self.action_selector.select_max_q(
             results["action_scores"], results["action_mask"]
@@ -122,7 +263,7 @@ class Agent:
         # decode the action strings
         return (
             self.decode_actions(action_cands, actions_idx.tolist()),
-            results["rnn_curr_hidden"],
+            results["state"],
         )
 
     @staticmethod
@@ -188,19 +329,17 @@ class Agent:
             unpadded_action_cand_mask = flat_action_cand_mask[i : i + len(cands)]
             pad_len = max_num_action_cands - len(cands)
             if pad_len > 0:
-                # we add an UNK even if the action candidate should be masked
-                # to prevent nan from multiheaded attention which happens due to a bug
-                # https://github.com/pytorch/pytorch/issues/41508
-                # this is OK since padded actions will never be chosen
-                # based on action_mask
-                pad = torch.tensor(
-                    [[self.preprocessor.unk_id] + [0] * (max_action_cand_len - 1)],
-                    device=device,
-                ).expand(pad_len, -1)
+                # padded action candidates are fully masked
+                # they're never chosen based on action_mask
+                pad = torch.zeros(
+                    pad_len, max_action_cand_len, dtype=torch.long, device=device
+                )
                 padded_action_cand_word_ids = torch.cat(
                     [unpadded_action_cand_word_ids, pad]
                 )
-                padded_action_cand_mask = torch.cat([unpadded_action_cand_mask, pad])
+                padded_action_cand_mask = torch.cat(
+                    [unpadded_action_cand_mask, pad.float()]
+                )
                 padded_action_mask = torch.tensor(
                     [1] * len(cands) + [0] * pad_len,
                     dtype=torch.float,
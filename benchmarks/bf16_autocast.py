@@ -0,0 +1,221 @@
+"""
+Compare bfloat16 autocast against float32 for the graph updater with the tiny and
+original model sizes from train_graph_updater_conf/model_size/, on the episodes of
+test-data/test-data.json, which are repeated to fill the training batch sizes.
+
+Accuracy is measured as the relative difference of the eval losses, the agreement
+of the predicted and greedily decoded words and the difference of the RNN hidden
+states w.r.t. float32, as well as the train losses after training both from the
+same initial weights for a few steps. Throughput is measured for training steps,
+i.e. forward and backward passes of a truncated BPTT window, and eval steps.
+
+python -m benchmarks.bf16_autocast
+"""
+import argparse
+import json
+import random
+import torch
+
+from typing import Any, Dict, List, Optional
+
+from train_graph_updater import GraphUpdaterObsGen
+from graph_updater_data import GraphUpdaterObsGenDataModule
+from optimizers import RAdam
+from benchmarks.utils import time_fn, print_table
+
+MODEL_SIZES: Dict[str, Dict[str, Any]] = {
+    # tiny.yaml doesn't set any model sizes, so the defaults of GraphUpdaterObsGen
+    "tiny": {"batch_size": 4, "model_kwargs": {}},
+    "original": {
+        "batch_size": 48,
+        "model_kwargs": {
+            "hidden_dim": 64,
+            "word_emb_dim": 300,
+            "node_emb_dim": 100,
+            "relation_emb_dim": 32,
+            "text_encoder_num_blocks": 1,
+            "text_encoder_num_conv_layers": 5,
+            "text_encoder_kernel_size": 5,
+            "text_encoder_num_heads": 1,
+            "graph_encoder_num_cov_layers": 6,
+            "graph_encoder_num_bases": 3,
+            "text_decoder_num_blocks": 1,
+            "text_decoder_num_heads": 1,
+        },
+    },
+}
+
+
+def load_batch(
+    dm: GraphUpdaterObsGenDataModule, path: str, batch_size: int, num_steps: int
+) -> List[Dict[str, torch.Tensor]]:
+    with open(path) as f:
+        episodes = json.load(f)
+    batch = dm.prepare_batch(random.choices(episodes, k=batch_size))
+    return batch[:num_steps]
+
+
+def load_models(
+    model_kwargs: Dict[str, Any], ckpt: Optional[str]
+) -> List[GraphUpdaterObsGen]:
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+    models = []
+    for bf16_autocast in [False, True]:
+        if ckpt is None:
+            torch.manual_seed(42)
+            model = GraphUpdaterObsGen(
+                bf16_autocast=bf16_autocast, **model_kwargs, **vocab_paths
+            )
+        else:
+            model = GraphUpdaterObsGen.load_from_checkpoint(
+                ckpt, map_location="cpu", bf16_autocast=bf16_autocast, **vocab_paths
+            )
+        models.append(model)
+    return models
+
+
+def train(
+    model: GraphUpdaterObsGen,
+    batch: List[Dict[str, torch.Tensor]],
+    num_steps: int,
+    learning_rate: float,
+) -> float:
+    optimizer = RAdam(model.parameters(), lr=learning_rate)
+    model.train()
+    for _ in range(num_steps):
+        optimizer.zero_grad()
+        loss = torch.stack(model.process_batch(batch)["losses"]).mean()
+        loss.backward()
+        optimizer.step()
+    return loss.item()
+
+
+def main(args: argparse.Namespace) -> None:
+    random.seed(42)
+    torch.set_num_threads(args.num_threads)
+    dm = GraphUpdaterObsGenDataModule(
+        args.test_data,
+        1,
+        0,
+        args.test_data,
+        1,
+        0,
+        args.test_data,
+        1,
+        0,
+        "vocabs/word_vocab.txt",
+    )
+
+    rows = []
+    for size in args.model_sizes:
+        batch_size = args.batch_size or MODEL_SIZES[size]["batch_size"]
+        batch = load_batch(dm, args.test_data, batch_size, args.tbptt_steps)
+        models = load_models(
+            MODEL_SIZES[size]["model_kwargs"], args.ckpt if size == "original" else None
+        )
+
+        @torch.no_grad()
+        def eval_step(model: GraphUpdaterObsGen) -> Dict[str, List[torch.Tensor]]:
+            model.eval()
+            return model.process_batch(batch)
+
+        def train_step(model: GraphUpdaterObsGen) -> torch.Tensor:
+            model.train()
+            model.zero_grad()
+            loss = torch.stack(model.process_batch(batch)["losses"]).mean()
+            loss.backward()
+            return loss
+
+        float_results, bf16_results = [eval_step(model) for model in models]
+        float_loss = torch.stack(float_results["losses"]).mean().item()
+        step_masks = [step["step_mask"].bool() for step in batch]
+        word_masks = [step["groundtruth_obs_word_ids"] != 0 for step in batch]
+        for name, model, results in zip(
+            ["float32", "bf16 autocast"], models, [float_results, bf16_results]
+        ):
+            loss = torch.stack(results["losses"]).mean().item()
+            pred_agreement = torch.cat(
+                [
+                    (pred == float_pred)[mask]
+                    for pred, float_pred, mask in zip(
+                        results["preds"], float_results["preds"], word_masks
+                    )
+                ]
+            )
+            decoded_agreement = torch.tensor(
+                [
+                    dec.size() == float_dec.size() and dec.equal(float_dec)
+                    for decoded, float_decoded, mask in zip(
+                        results["decoded"], float_results["decoded"], step_masks
+                    )
+                    for dec, float_dec in zip(decoded[mask], float_decoded[mask])
+                ]
+            )
+            hidden_diff = max(
+                (hidden - float_hidden)[mask].abs().max().item()
+                for hidden, float_hidden, mask in zip(
+                    results["hiddens"], float_results["hiddens"], step_masks
+                )
+            )
+            rows.append(
+                [
+                    size,
+                    name,
+                    batch_size,
+                    loss,
+                    abs(loss - float_loss) / float_loss * 100,
+                    pred_agreement.float().mean().item() * 100,
+                    decoded_agreement.float().mean().item() * 100,
+                    torch.stack(results["f1s"]).mean().item(),
+                    f"{hidden_diff:.1e}",
+                    time_fn(lambda: train_step(model), repeat=args.repeat),
+                    time_fn(lambda: eval_step(model), repeat=args.repeat),
+                ]
+            )
+        # train from the same initial weights
+        for row, model in zip(rows[-2:], models):
+            row.insert(9, train(model, batch, args.train_steps, args.learning_rate))
+    print_table(
+        [
+            "model size",
+            "precision",
+            "batch",
+            "eval loss",
+            "loss diff (%)",
+            "pred agreement (%)",
+            "decoded agreement (%)",
+            "decoded f1",
+            "max hidden diff",
+            f"train loss after {args.train_steps} steps",
+            "train step (ms)",
+            "eval step (ms)",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test-data", default="test-data/test-data.json")
+    parser.add_argument(
+        "--model-sizes", nargs="+", default=["tiny", "original"], choices=MODEL_SIZES
+    )
+    parser.add_argument(
+        "--ckpt", default=None, help="checkpoint for the original model size"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="defaults to the training batch sizes of the model sizes",
+    )
+    parser.add_argument("--tbptt-steps", type=int, default=5)
+    parser.add_argument("--train-steps", type=int, default=20)
+    parser.add_argument("--learning-rate", type=float, default=5e-4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=4)
+    main(parser.parse_args())
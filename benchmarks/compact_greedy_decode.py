@@ -0,0 +1,113 @@
+"""
+Compare the greedy decoding of GraphUpdaterObsGen with the active batch compaction,
+which drops the sequences that have reached eos from the working batch, against
+decoding the whole batch until all the sequences have reached eos, with the tiny and
+original model sizes from train_graph_updater_conf/model_size/, both with the
+KV-cached incremental decoding.
+The models are randomly initialized, and the logits of eos are scaled by each of
+--eos-scales, so that the sequences end at different lengths.
+
+Reported are the decoded lengths, the average active batch fractions (see
+GraphUpdaterObsGen.greedy_decode_with_active_fraction()), the times of
+greedy_decode() for a batch and whether the decoded word ids are the same.
+
+python -m benchmarks.compact_greedy_decode
+"""
+import argparse
+import torch
+
+from typing import Any, Dict
+
+from train_graph_updater import GraphUpdaterObsGen
+from preprocessor import EOS
+from benchmarks.utils import time_fn, print_table
+
+MODEL_SIZES: Dict[str, Dict[str, Any]] = {
+    # tiny.yaml doesn't set any model sizes, so the defaults of GraphUpdaterObsGen
+    "tiny": {},
+    "original": {
+        "hidden_dim": 64,
+        "node_emb_dim": 100,
+        "relation_emb_dim": 32,
+        "text_encoder_num_conv_layers": 5,
+        "graph_encoder_num_cov_layers": 6,
+    },
+}
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.set_num_threads(args.num_threads)
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+
+    rows = []
+    for size in args.model_sizes:
+        torch.manual_seed(42)
+        g = GraphUpdaterObsGen(
+            max_decode_len=args.max_decode_len,
+            kv_cached_greedy_decode=True,
+            **MODEL_SIZES[size],
+            **vocab_paths,
+        )
+        g.eval()
+        hidden_dim = g.hparams.hidden_dim  # type: ignore
+        node_hidden = torch.randn(args.batch_size, len(g.node_vocab), hidden_dim)
+        prev_action_hidden = torch.randn(
+            args.batch_size, args.prev_action_len, hidden_dim
+        )
+        prev_action_mask = torch.ones(args.batch_size, args.prev_action_len)
+        eos_id = g.preprocessor.word_to_id(EOS)
+        eos_weight = g.target_word_prj.weight[eos_id].detach().clone()
+        for eos_scale in args.eos_scales:
+            with torch.no_grad():
+                g.target_word_prj.weight[eos_id] = eos_weight * eos_scale
+
+            @torch.no_grad()
+            def greedy_decode(compact: bool) -> Any:
+                g.hparams.compact_greedy_decode = compact  # type: ignore
+                return g.greedy_decode_with_active_fraction(
+                    node_hidden, prev_action_hidden, prev_action_mask
+                )
+
+            decoded, active_fraction = greedy_decode(False)
+            compacted_decoded, _ = greedy_decode(True)
+            rows.append(
+                [
+                    size,
+                    eos_scale,
+                    decoded.size(1),
+                    active_fraction.item(),
+                    time_fn(lambda: greedy_decode(False), repeat=args.repeat),
+                    time_fn(lambda: greedy_decode(True), repeat=args.repeat),
+                    decoded.equal(compacted_decoded),
+                ]
+            )
+    print_table(
+        [
+            "model size",
+            "eos scale",
+            "decoded len",
+            "active fraction",
+            "whole batch (ms)",
+            "compacted (ms)",
+            "same decoded",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-sizes", nargs="+", default=["tiny", "original"], choices=MODEL_SIZES
+    )
+    parser.add_argument("--eos-scales", type=float, nargs="+", default=[1.0, 1.5, 2.0])
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--max-decode-len", type=int, default=200)
+    parser.add_argument("--prev-action-len", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=1)
+    main(parser.parse_args())
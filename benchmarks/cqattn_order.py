@@ -0,0 +1,71 @@
+"""
+Benchmark the evaluation orders of the context-to-query attention product
+s_query @ s_ctx^T @ ctx in ContextQueryAttention for observations of different
+lengths against the nodes of a graph, with the model sizes from
+train_gata_conf/config.yaml.
+
+python -m benchmarks.cqattn_order
+"""
+import argparse
+import torch
+
+from layers import ContextQueryAttention
+from benchmarks.utils import time_fn, print_table
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(42)
+    device = torch.device(args.device)
+    cqattn = ContextQueryAttention(args.hidden_dim).to(device)
+    query = torch.rand(args.batch_size, args.num_nodes, args.hidden_dim, device=device)
+    query_mask = torch.ones(args.batch_size, args.num_nodes, device=device)
+
+    rows = []
+    for obs_len in args.obs_lens:
+        ctx = torch.rand(args.batch_size, obs_len, args.hidden_dim, device=device)
+        ctx_mask = torch.ones(args.batch_size, obs_len, device=device)
+
+        @torch.no_grad()
+        def run(order: str) -> torch.Tensor:
+            cqattn.ctx_to_query_order = order
+            return cqattn(ctx, query, ctx_mask, query_mask)
+
+        max_diff = (run("left") - run("right")).abs().max()
+        times = {
+            order: time_fn(lambda: run(order), repeat=args.repeat)
+            for order in ["left", "right", "auto"]
+        }
+        rows.append(
+            [
+                obs_len,
+                times["left"],
+                times["right"],
+                times["auto"],
+                times["left"] / times["auto"],
+                f"{max_diff.item():.1e}",
+            ]
+        )
+    print_table(
+        [
+            "obs len",
+            "(s_query @ s_ctx^T) @ ctx (ms)",
+            "s_query @ (s_ctx^T @ ctx) (ms)",
+            "auto (ms)",
+            "speedup",
+            "max abs diff",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--obs-lens", type=int, nargs="+", default=[10, 50, 100, 200, 500]
+    )
+    parser.add_argument("--num-nodes", type=int, default=99)
+    parser.add_argument("--batch-size", type=int, default=48)
+    parser.add_argument("--hidden-dim", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--device", default="cpu")
+    main(parser.parse_args())
@@ -0,0 +1,163 @@
+"""
+Compare the deferred text decoding of GraphUpdaterObsGen.process_batch(), which runs
+the text decoder, the target word projection and the loss once for all the steps of
+a truncated BPTT window, against decoding each step, with and without the
+time-parallel text encoding, using the tiny and original model sizes from
+train_graph_updater_conf/model_size/ on the episodes of test-data/test-data.json,
+which are repeated to fill the training batch sizes.
+
+Reported are the times and the throughputs, in episode steps per second, of training
+steps, i.e. forward and backward passes of a truncated BPTT window, the numbers of
+operators dispatched for them, as well as the differences of the losses.
+
+python -m benchmarks.deferred_text_decoding
+"""
+import argparse
+import json
+import random
+import torch
+
+from typing import Any, Dict, List
+
+from train_graph_updater import GraphUpdaterObsGen
+from graph_updater_data import GraphUpdaterObsGenDataModule
+from benchmarks.utils import time_fn, print_table
+
+MODEL_SIZES: Dict[str, Dict[str, Any]] = {
+    # tiny.yaml doesn't set any model sizes, so the defaults of GraphUpdaterObsGen
+    "tiny": {"batch_size": 4, "model_kwargs": {}},
+    "original": {
+        "batch_size": 48,
+        "model_kwargs": {
+            "hidden_dim": 64,
+            "word_emb_dim": 300,
+            "node_emb_dim": 100,
+            "relation_emb_dim": 32,
+            "text_encoder_num_blocks": 1,
+            "text_encoder_num_conv_layers": 5,
+            "text_encoder_kernel_size": 5,
+            "text_encoder_num_heads": 1,
+            "graph_encoder_num_cov_layers": 6,
+            "graph_encoder_num_bases": 3,
+            "text_decoder_num_blocks": 1,
+            "text_decoder_num_heads": 1,
+        },
+    },
+}
+
+MODES: Dict[str, Dict[str, bool]] = {
+    "per step": {},
+    "deferred": {"deferred_text_decoding": True},
+    "time-parallel": {"time_parallel_text_encoding": True},
+    "time-parallel + deferred": {
+        "time_parallel_text_encoding": True,
+        "deferred_text_decoding": True,
+    },
+}
+
+
+def load_batch(
+    dm: GraphUpdaterObsGenDataModule, path: str, batch_size: int, num_steps: int
+) -> List[Dict[str, torch.Tensor]]:
+    with open(path) as f:
+        episodes = json.load(f)
+    batch = dm.prepare_batch(random.choices(episodes, k=batch_size))
+    return batch[:num_steps]
+
+
+def count_ops(fn: Any) -> int:
+    """
+    Return the number of the operators dispatched while running fn().
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as p:
+        fn()
+    return sum(
+        event.count for event in p.key_averages() if event.key.startswith("aten::")
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    random.seed(42)
+    torch.set_num_threads(args.num_threads)
+    dm = GraphUpdaterObsGenDataModule(
+        args.test_data,
+        1,
+        0,
+        args.test_data,
+        1,
+        0,
+        args.test_data,
+        1,
+        0,
+        "vocabs/word_vocab.txt",
+    )
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+
+    rows = []
+    for size in args.model_sizes:
+        batch_size = args.batch_size or MODEL_SIZES[size]["batch_size"]
+        batch = load_batch(dm, args.test_data, batch_size, args.tbptt_steps)
+        num_steps = int(sum(step["step_mask"].sum().item() for step in batch))
+        per_step_losses = None
+        for name, mode_kwargs in MODES.items():
+            torch.manual_seed(42)
+            model = GraphUpdaterObsGen(
+                **mode_kwargs, **MODEL_SIZES[size]["model_kwargs"], **vocab_paths
+            )
+            model.train()
+
+            def train_step() -> List[torch.Tensor]:
+                model.zero_grad()
+                losses = model.process_batch(batch)["losses"]
+                torch.stack(losses).mean().backward()
+                return losses
+
+            losses = torch.stack(train_step()).detach()
+            if per_step_losses is None:
+                per_step_losses = losses
+            train_ms = time_fn(train_step, repeat=args.repeat)
+            rows.append(
+                [
+                    size,
+                    name,
+                    batch_size,
+                    train_ms,
+                    num_steps / train_ms * 1000,
+                    count_ops(train_step),
+                    f"{(losses - per_step_losses).abs().max().item():.1e}",
+                ]
+            )
+    print_table(
+        [
+            "model size",
+            "mode",
+            "batch",
+            "train step (ms)",
+            "train steps/s",
+            "dispatched ops",
+            "max loss diff",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test-data", default="test-data/test-data.json")
+    parser.add_argument(
+        "--model-sizes", nargs="+", default=["tiny", "original"], choices=MODEL_SIZES
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="defaults to the training batch sizes of the model sizes",
+    )
+    parser.add_argument("--tbptt-steps", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=4)
+    main(parser.parse_args())
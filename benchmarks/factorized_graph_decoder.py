@@ -0,0 +1,168 @@
+"""
+Compare the low-rank factorized graph decoders of GraphUpdater against the dense one
+with the model sizes from train_graph_updater_conf/model_size/original.yaml.
+Each factorized graph decoder is distilled from the dense one of the given graph
+updater checkpoint (see GraphUpdater.distill_factorized_graph_decoder()),
+or randomly initialized weights if no checkpoint is given, whose graphs are close
+to noise and hard to fit, so only useful to check the harness, sizes and latencies.
+
+Reported are the numbers of parameters of the graph decoders, the times of f_d and
+the graph updater step for a batch of games, as well as the fidelity of the
+distilled graphs w.r.t. the dense ones on held-out RNN hidden states, i.e. the mean
+squared errors and the agreement of the edges thresholded at 0.
+
+python -m benchmarks.factorized_graph_decoder
+"""
+import argparse
+import copy
+import torch
+import torch.nn.functional as F
+
+from typing import List, Optional
+
+from graph_updater import GraphUpdater
+from train_graph_updater import GraphUpdaterObsGen
+from benchmarks.utils import time_fn, print_table
+
+
+def load_graph_updater(ckpt: Optional[str]) -> GraphUpdater:
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+    if ckpt is None:
+        torch.manual_seed(42)
+        graph_updater_obs_gen = GraphUpdaterObsGen(
+            hidden_dim=64,
+            node_emb_dim=100,
+            relation_emb_dim=32,
+            text_encoder_num_conv_layers=5,
+            graph_encoder_num_cov_layers=6,
+            **vocab_paths,
+        )
+    else:
+        graph_updater_obs_gen = GraphUpdaterObsGen.load_from_checkpoint(
+            ckpt, map_location="cpu", **vocab_paths
+        )
+    graph_updater = graph_updater_obs_gen.graph_updater
+    graph_updater.pretraining = False
+    return graph_updater
+
+
+def num_decoder_params(graph_updater: GraphUpdater) -> int:
+    decoder = (
+        graph_updater.f_d_layers
+        if graph_updater.factorized_graph_decoder is None
+        else graph_updater.factorized_graph_decoder
+    )
+    return sum(param.numel() for param in decoder.parameters())  # type: ignore
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.set_num_threads(args.num_threads)
+    dense_graph_updater = load_graph_updater(args.ckpt)
+    hidden_dim = dense_graph_updater.hidden_dim
+    num_words = dense_graph_updater.word_embeddings[0].num_embeddings
+
+    torch.manual_seed(42)
+    # skip the special tokens, i.e. PAD, UNK, BOS, EOS
+    obs_word_ids = torch.randint(4, num_words, (args.batch_size, args.obs_len))
+    obs_mask = torch.ones(args.batch_size, args.obs_len)
+    prev_action_word_ids = torch.randint(
+        4, num_words, (args.batch_size, args.prev_action_len)
+    )
+    prev_action_mask = torch.ones(args.batch_size, args.prev_action_len)
+    rnn_prev_hidden = torch.rand(args.batch_size, hidden_dim) * 2 - 1
+    held_out_hidden = torch.rand(args.num_held_out, hidden_dim) * 2 - 1
+    with torch.no_grad():
+        dense_graph = dense_graph_updater.f_d(held_out_hidden)
+
+    configs: List[Optional[List[Optional[int]]]] = [None]
+    configs += [[rank, None] for rank in args.ranks]
+    configs += [
+        [rank, relation_rank]
+        for rank in args.ranks
+        for relation_rank in args.relation_ranks
+        if relation_rank <= rank
+    ]
+    rows = []
+    for config in configs:
+        if config is None:
+            name = "dense"
+            graph_updater = dense_graph_updater
+            mse = 0.0
+            agreement = 100.0
+        else:
+            rank, relation_rank = config
+            name = f"rank {rank}"
+            if relation_rank is not None:
+                name += f", relation rank {relation_rank}"
+            graph_updater = copy.deepcopy(dense_graph_updater)
+            graph_updater.distill_factorized_graph_decoder(
+                rank,  # type: ignore
+                relation_rank=relation_rank,
+                num_steps=args.distill_steps,
+                batch_size=args.distill_batch_size,
+                learning_rate=args.learning_rate,
+            )
+            with torch.no_grad():
+                graph = graph_updater.f_d(held_out_hidden)
+            mse = F.mse_loss(graph, dense_graph).item()
+            agreement = (graph > 0).eq(dense_graph > 0).float().mean().item() * 100
+        graph_updater.eval()
+
+        @torch.no_grad()
+        def f_d() -> torch.Tensor:
+            return graph_updater.f_d(rnn_prev_hidden)
+
+        @torch.no_grad()
+        def step() -> torch.Tensor:
+            return graph_updater(
+                obs_word_ids,
+                prev_action_word_ids,
+                obs_mask,
+                prev_action_mask,
+                rnn_prev_hidden=rnn_prev_hidden,
+            )["h_t"]
+
+        rows.append(
+            [
+                name,
+                num_decoder_params(graph_updater),
+                time_fn(f_d, repeat=args.repeat),
+                time_fn(step, repeat=args.repeat),
+                f"{mse:.1e}",
+                agreement,
+            ]
+        )
+    print_table(
+        [
+            "graph decoder",
+            "params",
+            "f_d (ms)",
+            "step (ms)",
+            "held-out mse",
+            "edge agreement (%)",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--ckpt", default=None, help="checkpoint of the pretrained graph updater"
+    )
+    parser.add_argument("--ranks", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--relation-ranks", type=int, nargs="+", default=[4])
+    parser.add_argument("--distill-steps", type=int, default=1000)
+    parser.add_argument("--distill-batch-size", type=int, default=64)
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--num-held-out", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--obs-len", type=int, default=100)
+    parser.add_argument("--prev-action-len", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--num-threads", type=int, default=1)
+    main(parser.parse_args())
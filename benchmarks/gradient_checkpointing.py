@@ -0,0 +1,126 @@
+"""
+Benchmark the peak memory and the step time of a graph updater training step,
+i.e. forward and backward passes of a truncated BPTT window, with and without
+gradient checkpointing, using the model sizes from
+train_graph_updater_conf/model_size/original.yaml.
+
+python -m benchmarks.gradient_checkpointing
+"""
+import argparse
+import torch
+
+from typing import Dict, List
+
+from train_graph_updater import GraphUpdaterObsGen
+from benchmarks.utils import time_fn, peak_memory_mb, print_table
+
+
+def random_batch(
+    num_words: int,
+    batch_size: int,
+    num_steps: int,
+    obs_len: int,
+    prev_action_len: int,
+    device: torch.device,
+) -> List[Dict[str, torch.Tensor]]:
+    # skip the special tokens, i.e. PAD, UNK, BOS, EOS
+    return [
+        {
+            "obs_word_ids": torch.randint(
+                4, num_words, (batch_size, obs_len), device=device
+            ),
+            "obs_mask": torch.ones(batch_size, obs_len, device=device),
+            "prev_action_word_ids": torch.randint(
+                4, num_words, (batch_size, prev_action_len), device=device
+            ),
+            "prev_action_mask": torch.ones(batch_size, prev_action_len, device=device),
+            "groundtruth_obs_word_ids": torch.randint(
+                4, num_words, (batch_size, obs_len), device=device
+            ),
+            "step_mask": torch.ones(batch_size, device=device),
+        }
+        for _ in range(num_steps)
+    ]
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(42)
+    device = torch.device(args.device)
+    model_kwargs = {
+        "hidden_dim": 64,
+        "word_emb_dim": 300,
+        "node_emb_dim": 100,
+        "relation_emb_dim": 32,
+        "text_encoder_num_blocks": 1,
+        "text_encoder_num_conv_layers": 5,
+        "text_encoder_kernel_size": 5,
+        "text_encoder_num_heads": 1,
+        "graph_encoder_num_cov_layers": 6,
+        "graph_encoder_num_bases": 3,
+        "text_decoder_num_blocks": 1,
+        "text_decoder_num_heads": 1,
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+    lm = GraphUpdaterObsGen(**model_kwargs).to(device)
+    ckpt_lm = GraphUpdaterObsGen(gradient_checkpointing=True, **model_kwargs).to(device)
+    ckpt_lm.load_state_dict(lm.state_dict())
+    lm.train()
+    ckpt_lm.train()
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        batch = random_batch(
+            lm.num_words,
+            batch_size,
+            args.tbptt_steps,
+            args.obs_len,
+            args.prev_action_len,
+            device,
+        )
+
+        def train_step(model: GraphUpdaterObsGen) -> torch.Tensor:
+            model.zero_grad()
+            loss = torch.stack(model.process_batch(batch)["losses"]).mean()
+            loss.backward()
+            return loss
+
+        default_ms = time_fn(lambda: train_step(lm), repeat=args.repeat)
+        ckpt_ms = time_fn(lambda: train_step(ckpt_lm), repeat=args.repeat)
+        default_mb = peak_memory_mb(lambda: train_step(lm))
+        ckpt_mb = peak_memory_mb(lambda: train_step(ckpt_lm))
+        rows.append(
+            [
+                batch_size,
+                default_ms,
+                ckpt_ms,
+                ckpt_ms / default_ms,
+                default_mb,
+                ckpt_mb,
+                ckpt_mb / default_mb,
+            ]
+        )
+    print_table(
+        [
+            "batch",
+            "default (ms)",
+            "checkpointed (ms)",
+            "step time ratio",
+            "default peak (MB)",
+            "checkpointed peak (MB)",
+            "peak memory ratio",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 16, 48])
+    parser.add_argument("--tbptt-steps", type=int, default=5)
+    parser.add_argument("--obs-len", type=int, default=100)
+    parser.add_argument("--prev-action-len", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--device", default="cpu")
+    main(parser.parse_args())
@@ -0,0 +1,110 @@
+"""
+Compare the KV-cached incremental greedy decoding of GraphUpdaterObsGen, which only
+decodes the newest position every step, against decoding the whole prefix every step,
+with the tiny and original model sizes from train_graph_updater_conf/model_size/.
+The models are randomly initialized, and eos is never decoded so that every decode
+runs for max_decode_len steps, i.e. the worst case of a batch with one long
+observation.
+
+Reported are the times of greedy_decode() for a batch, the decoding throughputs,
+in decoded tokens per second, and whether the decoded word ids are the same.
+
+python -m benchmarks.kv_cached_greedy_decode
+"""
+import argparse
+import torch
+
+from typing import Any, Dict
+
+from train_graph_updater import GraphUpdaterObsGen
+from preprocessor import EOS
+from benchmarks.utils import time_fn, print_table
+
+MODEL_SIZES: Dict[str, Dict[str, Any]] = {
+    # tiny.yaml doesn't set any model sizes, so the defaults of GraphUpdaterObsGen
+    "tiny": {},
+    "original": {
+        "hidden_dim": 64,
+        "node_emb_dim": 100,
+        "relation_emb_dim": 32,
+        "text_encoder_num_conv_layers": 5,
+        "graph_encoder_num_cov_layers": 6,
+    },
+}
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.set_num_threads(args.num_threads)
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+
+    rows = []
+    for size in args.model_sizes:
+        torch.manual_seed(42)
+        g = GraphUpdaterObsGen(**MODEL_SIZES[size], **vocab_paths)
+        g.eval()
+        with torch.no_grad():
+            g.target_word_prj.weight[g.preprocessor.word_to_id(EOS)] = 0
+        hidden_dim = g.hparams.hidden_dim  # type: ignore
+        num_nodes = len(g.node_vocab)
+        for batch_size in args.batch_sizes:
+            node_hidden = torch.rand(batch_size, num_nodes, hidden_dim)
+            prev_action_hidden = torch.rand(
+                batch_size, args.prev_action_len, hidden_dim
+            )
+            prev_action_mask = torch.ones(batch_size, args.prev_action_len)
+            for max_decode_len in args.max_decode_lens:
+                g.hparams.max_decode_len = max_decode_len  # type: ignore
+
+                @torch.no_grad()
+                def greedy_decode(kv_cached: bool) -> torch.Tensor:
+                    g.hparams.kv_cached_greedy_decode = kv_cached  # type: ignore
+                    return g.greedy_decode(
+                        node_hidden, prev_action_hidden, prev_action_mask
+                    )
+
+                same = greedy_decode(False).equal(greedy_decode(True))
+                full_ms = time_fn(lambda: greedy_decode(False), repeat=args.repeat)
+                cached_ms = time_fn(lambda: greedy_decode(True), repeat=args.repeat)
+                num_tokens = batch_size * max_decode_len
+                rows.append(
+                    [
+                        size,
+                        batch_size,
+                        max_decode_len,
+                        full_ms,
+                        cached_ms,
+                        num_tokens / full_ms * 1000,
+                        num_tokens / cached_ms * 1000,
+                        same,
+                    ]
+                )
+    print_table(
+        [
+            "model size",
+            "batch",
+            "max decode len",
+            "full prefix (ms)",
+            "kv cached (ms)",
+            "full prefix tokens/s",
+            "kv cached tokens/s",
+            "same decoded",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-sizes", nargs="+", default=["tiny", "original"], choices=MODEL_SIZES
+    )
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 128])
+    parser.add_argument("--max-decode-lens", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--prev-action-len", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=1)
+    main(parser.parse_args())
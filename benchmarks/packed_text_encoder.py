@@ -0,0 +1,174 @@
+"""
+Benchmark packed text encoding (EncoderMixin.packed_text_encoding) against padded
+text encoding, using the model sizes from train_gata_conf/config.yaml, on
+the observations and previous actions of test-data/test-data.json, and on
+the observations and action candidates recorded by playing the given games with
+random actions.
+
+python -m benchmarks.packed_text_encoder
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import torch
+import torch.nn as nn
+
+from typing import Dict, List
+
+from textworld import EnvInfos
+
+from agent import Agent
+from layers import EncoderMixin, TextEncoder, PackedSequences
+from preprocessor import SpacyPreprocessor
+from utils import load_textworld_games, batchify
+from benchmarks.utils import time_fn, print_table
+
+
+class BenchmarkTextEncoder(EncoderMixin, nn.Module):
+    def __init__(self, args: argparse.Namespace, num_words: int) -> None:
+        super().__init__()
+        self.word_embeddings = nn.Sequential(
+            nn.Embedding(num_words, args.word_emb_dim),
+            nn.Linear(args.word_emb_dim, args.hidden_dim, bias=False),
+        )
+        self.text_encoder = TextEncoder(
+            args.text_encoder_num_blocks,
+            args.text_encoder_num_conv_layers,
+            args.text_encoder_kernel_size,
+            args.hidden_dim,
+            args.text_encoder_num_heads,
+        )
+
+
+def load_test_data(path: str) -> Dict[str, List[List[str]]]:
+    with open(path) as f:
+        episodes = json.load(f)
+    # batch the steps of the episodes like GraphUpdaterObsGenDataModule,
+    # i.e. the i'th batch has the i'th steps of the episodes
+    steps = [
+        [episode[i] for episode in episodes if i < len(episode)]
+        for i in range(max(len(episode) for episode in episodes))
+    ]
+    return {
+        "test-data obs": [[step["observation"] for step in batch] for batch in steps],
+        "test-data prev action": [
+            [step["previous_action"] for step in batch] for batch in steps
+        ],
+    }
+
+
+def record_rl_text(
+    game_dir: str, batch_size: int, max_episode_steps: int, preprocessor
+) -> Dict[str, List[List[str]]]:
+    request_infos = EnvInfos()
+    request_infos.admissible_commands = True
+    game_files = sorted(glob.glob(os.path.join(game_dir, "*.z8")))
+    obs_batches: List[List[str]] = []
+    action_cand_batches: List[List[str]] = []
+    for batch_game_files in batchify(game_files, batch_size):
+        env = load_textworld_games(
+            list(batch_game_files),
+            "packed-text-encoder",
+            request_infos,
+            max_episode_steps,
+            len(batch_game_files),
+        )
+        raw_obs, infos = env.reset()
+        dones = [False] * len(batch_game_files)
+        while not all(dones):
+            obs_batches.append(preprocessor.batch_clean(raw_obs))
+            action_cands = Agent.filter_action_cands(infos["admissible_commands"])
+            # action candidates are encoded all at once, see Agent
+            action_cand_batches.append(
+                [cand for cands in action_cands for cand in cands]
+            )
+            actions = [random.choice(cands) for cands in action_cands]
+            raw_obs, _, dones, infos = env.step(actions)
+        env.close()
+    return {"rl obs": obs_batches, "rl action cands": action_cand_batches}
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(42)
+    random.seed(42)
+    device = torch.device(args.device)
+    preprocessor = SpacyPreprocessor.load_from_file("vocabs/word_vocab.txt")
+    encoder = BenchmarkTextEncoder(args, len(preprocessor.word_to_id_dict)).to(device)
+    encoder.eval()
+
+    datasets = load_test_data(args.test_data)
+    datasets.update(
+        record_rl_text(
+            args.game_dir, args.game_batch_size, args.max_episode_steps, preprocessor
+        )
+    )
+
+    rows = []
+    for name, batches in datasets.items():
+        inputs = [preprocessor.preprocess(batch, device=device) for batch in batches]
+
+        @torch.no_grad()
+        def run(packed: bool) -> List[torch.Tensor]:
+            encoder.packed_text_encoding = packed
+            return [encoder.encode_text(word_ids, mask) for word_ids, mask in inputs]
+
+        max_diff = max(
+            ((padded - packed) * mask.unsqueeze(-1)).abs().max().item()
+            for padded, packed, (_, mask) in zip(run(False), run(True), inputs)
+        )
+        num_tokens = sum(mask.sum().item() for _, mask in inputs)
+        num_padded = sum(mask.numel() for _, mask in inputs)
+        num_packed = sum(
+            PackedSequences.from_mask(
+                mask, num_pads=encoder.text_encoder.num_leaking_pads
+            ).total_len
+            for _, mask in inputs
+        )
+        padded_ms = time_fn(lambda: run(False), repeat=args.repeat)
+        packed_ms = time_fn(lambda: run(True), repeat=args.repeat)
+        rows.append(
+            [
+                name,
+                len(inputs),
+                sum(mask.size(0) for _, mask in inputs),
+                (1 - num_tokens / num_padded) * 100,
+                (1 - num_packed / num_padded) * 100,
+                padded_ms,
+                packed_ms,
+                padded_ms / packed_ms,
+                f"{max_diff:.1e}",
+            ]
+        )
+    print_table(
+        [
+            "text",
+            "batches",
+            "sequences",
+            "padding (%)",
+            "skipped (%)",
+            "padded (ms)",
+            "packed (ms)",
+            "speedup",
+            "max abs diff",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test-data", default="test-data/test-data.json")
+    parser.add_argument("--game-dir", default="test-data/rl_games")
+    parser.add_argument("--game-batch-size", type=int, default=8)
+    parser.add_argument("--max-episode-steps", type=int, default=50)
+    parser.add_argument("--hidden-dim", type=int, default=64)
+    parser.add_argument("--word-emb-dim", type=int, default=300)
+    parser.add_argument("--text-encoder-num-blocks", type=int, default=1)
+    parser.add_argument("--text-encoder-num-conv-layers", type=int, default=5)
+    parser.add_argument("--text-encoder-kernel-size", type=int, default=5)
+    parser.add_argument("--text-encoder-num-heads", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--device", default="cpu")
+    main(parser.parse_args())
@@ -0,0 +1,133 @@
+"""
+Measure the q-value drift of quantized graphs against float32 graphs.
+The float32 agent plays the given games, and at each step, the action scores are
+calculated again with the graph updater emitting quantized graphs from the same
+inputs and RNN hidden states.
+
+python -m benchmarks.quantized_adjacency_drift --ckpt /path/to/gata.ckpt
+"""
+import argparse
+import glob
+import os
+import torch
+
+from typing import Dict, List
+
+from agent import Agent
+from train_gata import GATADoubleDQN, request_infos_for_eval
+from utils import load_textworld_games, batchify
+from benchmarks.utils import print_table
+
+
+DTYPES = {"int8": torch.int8, "bfloat16": torch.bfloat16}
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(42)
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+    if args.ckpt is None:
+        # randomly initialized weights, only useful to check the harness
+        gata_double_dqn = GATADoubleDQN(**vocab_paths)
+    else:
+        gata_double_dqn = GATADoubleDQN.load_from_checkpoint(args.ckpt, **vocab_paths)
+    gata_double_dqn.eval()
+    agent = Agent(
+        gata_double_dqn.graph_updater,
+        gata_double_dqn.action_selector,
+        gata_double_dqn.preprocessor,
+    )
+
+    game_files = sorted(glob.glob(os.path.join(args.game_dir, "*.z8")))
+    abs_diffs: Dict[str, List[torch.Tensor]] = {dtype: [] for dtype in args.dtypes}
+    same_actions: Dict[str, List[torch.Tensor]] = {dtype: [] for dtype in args.dtypes}
+    for batch_game_files in batchify(game_files, args.batch_size):
+        env = load_textworld_games(
+            list(batch_game_files),
+            "quantized-adjacency-drift",
+            request_infos_for_eval(),
+            args.max_episode_steps,
+            len(batch_game_files),
+        )
+        raw_obs, infos = env.reset()
+        prev_actions = None
+        rnn_prev_hidden = None
+        dones = [False] * len(batch_game_files)
+        while not all(dones):
+            obs = agent.preprocessor.batch_clean(raw_obs)
+            action_cands = agent.filter_action_cands(infos["admissible_commands"])
+            results = agent.calculate_action_scores(
+                obs, action_cands, prev_actions, rnn_prev_hidden=rnn_prev_hidden
+            )
+            # only the games that are still being played
+            not_done = torch.tensor([not done for done in dones])
+            action_mask = results["action_mask"][not_done]
+            action_scores = results["action_scores"][not_done]
+            actions_idx = agent.action_selector.select_max_q(action_scores, action_mask)
+            for dtype in args.dtypes:
+                agent.graph_updater.quantized_graph_dtype = DTYPES[dtype]
+                quantized_action_scores = agent.calculate_action_scores(
+                    obs, action_cands, prev_actions, rnn_prev_hidden=rnn_prev_hidden
+                )["action_scores"][not_done]
+                agent.graph_updater.quantized_graph_dtype = None
+                abs_diffs[dtype].append(
+                    (quantized_action_scores - action_scores)
+                    .abs()
+                    .masked_select(action_mask.bool())
+                )
+                same_actions[dtype].append(
+                    agent.action_selector.select_max_q(
+                        quantized_action_scores, action_mask
+                    )
+                    == actions_idx
+                )
+
+            # take a step with the float32 agent
+            actions = agent.decode_actions(
+                action_cands,
+                agent.action_selector.select_max_q(
+                    results["action_scores"], results["action_mask"]
+                ).tolist(),
+            )
+            raw_obs, _, dones, infos = env.step(actions)
+            prev_actions = actions
+            rnn_prev_hidden = results["rnn_curr_hidden"]
+        env.close()
+
+    rows = []
+    for dtype in args.dtypes:
+        dtype_abs_diffs = torch.cat(abs_diffs[dtype])
+        rows.append(
+            [
+                dtype,
+                len(game_files),
+                f"{dtype_abs_diffs.mean().item():.1e}",
+                f"{dtype_abs_diffs.max().item():.1e}",
+                torch.cat(same_actions[dtype]).float().mean().item() * 100,
+            ]
+        )
+    print_table(
+        [
+            "dtype",
+            "games",
+            "mean abs q drift",
+            "max abs q drift",
+            "same greedy action (%)",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", default=None)
+    parser.add_argument("--game-dir", default="test-data/rl_games")
+    parser.add_argument(
+        "--dtypes", nargs="+", choices=list(DTYPES), default=list(DTYPES)
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-episode-steps", type=int, default=100)
+    main(parser.parse_args())
@@ -0,0 +1,233 @@
+"""
+Evaluate the int8 dynamically quantized agent (see quantize_dynamic_agent() in
+train_gata.py) against the float32 agent on CPU. Each agent plays the given games,
+and the normalized rewards and the latencies of their steps are reported.
+While the float32 agent plays, the quantized agent picks its actions from the same
+inputs with its own RNN hidden states, which are compared with the actions of the
+float32 agent. The memory footprint of an actor is measured as the resident set
+size of a fresh process that only loads the serialized agent and plays a batch
+of games.
+
+python -m benchmarks.quantized_agent --ckpt /path/to/gata.ckpt
+"""
+import argparse
+import glob
+import io
+import os
+import time
+import multiprocessing as mp
+import torch
+
+from typing import Dict, List, Optional
+
+from agent import Agent
+from preprocessor import SpacyPreprocessor
+from train_gata import GATADoubleDQN, request_infos_for_eval, quantize_dynamic_agent
+from utils import load_textworld_games, batchify
+from benchmarks.utils import print_table
+
+
+def load_agent(ckpt: Optional[str], quantized: bool) -> Agent:
+    torch.manual_seed(42)
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+    if ckpt is None:
+        # randomly initialized weights with the model sizes from
+        # train_gata_conf/config.yaml, only useful to check the harness,
+        # latencies and memory footprints
+        gata_double_dqn = GATADoubleDQN(
+            hidden_dim=64,
+            node_emb_dim=100,
+            relation_emb_dim=32,
+            text_encoder_num_conv_layers=5,
+            graph_encoder_num_cov_layers=6,
+            **vocab_paths,
+        )
+    else:
+        gata_double_dqn = GATADoubleDQN.load_from_checkpoint(
+            ckpt, map_location="cpu", **vocab_paths
+        )
+    gata_double_dqn.eval()
+    if quantized:
+        return quantize_dynamic_agent(gata_double_dqn)
+    return Agent(
+        gata_double_dqn.graph_updater,
+        gata_double_dqn.action_selector,
+        gata_double_dqn.preprocessor,
+    )
+
+
+def model_size_mb(agent: Agent) -> float:
+    buffer = io.BytesIO()
+    torch.save(
+        {
+            "graph_updater": agent.graph_updater.state_dict(),
+            "action_selector": agent.action_selector.state_dict(),
+        },
+        buffer,
+    )
+    return buffer.tell() / 1024 ** 2
+
+
+def current_rss_mb() -> float:
+    # the second field of statm is the resident set size in pages
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def play(
+    agent: Agent,
+    game_files: List[str],
+    args: argparse.Namespace,
+    follower: Optional[Agent] = None,
+) -> Dict[str, List[float]]:
+    """
+    Play the games with the agent, and if follower is given, compare its actions
+    with the actions of the agent.
+    """
+    normalized_rewards: List[float] = []
+    step_ms: List[float] = []
+    agreements: List[float] = []
+    for batch_game_files in batchify(game_files, args.batch_size):
+        env = load_textworld_games(
+            list(batch_game_files),
+            "quantized-agent",
+            request_infos_for_eval(),
+            args.max_episode_steps,
+            len(batch_game_files),
+        )
+        raw_obs, infos = env.reset()
+        prev_actions: Optional[List[str]] = None
+        rnn_prev_hidden: Optional[torch.Tensor] = None
+        follower_rnn_prev_hidden: Optional[torch.Tensor] = None
+        dones = [False] * len(batch_game_files)
+        while not all(dones):
+            start = time.perf_counter()
+            actions, rnn_prev_hidden = agent.act(
+                raw_obs,
+                infos["admissible_commands"],
+                prev_actions=prev_actions,
+                rnn_prev_hidden=rnn_prev_hidden,
+            )
+            step_ms.append((time.perf_counter() - start) * 1000)
+            if follower is not None:
+                follower_actions, follower_rnn_prev_hidden = follower.act(
+                    raw_obs,
+                    infos["admissible_commands"],
+                    prev_actions=prev_actions,
+                    rnn_prev_hidden=follower_rnn_prev_hidden,
+                )
+                # only the games that are still being played
+                agreements.extend(
+                    float(action == follower_action)
+                    for action, follower_action, done in zip(
+                        actions, follower_actions, dones
+                    )
+                    if not done
+                )
+            raw_obs, rewards, dones, infos = env.step(actions)
+            prev_actions = actions
+        normalized_rewards.extend(
+            reward / game.metadata["max_score"]
+            for reward, game in zip(rewards, infos["game"])
+        )
+        env.close()
+    return {
+        "normalized_rewards": normalized_rewards,
+        "step_ms": step_ms,
+        "agreements": agreements,
+    }
+
+
+def _actor_rss_worker(
+    serialized_modules: bytes,
+    game_files: List[str],
+    args: argparse.Namespace,
+    queue: mp.Queue,
+) -> None:
+    torch.set_num_threads(args.num_threads)
+    graph_updater, action_selector = torch.load(
+        io.BytesIO(serialized_modules), weights_only=False
+    )
+    agent = Agent(
+        graph_updater,
+        action_selector,
+        SpacyPreprocessor.load_from_file("vocabs/word_vocab.txt"),
+    )
+    play(agent, game_files[: args.batch_size], args)
+    queue.put(current_rss_mb())
+
+
+def actor_rss_mb(
+    agent: Agent, game_files: List[str], args: argparse.Namespace
+) -> float:
+    """
+    Return the resident set size of a fresh actor process, which loads the
+    serialized agent and plays a batch of games.
+    """
+    buffer = io.BytesIO()
+    torch.save((agent.graph_updater, agent.action_selector), buffer)
+    # spawn, not fork, so that the actor doesn't share the memory of this process
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(
+        target=_actor_rss_worker, args=(buffer.getvalue(), game_files, args, queue)
+    )
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.set_num_threads(args.num_threads)
+    game_files = sorted(glob.glob(os.path.join(args.game_dir, "*.z8")))
+    agent = load_agent(args.ckpt, False)
+    quantized_agent = load_agent(args.ckpt, True)
+
+    float_results = play(agent, game_files, args, follower=quantized_agent)
+    quantized_results = play(quantized_agent, game_files, args)
+
+    rows = []
+    for name, row_agent, results, quantized in [
+        ("float32", agent, float_results, False),
+        ("int8 dynamic", quantized_agent, quantized_results, True),
+    ]:
+        rows.append(
+            [
+                name,
+                len(game_files),
+                torch.tensor(results["normalized_rewards"]).mean().item(),
+                torch.tensor(float_results["agreements"]).mean().item() * 100
+                if quantized
+                else 100.0,
+                torch.tensor(results["step_ms"]).mean().item(),
+                model_size_mb(row_agent),
+                actor_rss_mb(row_agent, game_files, args),
+            ]
+        )
+    print_table(
+        [
+            "agent",
+            "games",
+            "avg normalized reward",
+            "action agreement (%)",
+            "step latency (ms)",
+            "model size (MB)",
+            "actor RSS (MB)",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", default=None)
+    parser.add_argument("--game-dir", default="test-data/rl_games")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--max-episode-steps", type=int, default=100)
+    parser.add_argument("--num-threads", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,107 @@
+"""
+Benchmark the basis-first aggregation mode of GraphEncoder against the default
+mode, using the model sizes from train_graph_updater_conf/model_size/original.yaml.
+
+python -m benchmarks.rgcn_basis_first
+"""
+import argparse
+import torch
+
+from layers import GraphEncoder
+from benchmarks.utils import time_fn, peak_memory_mb, print_table
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(42)
+    device = torch.device(args.device)
+    graph_encoder = GraphEncoder(
+        args.hidden_dim + args.node_emb_dim,
+        args.hidden_dim + args.relation_emb_dim,
+        args.num_relations,
+        [args.hidden_dim] * args.num_layers,
+        args.num_bases,
+    ).to(device)
+    basis_first_graph_encoder = GraphEncoder(
+        args.hidden_dim + args.node_emb_dim,
+        args.hidden_dim + args.relation_emb_dim,
+        args.num_relations,
+        [args.hidden_dim] * args.num_layers,
+        args.num_bases,
+        basis_first=True,
+    ).to(device)
+    basis_first_graph_encoder.load_state_dict(graph_encoder.state_dict())
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        node_features = torch.rand(
+            batch_size,
+            args.num_nodes,
+            args.hidden_dim + args.node_emb_dim,
+            device=device,
+        )
+        relation_features = torch.rand(
+            batch_size,
+            args.num_relations,
+            args.hidden_dim + args.relation_emb_dim,
+            device=device,
+        )
+        # tanh outputs from GraphUpdater.f_d are in [-1, 1]
+        adj = torch.empty(
+            batch_size,
+            args.num_relations,
+            args.num_nodes,
+            args.num_nodes,
+            device=device,
+        ).uniform_(-1, 1)
+
+        @torch.no_grad()
+        def run_default() -> torch.Tensor:
+            return graph_encoder(node_features, relation_features, adj)
+
+        @torch.no_grad()
+        def run_basis_first() -> torch.Tensor:
+            return basis_first_graph_encoder(node_features, relation_features, adj)
+
+        max_diff = (run_default() - run_basis_first()).abs().max().item()
+        default_ms = time_fn(run_default, repeat=args.repeat)
+        basis_first_ms = time_fn(run_basis_first, repeat=args.repeat)
+        default_mb = peak_memory_mb(run_default)
+        basis_first_mb = peak_memory_mb(run_basis_first)
+        rows.append(
+            [
+                batch_size,
+                default_ms,
+                basis_first_ms,
+                default_ms / basis_first_ms,
+                default_mb,
+                basis_first_mb,
+                f"{max_diff:.1e}",
+            ]
+        )
+    print_table(
+        [
+            "batch",
+            "default (ms)",
+            "basis first (ms)",
+            "speedup",
+            "default peak (MB)",
+            "basis first peak (MB)",
+            "max abs diff",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--hidden-dim", type=int, default=64)
+    parser.add_argument("--node-emb-dim", type=int, default=100)
+    parser.add_argument("--relation-emb-dim", type=int, default=32)
+    parser.add_argument("--num-relations", type=int, default=20)
+    parser.add_argument("--num-nodes", type=int, default=99)
+    parser.add_argument("--num-layers", type=int, default=6)
+    parser.add_argument("--num-bases", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--device", default="cpu")
+    main(parser.parse_args())
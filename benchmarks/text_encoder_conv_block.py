@@ -0,0 +1,81 @@
+"""
+Benchmark the channels-last TextEncoderConvBlock against the default one, using
+the conv layers of a text encoder block with the model sizes from
+train_graph_updater_conf/model_size/original.yaml.
+
+python -m benchmarks.text_encoder_conv_block
+"""
+import argparse
+import torch
+import torch.nn as nn
+
+from layers import TextEncoderConvBlock
+from benchmarks.utils import time_fn, print_table
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(42)
+    device = torch.device(args.device)
+    conv_layers = nn.Sequential(
+        *[
+            TextEncoderConvBlock(args.hidden_dim, args.kernel_size)
+            for _ in range(args.num_conv_layers)
+        ]
+    ).to(device)
+    channels_last_conv_layers = nn.Sequential(
+        *[
+            TextEncoderConvBlock(args.hidden_dim, args.kernel_size, channels_last=True)
+            for _ in range(args.num_conv_layers)
+        ]
+    ).to(device)
+    channels_last_conv_layers.load_state_dict(conv_layers.state_dict())
+
+    rows = []
+    for batch_size, seq_len in zip(args.batch_sizes, args.seq_lens):
+        input = torch.rand(batch_size, seq_len, args.hidden_dim, device=device)
+
+        @torch.no_grad()
+        def infer(model: nn.Module) -> torch.Tensor:
+            return model(input)
+
+        def train(model: nn.Module) -> torch.Tensor:
+            model.zero_grad()
+            output = model(input)
+            output.sum().backward()
+            return output
+
+        max_diff = (infer(conv_layers) - infer(channels_last_conv_layers)).abs().max()
+        row = [batch_size, seq_len]
+        for fn in [infer, train]:
+            default_ms = time_fn(lambda: fn(conv_layers), repeat=args.repeat)
+            channels_last_ms = time_fn(
+                lambda: fn(channels_last_conv_layers), repeat=args.repeat
+            )
+            row += [default_ms, channels_last_ms, default_ms / channels_last_ms]
+        rows.append(row + [f"{max_diff.item():.1e}"])
+    print_table(
+        [
+            "batch",
+            "seq len",
+            "infer default (ms)",
+            "infer channels last (ms)",
+            "infer speedup",
+            "train default (ms)",
+            "train channels last (ms)",
+            "train speedup",
+            "max abs diff",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 48, 300])
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[100, 100, 200, 8])
+    parser.add_argument("--hidden-dim", type=int, default=64)
+    parser.add_argument("--kernel-size", type=int, default=5)
+    parser.add_argument("--num-conv-layers", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--device", default="cpu")
+    main(parser.parse_args())
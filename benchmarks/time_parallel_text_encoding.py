@@ -0,0 +1,169 @@
+"""
+Compare the time-parallel text encoding of GraphUpdaterObsGen.process_batch(),
+which encodes the observations and previous actions of all the steps of a truncated
+BPTT window in one batched call to the text encoder, against encoding them step by
+step, with the tiny and original model sizes from train_graph_updater_conf/model_size/,
+on the episodes of test-data/test-data.json, which are repeated to fill the training
+batch sizes.
+
+Reported are the times and the throughputs, in episode steps per second, of training
+steps, i.e. forward and backward passes of a truncated BPTT window, and eval steps,
+as well as the differences of the losses and the RNN hidden states.
+
+python -m benchmarks.time_parallel_text_encoding
+"""
+import argparse
+import json
+import random
+import torch
+
+from typing import Any, Dict, List
+
+from train_graph_updater import GraphUpdaterObsGen
+from graph_updater_data import GraphUpdaterObsGenDataModule
+from benchmarks.utils import time_fn, print_table
+
+MODEL_SIZES: Dict[str, Dict[str, Any]] = {
+    # tiny.yaml doesn't set any model sizes, so the defaults of GraphUpdaterObsGen
+    "tiny": {"batch_size": 4, "model_kwargs": {}},
+    "original": {
+        "batch_size": 48,
+        "model_kwargs": {
+            "hidden_dim": 64,
+            "word_emb_dim": 300,
+            "node_emb_dim": 100,
+            "relation_emb_dim": 32,
+            "text_encoder_num_blocks": 1,
+            "text_encoder_num_conv_layers": 5,
+            "text_encoder_kernel_size": 5,
+            "text_encoder_num_heads": 1,
+            "graph_encoder_num_cov_layers": 6,
+            "graph_encoder_num_bases": 3,
+            "text_decoder_num_blocks": 1,
+            "text_decoder_num_heads": 1,
+        },
+    },
+}
+
+
+def load_batch(
+    dm: GraphUpdaterObsGenDataModule, path: str, batch_size: int, num_steps: int
+) -> List[Dict[str, torch.Tensor]]:
+    with open(path) as f:
+        episodes = json.load(f)
+    batch = dm.prepare_batch(random.choices(episodes, k=batch_size))
+    return batch[:num_steps]
+
+
+def main(args: argparse.Namespace) -> None:
+    random.seed(42)
+    torch.set_num_threads(args.num_threads)
+    dm = GraphUpdaterObsGenDataModule(
+        args.test_data,
+        1,
+        0,
+        args.test_data,
+        1,
+        0,
+        args.test_data,
+        1,
+        0,
+        "vocabs/word_vocab.txt",
+    )
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+
+    rows = []
+    for size in args.model_sizes:
+        batch_size = args.batch_size or MODEL_SIZES[size]["batch_size"]
+        batch = load_batch(dm, args.test_data, batch_size, args.tbptt_steps)
+        num_steps = int(sum(step["step_mask"].sum().item() for step in batch))
+        models = []
+        for time_parallel_text_encoding in [False, True]:
+            torch.manual_seed(42)
+            models.append(
+                GraphUpdaterObsGen(
+                    time_parallel_text_encoding=time_parallel_text_encoding,
+                    **MODEL_SIZES[size]["model_kwargs"],
+                    **vocab_paths,
+                )
+            )
+
+        @torch.no_grad()
+        def eval_step(model: GraphUpdaterObsGen) -> Dict[str, List[torch.Tensor]]:
+            model.eval()
+            return model.process_batch(batch)
+
+        def train_step(model: GraphUpdaterObsGen) -> torch.Tensor:
+            model.train()
+            model.zero_grad()
+            loss = torch.stack(model.process_batch(batch)["losses"]).mean()
+            loss.backward()
+            return loss
+
+        step_results = [eval_step(model) for model in models]
+        for name, model, results in zip(
+            ["step by step", "time-parallel"], models, step_results
+        ):
+            loss_diff = max(
+                (loss - step_by_step_loss).abs().item()
+                for loss, step_by_step_loss in zip(
+                    results["losses"], step_results[0]["losses"]
+                )
+            )
+            hidden_diff = max(
+                (hidden - step_by_step_hidden).abs().max().item()
+                for hidden, step_by_step_hidden in zip(
+                    results["hiddens"], step_results[0]["hiddens"]
+                )
+            )
+            train_ms = time_fn(lambda: train_step(model), repeat=args.repeat)
+            eval_ms = time_fn(lambda: eval_step(model), repeat=args.repeat)
+            rows.append(
+                [
+                    size,
+                    name,
+                    batch_size,
+                    train_ms,
+                    num_steps / train_ms * 1000,
+                    eval_ms,
+                    num_steps / eval_ms * 1000,
+                    f"{loss_diff:.1e}",
+                    f"{hidden_diff:.1e}",
+                ]
+            )
+    print_table(
+        [
+            "model size",
+            "text encoding",
+            "batch",
+            "train step (ms)",
+            "train steps/s",
+            "eval step (ms)",
+            "eval steps/s",
+            "max loss diff",
+            "max hidden diff",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test-data", default="test-data/test-data.json")
+    parser.add_argument(
+        "--model-sizes", nargs="+", default=["tiny", "original"], choices=MODEL_SIZES
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="defaults to the training batch sizes of the model sizes",
+    )
+    parser.add_argument("--tbptt-steps", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=4)
+    main(parser.parse_args())
@@ -0,0 +1,64 @@
+import time
+import resource
+import multiprocessing as mp
+import torch
+
+from typing import Callable, List, Sequence
+
+
+def time_fn(fn: Callable[[], object], repeat: int = 10, warmup: int = 2) -> float:
+    """
+    Return the mean wall-clock time of fn() in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _peak_rss_worker(fn: Callable[[], object], queue: mp.Queue) -> None:
+    # ru_maxrss is in kilobytes on linux
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((after - before) / 1024)
+
+
+def peak_memory_mb(fn: Callable[[], object]) -> float:
+    """
+    Return the peak memory increase in MB while running fn().
+
+    On CUDA, this is based on torch.cuda.max_memory_allocated(). On CPU, fn() is
+    run in a forked process, and the increase of its max resident set size is
+    reported, so fn() has to be fork-safe.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - before) / 1024 ** 2
+    ctx = mp.get_context("fork")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_peak_rss_worker, args=(fn, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def print_table(header: Sequence[str], rows: List[Sequence[object]]) -> None:
+    """
+    Print a markdown table.
+    """
+    print("| " + " | ".join(header) + " |")
+    print("|" + "|".join("---" for _ in header) + "|")
+    for row in rows:
+        print(
+            "| "
+            + " | ".join(f"{c:.2f}" if isinstance(c, float) else str(c) for c in row)
+            + " |"
+        )
@@ -0,0 +1,128 @@
+"""
+Distill the dense graph decoder of a pretrained GraphUpdaterObsGen checkpoint into
+a low-rank factorized one, and save it as a new checkpoint, which can be used as
+model.pretrained_graph_updater.ckpt_path of train_gata.py with the same
+model.graph_decoder_rank and model.graph_decoder_relation_rank.
+
+The factorized graph decoder is fit to the graphs of the RNN hidden states that the
+graph updater reaches on the episodes of --data-path, e.g. the training data of the
+graph updater. A held-out fraction of them is used to report the fidelity of the
+distilled graphs w.r.t. the dense ones, i.e. the mean squared error and the
+agreement of the edges thresholded at 0. Without --data-path, the hidden states
+are sampled uniformly from [-1, 1], which doesn't reflect the states the graph
+updater actually reaches.
+
+python distill_graph_decoder.py pretrained/graph-updater-obs-gen.ckpt \
+    pretrained/graph-updater-obs-gen-rank-32.ckpt --rank 32 \
+    --data-path data/obs_gen.0.1/train.json
+"""
+import torch
+import torch.nn.functional as F
+
+from pytorch_lightning.utilities.cloud_io import load as pl_load, atomic_save
+from torch.utils.data import DataLoader
+
+from train_graph_updater import GraphUpdaterObsGen
+from graph_updater_data import GraphUpdaterDataset, GraphUpdaterObsGenDataModule
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("graph_updater_obs_gen_ckpt")
+    parser.add_argument("output_ckpt")
+    parser.add_argument("--rank", type=int, required=True)
+    parser.add_argument("--relation-rank", type=int, default=None)
+    parser.add_argument("--num-steps", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--data-path", default=None)
+    parser.add_argument("--data-batch-size", type=int, default=16)
+    parser.add_argument("--held-out-fraction", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--word-vocab-path", default="vocabs/word_vocab.txt")
+    parser.add_argument("--node-vocab-path", default="vocabs/node_vocab.txt")
+    parser.add_argument("--relation-vocab-path", default="vocabs/relation_vocab.txt")
+    args = parser.parse_args()
+
+    graph_updater_obs_gen = GraphUpdaterObsGen.load_from_checkpoint(
+        args.graph_updater_obs_gen_ckpt,
+        word_vocab_path=args.word_vocab_path,
+        node_vocab_path=args.node_vocab_path,
+        relation_vocab_path=args.relation_vocab_path,
+    )
+    graph_updater = graph_updater_obs_gen.graph_updater
+
+    torch.manual_seed(args.seed)
+    rnn_hiddens = None
+    held_out_hiddens = None
+    if args.data_path is not None:
+        # only used for the preprocessor
+        data_module = GraphUpdaterObsGenDataModule(
+            args.data_path,
+            args.data_batch_size,
+            0,
+            args.data_path,
+            args.data_batch_size,
+            0,
+            args.data_path,
+            args.data_batch_size,
+            0,
+            args.word_vocab_path,
+        )
+        hiddens = graph_updater_obs_gen.collect_rnn_hiddens(
+            DataLoader(
+                GraphUpdaterDataset(data_module.train_path),
+                batch_size=args.data_batch_size,
+                collate_fn=data_module.prepare_batch,
+            )
+        )
+        hiddens = hiddens[torch.randperm(hiddens.size(0))]
+        num_held_out = int(hiddens.size(0) * args.held_out_fraction)
+        held_out_hiddens = hiddens[:num_held_out]
+        rnn_hiddens = hiddens[num_held_out:]
+        print(
+            f"collected {hiddens.size(0)} hidden states: "
+            f"{rnn_hiddens.size(0)} to fit, {num_held_out} held out"
+        )
+    if held_out_hiddens is None or held_out_hiddens.size(0) == 0:
+        held_out_hiddens = (
+            torch.rand(
+                1000, graph_updater.hidden_dim, device=graph_updater_obs_gen.device
+            )
+            * 2
+            - 1
+        )
+    with torch.no_grad():
+        dense_graph = graph_updater.f_d(held_out_hiddens)
+
+    losses = graph_updater_obs_gen.distill_factorized_graph_decoder(
+        args.rank,
+        relation_rank=args.relation_rank,
+        rnn_hiddens=rnn_hiddens,
+        num_steps=args.num_steps,
+        batch_size=args.batch_size,
+        learning_rate=args.learning_rate,
+    )
+    print(f"distillation loss: {losses[0]:.4f} -> {losses[-1]:.4f}")
+
+    with torch.no_grad():
+        graph = graph_updater.f_d(held_out_hiddens)
+    mse = F.mse_loss(graph, dense_graph).item()
+    agreement = (graph > 0).eq(dense_graph > 0).float().mean().item() * 100
+    print(
+        f"held-out fidelity on {held_out_hiddens.size(0)} hidden states: "
+        f"mse {mse:.4f}, edge agreement {agreement:.2f}%"
+    )
+
+    ckpt = pl_load(args.graph_updater_obs_gen_ckpt, map_location="cpu")
+    # the optimizer states are of the dense graph decoder, so drop them
+    ckpt.pop("optimizer_states", None)
+    ckpt.pop("lr_schedulers", None)
+    ckpt["state_dict"] = graph_updater_obs_gen.state_dict()
+    ckpt[GraphUpdaterObsGen.CHECKPOINT_HYPER_PARAMS_KEY].update(
+        graph_decoder_rank=args.rank,
+        graph_decoder_relation_rank=args.relation_rank,
+    )
+    atomic_save(ckpt, args.output_ckpt)
@@ -1,12 +1,43 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from typing import Optional, Dict
+from dataclasses import dataclass
+from typing import Optional, Dict, Union, Any, List
 
-from layers import GraphEncoder, TextEncoder, ReprAggregator, EncoderMixin
+from layers import (
+    GraphEncoder,
+    TextEncoder,
+    ReprAggregator,
+    EncoderMixin,
+    ActiveNodes,
+    QuantizedAdjacency,
+    FactorizedGraphDecoder,
+)
 from utils import masked_mean
 
 
+@dataclass
+class GraphUpdaterState:
+    """
+    Recurrent state of GraphUpdater, i.e. the 'state' of its output, which can be
+    passed to the next step as prev_state, so that the previous graph doesn't have
+    to be decoded from the rnn hidden state, and encoded, again. If only the rnn
+    hidden state is available, e.g. for transitions sampled from the replay buffer,
+    g_t and encoded_g_t are None, and they're calculated from h_t.
+    """
+
+    # hidden state of the rnn cell; (batch, hidden_dim)
+    h_t: torch.Tensor
+    # decoded graph, same as 'g_t' of the output of GraphUpdater
+    g_t: Optional[Union[torch.Tensor, QuantizedAdjacency]] = None
+    # encoded graph, only available when pretraining; (batch, num_node, hidden_dim)
+    encoded_g_t: Optional[torch.Tensor] = None
+    # active nodes so far in the episodes, only set by Agent in active node mode
+    # (batch, num_node)
+    active_node_mask: Optional[torch.Tensor] = None
+
+
 class GraphUpdater(EncoderMixin, nn.Module):
     def __init__(
         self,
@@ -27,6 +58,11 @@ class GraphUpdater(EncoderMixin, nn.Module):
         node_name_mask: torch.Tensor,
         rel_name_word_ids: torch.Tensor,
         rel_name_mask: torch.Tensor,
+        gradient_checkpointing: bool = False,
+        graph_decoder_rank: Optional[int] = None,
+        graph_decoder_relation_rank: Optional[int] = None,
+        basis_first: bool = False,
+        channels_last: bool = False,
     ) -> None:
         super().__init__()
         # constants
@@ -71,6 +107,8 @@ class GraphUpdater(EncoderMixin, nn.Module):
             text_encoder_kernel_size,
             hidden_dim,
             text_encoder_num_heads,
+            gradient_checkpointing=gradient_checkpointing,
+            channels_last=channels_last,
         )
         self.graph_encoder = GraphEncoder(
             hidden_dim + node_emb_dim,
@@ -78,6 +116,8 @@ class GraphUpdater(EncoderMixin, nn.Module):
             num_relations,
             [hidden_dim] * graph_encoder_num_cov_layers,
             graph_encoder_num_bases,
+            basis_first=basis_first,
+            gradient_checkpointing=gradient_checkpointing,
         )
 
         # other layers
@@ -86,16 +126,39 @@ class GraphUpdater(EncoderMixin, nn.Module):
             nn.Linear(4 * hidden_dim, hidden_dim), nn.Tanh()
         )
         self.rnncell = nn.GRUCell(hidden_dim, hidden_dim)
-        self.f_d_layers = nn.Sequential(
-            nn.Linear(hidden_dim, hidden_dim),
-            nn.ReLU(),
-            nn.Linear(hidden_dim, num_relations // 2 * num_nodes * num_nodes),
-            nn.Tanh(),
-        )
+        # graph decoder, if graph_decoder_rank is set, the low-rank factorized one,
+        # otherwise the dense one, whose last linear layer has
+        # num_relations // 2 * num_nodes * num_nodes outputs.
+        self.f_d_layers: Optional[nn.Sequential] = None
+        self.factorized_graph_decoder: Optional[FactorizedGraphDecoder] = None
+        if graph_decoder_rank is None:
+            self.f_d_layers = nn.Sequential(
+                nn.Linear(hidden_dim, hidden_dim),
+                nn.ReLU(),
+                nn.Linear(hidden_dim, num_relations // 2 * num_nodes * num_nodes),
+                nn.Tanh(),
+            )
+        else:
+            self.factorized_graph_decoder = FactorizedGraphDecoder(
+                hidden_dim,
+                num_relations // 2,
+                num_nodes,
+                graph_decoder_rank,
+                relation_rank=graph_decoder_relation_rank,
+            )
 
         # pretraining flag
         self.pretraining = False
 
+        # if True, decoded graphs only have the forward half of the relations,
+        # (batch, num_relation // 2, num_node, num_node), and the graph encoders
+        # calculate the reverse relations from them without materializing them.
+        self.forward_half_graph = False
+
+        # if set, decoded graphs are QuantizedAdjacency's with values of this dtype,
+        # e.g. torch.int8 or torch.bfloat16, which the graph encoders accept.
+        self.quantized_graph_dtype: Optional[torch.dtype] = None
+
     def f_delta(
         self,
         prev_node_hidden: torch.Tensor,
@@ -103,6 +166,7 @@ class GraphUpdater(EncoderMixin, nn.Module):
         prev_action_hidden: torch.Tensor,
         obs_mask: torch.Tensor,
         prev_action_mask: torch.Tensor,
+        prev_node_mask: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """
         prev_node_hidden: (batch, num_node, hidden_dim)
@@ -110,44 +174,156 @@ class GraphUpdater(EncoderMixin, nn.Module):
         prev_action_hidden: (batch, prev_action_len, hidden_dim)
         obs_mask: (batch, obs_len)
         prev_action_mask: (batch, prev_action_len)
+        prev_node_mask: (batch, num_node), only necessary for active node subgraphs
 
         output: (batch, 4 * hidden_dim)
         """
-        batch_size = prev_node_hidden.size(0)
-        # no masks necessary for prev_node_hidden, so just create a fake one
-        prev_node_mask = torch.ones(
-            batch_size, self.num_nodes, device=prev_node_hidden.device
-        )
+        if prev_node_mask is None:
+            # no masks necessary for prev_node_hidden, so just create a fake one
+            prev_node_mask = torch.ones(
+                prev_node_hidden.size()[:2], device=prev_node_hidden.device
+            )
 
         # h_og: (batch, obs_len, hidden_dim)
         # h_go: (batch, num_node, hidden_dim)
         h_og, h_go = self.repr_aggr(
             obs_hidden, prev_node_hidden, obs_mask, prev_node_mask
         )
+        # mean_h_go is used in place of mean_h_ga below, so we only need h_ag
+        # from the aggregation of the previous action and graph
         # h_ag: (batch, prev_action_len, hidden_dim)
-        # h_ga: (batch, num_node, hidden_dim)
-        h_ag, h_ga = self.repr_aggr(
+        h_ag = self.repr_aggr.aggregate(
             prev_action_hidden, prev_node_hidden, prev_action_mask, prev_node_mask
         )
 
         mean_h_og = masked_mean(h_og, obs_mask)
         mean_h_go = masked_mean(h_go, prev_node_mask)
         mean_h_ag = masked_mean(h_ag, prev_action_mask)
-        mean_h_ga = masked_mean(h_go, prev_node_mask)
+        mean_h_ga = mean_h_go
 
         return torch.cat([mean_h_og, mean_h_go, mean_h_ag, mean_h_ga], dim=1)
 
-    def f_d(self, rnn_hidden: torch.Tensor) -> torch.Tensor:
+    def f_d(
+        self, rnn_hidden: torch.Tensor, active_nodes: Optional[ActiveNodes] = None
+    ) -> Union[torch.Tensor, QuantizedAdjacency]:
         """
         rnn_hidden: (batch, hidden_dim)
+        active_nodes: if given, only decode the subgraph of the active nodes.
         output: (batch, num_relation, num_node, num_node)
+            or (batch, num_relation // 2, num_node, num_node)
+            if self.forward_half_graph is True.
+            num_node is max_active_node if active_nodes is given.
+            QuantizedAdjacency if self.quantized_graph_dtype is set.
         """
-        h = self.f_d_layers(rnn_hidden).view(
-            -1, self.num_relations // 2, self.num_nodes, self.num_nodes
-        )
+        if self.factorized_graph_decoder is not None:
+            h = self.factorized_graph_decoder(
+                rnn_hidden, node_ids=None if active_nodes is None else active_nodes.ids
+            )
+            if active_nodes is not None:
+                h = active_nodes.mask_graph(h)
+        elif active_nodes is None:
+            h = self.f_d_layers(rnn_hidden).view(  # type: ignore
+                -1, self.num_relations // 2, self.num_nodes, self.num_nodes
+            )
+        else:
+            h = active_nodes.mask_graph(self.decode_subgraph(rnn_hidden, active_nodes))
         # (batch, num_relation // 2, num_node, num_node)
-        return torch.cat([h, h.transpose(2, 3)], dim=1)
-        # (batch, num_relation, num_node, num_node)
+        if not self.forward_half_graph:
+            h = torch.cat([h, h.transpose(2, 3)], dim=1)
+            # (batch, num_relation, num_node, num_node)
+        if self.quantized_graph_dtype is None:
+            return h
+        return QuantizedAdjacency.from_dense(h, dtype=self.quantized_graph_dtype)
+
+    def decode_subgraph(
+        self, rnn_hidden: torch.Tensor, active_nodes: ActiveNodes
+    ) -> torch.Tensor:
+        """
+        Same as f_d_layers, but the last linear layer is calculated only for
+        the edges between the active nodes by gathering its weights for them.
+
+        rnn_hidden: (batch, hidden_dim)
+
+        output: (batch, num_relation // 2, max_active_node, max_active_node)
+        """
+        assert self.f_d_layers is not None
+        h = self.f_d_layers[:2](rnn_hidden)
+        # (batch, hidden_dim)
+        linear = self.f_d_layers[2]
+        weight = linear.weight
+        bias = linear.bias
+        if callable(weight):
+            # dynamically quantized, see quantize_dynamic_agent() in train_gata.py
+            weight = weight().dequantize()  # type: ignore
+            bias = bias()  # type: ignore
+        weight = weight.view(
+            self.num_relations // 2, self.num_nodes, self.num_nodes, -1
+        )
+        # (num_relation // 2, num_node, num_node, hidden_dim)
+        bias = bias.view(self.num_relations // 2, self.num_nodes, self.num_nodes)
+        # (num_relation // 2, num_node, num_node)
+        row_ids = active_nodes.ids.unsqueeze(2)
+        col_ids = active_nodes.ids.unsqueeze(1)
+        h = torch.einsum("rbijd,bd->brij", weight[:, row_ids, col_ids], h)
+        # (batch, num_relation // 2, max_active_node, max_active_node)
+        h += bias[:, row_ids, col_ids].transpose(0, 1)
+        # (batch, num_relation // 2, max_active_node, max_active_node)
+        return self.f_d_layers[3](h)
+        # (batch, num_relation // 2, max_active_node, max_active_node)
+
+    def distill_factorized_graph_decoder(
+        self,
+        rank: int,
+        relation_rank: Optional[int] = None,
+        rnn_hiddens: Optional[torch.Tensor] = None,
+        num_steps: int = 1000,
+        batch_size: int = 64,
+        learning_rate: float = 1e-3,
+    ) -> List[float]:
+        """
+        Fit a FactorizedGraphDecoder to the decoded graphs of the dense graph decoder,
+        e.g. the one of a pretrained graph updater, and replace the dense graph
+        decoder with it.
+
+        rnn_hiddens: (num_hiddens, hidden_dim), RNN hidden states to fit the graphs
+            of, e.g. collected by playing games. If not given, they're sampled
+            uniformly from [-1, 1], the range of the hidden states of GRUCell.
+
+        output: the losses of the steps, i.e. the mean squared errors of the edges
+        """
+        assert self.f_d_layers is not None
+        device = self.f_d_layers[0].weight.device
+        decoder = FactorizedGraphDecoder(
+            self.hidden_dim,
+            self.num_relations // 2,
+            self.num_nodes,
+            rank,
+            relation_rank=relation_rank,
+        ).to(device)
+        optimizer = torch.optim.Adam(decoder.parameters(), lr=learning_rate)
+        losses: List[float] = []
+        for _ in range(num_steps):
+            if rnn_hiddens is None:
+                rnn_hidden = torch.rand(batch_size, self.hidden_dim, device=device)
+                rnn_hidden = rnn_hidden * 2 - 1
+            else:
+                rnn_hidden = rnn_hiddens[
+                    torch.randint(rnn_hiddens.size(0), (batch_size,))
+                ].to(device)
+            # (batch, hidden_dim)
+            with torch.no_grad():
+                target = self.f_d_layers(rnn_hidden).view(
+                    -1, self.num_relations // 2, self.num_nodes, self.num_nodes
+                )
+            optimizer.zero_grad()
+            loss = F.mse_loss(decoder(rnn_hidden), target)
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        decoder.requires_grad_(self.f_d_layers[0].weight.requires_grad)
+        self.factorized_graph_decoder = decoder
+        self.f_d_layers = None
+        return losses
 
     def forward(
         self,
@@ -156,18 +332,37 @@ class GraphUpdater(EncoderMixin, nn.Module):
         obs_mask: torch.Tensor,
         prev_action_mask: torch.Tensor,
         rnn_prev_hidden: Optional[torch.Tensor] = None,
-    ) -> Dict[str, torch.Tensor]:
+        active_nodes: Optional[ActiveNodes] = None,
+        prev_state: Optional[GraphUpdaterState] = None,
+        encoded_obs: Optional[torch.Tensor] = None,
+        encoded_prev_action: Optional[torch.Tensor] = None,
+    ) -> Dict[str, Any]:
         """
         obs_word_ids: (batch, obs_len)
         prev_action_word_ids: (batch, prev_action_len)
         obs_mask: (batch, obs_len)
         prev_action_mask: (batch, prev_action_len)
         rnn_prev_hidden: (batch, hidden_dim)
+        active_nodes: if given, only the subgraphs of the active nodes are decoded
+            and encoded, so num_node in the output is max_active_node.
+            Not supported for pretraining.
+        prev_state: 'state' of the output of the previous step, which can be given
+            instead of rnn_prev_hidden to reuse its decoded and encoded graph.
+            Its graphs are ignored if active_nodes is given, b/c the active nodes
+            may have changed since the previous step.
+        encoded_obs: (batch, obs_len, hidden_dim), if given, used instead of
+            encoding obs_word_ids, e.g. encoded with the other steps of an episode
+            by encode_text_steps().
+        encoded_prev_action: (batch, prev_action_len, hidden_dim), if given, used
+            instead of encoding prev_action_word_ids.
 
         output:
         {
             'h_t': hidden state of the rnn cell at time t; (batch, hidden_dim)
             'g_t': decoded graph at time t; (batch, num_relation, num_node, num_node)
+                or (batch, num_relation // 2, num_node, num_node)
+                if self.forward_half_graph is True
+                or QuantizedAdjacency if self.quantized_graph_dtype is set
             'h_ag': aggregated representation of the previous action
                 with the current graph. Used for pretraining.
                 (batch, prev_action_len, hidden_dim)
@@ -176,12 +371,23 @@ class GraphUpdater(EncoderMixin, nn.Module):
                 (batch, num_node, hidden_dim)
             'prj_obs': projected input obs word embeddings. Used for pretraining.
                 (batch, obs_len, hidden_dim)
+            'state': GraphUpdaterState of h_t, g_t and, if pretraining, the encoded
+                g_t to be passed to the next step as prev_state.
         }
         """
+        assert active_nodes is None or not self.pretraining
+        assert rnn_prev_hidden is None or prev_state is None
         batch_size = obs_word_ids.size(0)
+        if prev_state is not None:
+            rnn_prev_hidden = prev_state.h_t
+            if active_nodes is not None:
+                prev_state = GraphUpdaterState(rnn_prev_hidden)
 
         # encode previous actions
-        encoded_prev_action = self.encode_text(prev_action_word_ids, prev_action_mask)
+        if encoded_prev_action is None:
+            encoded_prev_action = self.encode_text(
+                prev_action_word_ids, prev_action_mask
+            )
         # (batch, prev_action_len, hidden_dim)
 
         # decode the previous graph
@@ -189,20 +395,26 @@ class GraphUpdater(EncoderMixin, nn.Module):
         # Also this makes it easier to train the action selector as you can simply
         # put zeros for rnn_prev_hidden for initial transitions, instead of having to
         # worry about None.
-        prev_graph = self.f_d(
-            torch.zeros(batch_size, self.hidden_dim, device=obs_word_ids.device)
-            if rnn_prev_hidden is None
-            else rnn_prev_hidden
-        )
+        # If prev_state has the previous graph, reuse it.
+        if prev_state is not None and prev_state.g_t is not None:
+            prev_graph = prev_state.g_t
+        else:
+            prev_graph = self.f_d(
+                torch.zeros(batch_size, self.hidden_dim, device=obs_word_ids.device)
+                if rnn_prev_hidden is None
+                else rnn_prev_hidden,
+                active_nodes=active_nodes,
+            )
         # (batch, num_relation, num_node, num_node)
 
         if self.pretraining:
             # encode text observations
             # we don't use encode_text here
             # b/c we want to return obs_word_embs for pretraining
-            obs_word_embs = self.word_embeddings(obs_word_ids)
+            obs_word_embs = self.embed_words(obs_word_ids)
             # (batch, obs_len, hidden_dim)
-            encoded_obs = self.text_encoder(obs_word_embs, obs_mask)
+            if encoded_obs is None:
+                encoded_obs = self.text_encoder(obs_word_embs, obs_mask)
             # encoded_obs: (batch, obs_len, hidden_dim)
             # prj_obs: (batch, obs_len, hidden_dim)
 
@@ -218,17 +430,27 @@ class GraphUpdater(EncoderMixin, nn.Module):
                 self.get_relation_features().unsqueeze(0).expand(batch_size, -1, -1)
             )
             # (batch, num_relations, hidden_dim + relation_emb_dim)
-            encoded_prev_graph = self.graph_encoder(
-                node_features, relation_features, prev_graph
-            )
+            first_layer_projected_features = self.get_first_layer_projected_features()
+            if prev_state is not None and prev_state.encoded_g_t is not None:
+                encoded_prev_graph = prev_state.encoded_g_t
+            else:
+                encoded_prev_graph = self.graph_encoder(
+                    node_features,
+                    relation_features,
+                    self.prepare_graph(prev_graph),
+                    first_layer_projected_features,
+                )
             # (batch, num_node, hidden_dim)
         else:
             # encode text observations
-            encoded_obs = self.encode_text(obs_word_ids, obs_mask)
+            if encoded_obs is None:
+                encoded_obs = self.encode_text(obs_word_ids, obs_mask)
             # encoded_obs: (batch, obs_len, hidden_dim)
 
             # encode the previous graph
-            encoded_prev_graph = self.encode_graph(prev_graph)
+            encoded_prev_graph = self.encode_graph(
+                prev_graph, active_nodes=active_nodes
+            )
             # (batch, num_node, hidden_dim)
 
         delta_g = self.f_delta(
@@ -237,6 +459,7 @@ class GraphUpdater(EncoderMixin, nn.Module):
             encoded_prev_action,
             obs_mask,
             prev_action_mask,
+            prev_node_mask=None if active_nodes is None else active_nodes.mask,
         )
         # (batch, 4 * hidden_dim)
 
@@ -246,10 +469,14 @@ class GraphUpdater(EncoderMixin, nn.Module):
         # (batch, hidden_dim)
 
         # (batch, num_node, hidden_dim)
-        curr_graph = self.f_d(h_t)
+        curr_graph = self.f_d(h_t, active_nodes=active_nodes)
         # (batch, num_relation, num_node, num_node)
 
-        results: Dict[str, torch.Tensor] = {"h_t": h_t, "g_t": curr_graph}
+        results: Dict[str, Any] = {
+            "h_t": h_t,
+            "g_t": curr_graph,
+            "state": GraphUpdaterState(h_t, g_t=curr_graph),
+        }
         if not self.pretraining:
             return results
 
@@ -257,9 +484,13 @@ class GraphUpdater(EncoderMixin, nn.Module):
         # the current graph and previous action
         # no masks necessary for encoded_curr_graph, so just create a fake one
         encoded_curr_graph = self.graph_encoder(
-            node_features, relation_features, curr_graph
+            node_features,
+            relation_features,
+            self.prepare_graph(curr_graph),
+            first_layer_projected_features,
         )
         # (batch, num_node, hidden_dim)
+        results["state"].encoded_g_t = encoded_curr_graph
         h_ag, h_ga = self.repr_aggr(
             encoded_prev_action,
             encoded_curr_graph,
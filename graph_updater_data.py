@@ -6,7 +6,7 @@ from typing import Optional, Dict, List, Any
 from torch.utils.data import Dataset, DataLoader
 from hydra.utils import to_absolute_path
 
-from preprocessor import SpacyPreprocessor, PAD, BOS, EOS
+from preprocessor import SpacyPreprocessor, BOS, EOS
 
 
 class GraphUpdaterDataset(Dataset):
@@ -79,7 +79,8 @@ class GraphUpdaterObsGenDataModule(pl.LightningDataModule):
         """
         This is a bit tricky, b/c we have to pad the episodes as well as the
         observation and previous action strings within each episode. The original
-        GATA code padded episodes with '<pad>' strings, and that's what we do here.
+        GATA code padded episodes with '<pad>' strings, but we pad them with
+        empty strings, i.e. fully masked observations and previous actions.
 
         Following the original GATA code, '<bos>' is prepended to observation strings,
         and '<eos>' is appeneded to ground-truth observation strings.
@@ -109,34 +110,26 @@ class GraphUpdaterObsGenDataModule(pl.LightningDataModule):
             # Collect the observations and prev action of the i'th episode
             # and batchify them.
             # If the length of an episode is shorter than max_episode_len,
-            # just add an empty string.
+            # they're empty, i.e. fully masked.
             # They're already tokenized, so split() is sufficient.
             episode_padded_obs = [
-                episode[i]["observation"] if i < len(episode) else ""
+                episode[i]["observation"].split() if i < len(episode) else None
                 for episode in batch
             ]
-
-            # we add BOS and EOS even if the observation should be masked
-            # to prevent nan from multiheaded attention which happens due to a bug
-            # https://github.com/pytorch/pytorch/issues/41508
             obs_word_ids, obs_mask = self.preprocessor.preprocess_tokenized(
-                [[BOS] + padded_obs.split() for padded_obs in episode_padded_obs]
+                [[] if obs is None else [BOS] + obs for obs in episode_padded_obs]
             )
             groundtruth_obs_word_ids, _ = self.preprocessor.preprocess_tokenized(
-                [padded_obs.split() + [EOS] for padded_obs in episode_padded_obs]
+                [[] if obs is None else obs + [EOS] for obs in episode_padded_obs]
             )
 
-            episode_padded_prev_actions = [
-                episode[i]["previous_action"] if i < len(episode) else PAD
-                for episode in batch
-            ]
             (
                 prev_action_word_ids,
                 prev_action_mask,
             ) = self.preprocessor.preprocess_tokenized(
                 [
-                    padded_prev_action.split()
-                    for padded_prev_action in episode_padded_prev_actions
+                    episode[i]["previous_action"].split() if i < len(episode) else []
+                    for episode in batch
                 ]
             )
 
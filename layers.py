@@ -1,15 +1,389 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.checkpoint
 import itertools
 import math
 import abc
 
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Union, Callable, Iterable, Dict, Any, Hashable
+from dataclasses import dataclass
+from collections import OrderedDict
 
-from utils import masked_softmax, masked_mean
+from utils import masked_softmax, masked_mean, autocast_state
 from preprocessor import SpacyPreprocessor, BOS, EOS, PAD, UNK
 
 
+@dataclass
+class SparseAdjacency:
+    """
+    Sparse (COO) representation of a batch of adjacency tensors of shape
+    (batch, num_relations, num_node, num_node).
+
+    Each edge is stored as an index tuple (batch, relation, target node, source node)
+    and its weight, i.e. the edge corresponds to adj[batch, relation, target, source]
+    of the dense adjacency tensor.
+    """
+
+    # (4, num_edges)
+    indices: torch.Tensor
+    # (num_edges)
+    weights: torch.Tensor
+    batch_size: int
+    num_relations: int
+    num_nodes: int
+
+    @classmethod
+    def from_dense(cls, adj: torch.Tensor, threshold: float = 0.0) -> "SparseAdjacency":
+        """
+        Only keep the edges whose magnitudes are greater than threshold.
+
+        adj: (batch, num_relations, num_node, num_node)
+        """
+        indices = (adj.abs() > threshold).nonzero().t()
+        # (4, num_edges)
+        batch_size, num_relations, num_nodes, _ = adj.size()
+        return cls(
+            indices,
+            adj[tuple(indices)],
+            batch_size,
+            num_relations,
+            num_nodes,
+        )
+
+    @classmethod
+    def from_dense_topk(cls, adj: torch.Tensor, k: int) -> "SparseAdjacency":
+        """
+        Only keep the k edges with the largest magnitudes of each relation of
+        each graph.
+
+        adj: (batch, num_relations, num_node, num_node)
+        """
+        batch_size, num_relations, num_nodes, _ = adj.size()
+        k = min(k, num_nodes * num_nodes)
+        flat_ids = adj.flatten(start_dim=2).abs().topk(k, dim=2, sorted=False)[1]
+        # (batch, num_relations, k)
+        batch_ids = torch.arange(batch_size, device=adj.device)[:, None, None]
+        relation_ids = torch.arange(num_relations, device=adj.device)[None, :, None]
+        indices = torch.stack(
+            [
+                batch_ids.expand_as(flat_ids),
+                relation_ids.expand_as(flat_ids),
+                flat_ids // num_nodes,
+                flat_ids % num_nodes,
+            ]
+        ).flatten(start_dim=1)
+        # (4, batch * num_relations * k)
+        return cls(
+            indices,
+            adj[tuple(indices)],
+            batch_size,
+            num_relations,
+            num_nodes,
+        )
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        output: (batch, num_relations, num_node, num_node)
+        """
+        adj = torch.zeros(
+            self.batch_size,
+            self.num_relations,
+            self.num_nodes,
+            self.num_nodes,
+            dtype=self.weights.dtype,
+            device=self.weights.device,
+        )
+        adj[tuple(self.indices)] = self.weights
+        return adj
+
+    def with_reverse_relations(self) -> "SparseAdjacency":
+        """
+        Given a sparse adjacency with only the forward half of the relations,
+        return a sparse adjacency with both the forward and reverse relations,
+        where the reverse edges are the forward edges with their target and
+        source nodes swapped.
+        """
+        batch_ids, relation_ids, target_ids, source_ids = self.indices
+        reverse_indices = torch.stack(
+            [batch_ids, relation_ids + self.num_relations, source_ids, target_ids]
+        )
+        return SparseAdjacency(
+            torch.cat([self.indices, reverse_indices], dim=1),
+            torch.cat([self.weights, self.weights]),
+            self.batch_size,
+            2 * self.num_relations,
+            self.num_nodes,
+        )
+
+
+@dataclass
+class QuantizedAdjacency:
+    """
+    Quantized representation of a batch of adjacency tensors of shape
+    (batch, num_relations, num_node, num_node) with per-relation scales, i.e.
+    adj[b, r] ~= values[b, r] * scales[b, r].
+
+    int8 values are 4x, and bfloat16 values are 2x smaller than float32 adjacency
+    tensors. PyTorch doesn't have int8 x float matrix multiplication kernels, so
+    R-GCNs cast int8 values to the dtype of the node features one relation at a time,
+    while bfloat16 values are multiplied in bfloat16.
+    """
+
+    # (batch, num_relations, num_node, num_node)
+    values: torch.Tensor
+    # (batch, num_relations)
+    scales: torch.Tensor
+
+    @classmethod
+    def from_dense(
+        cls, adj: torch.Tensor, dtype: torch.dtype = torch.int8
+    ) -> "QuantizedAdjacency":
+        """
+        int8 values are symmetrically quantized using the maximum magnitude of
+        each relation. Floating point values are simply cast with the scales of 1.
+
+        adj: (batch, num_relations, num_node, num_node)
+        """
+        if dtype.is_floating_point:
+            return cls(adj.to(dtype), adj.new_ones(adj.size()[:2]))
+        assert dtype == torch.int8, "only int8 and floating point types are supported"
+        scales = adj.abs().flatten(start_dim=2).max(dim=2)[0] / 127
+        # (batch, num_relations)
+        # avoid dividing by zero for relations without any edges
+        scales = scales.clamp(min=torch.finfo(adj.dtype).tiny)
+        values = (adj / scales[:, :, None, None]).round().to(dtype)
+        # (batch, num_relations, num_node, num_node)
+        return cls(values, scales)
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        output: (batch, num_relations, num_node, num_node)
+        """
+        return self.values.to(self.scales.dtype) * self.scales[:, :, None, None]
+
+    @property
+    def batch_size(self) -> int:
+        return self.values.size(0)
+
+    @property
+    def num_relations(self) -> int:
+        return self.values.size(1)
+
+    @property
+    def num_nodes(self) -> int:
+        return self.values.size(2)
+
+
+Adjacency = Union[torch.Tensor, SparseAdjacency, QuantizedAdjacency]
+
+
+@dataclass
+class ActiveNodes:
+    """
+    Active nodes of each graph in a batch. Each graph only mentions a small subset of
+    all the nodes, so we can work on the subgraphs of the active nodes, which are
+    padded to the maximum number of active nodes in the batch.
+    """
+
+    # ids of the active nodes, padded with the ids of the inactive nodes, so that
+    # there are no duplicate ids in each graph.
+    # (batch, max_active_node)
+    ids: torch.Tensor
+    # (batch, max_active_node)
+    mask: torch.Tensor
+
+    @classmethod
+    def from_mask(cls, active_node_mask: torch.Tensor) -> "ActiveNodes":
+        """
+        Each graph needs at least one node, so if a graph doesn't have any active
+        nodes, its first node is treated as active.
+
+        active_node_mask: (batch, num_node)
+        """
+        num_node = active_node_mask.size(1)
+        active_node_mask = active_node_mask.bool()
+        num_active_nodes = active_node_mask.sum(dim=1).clamp(min=1)
+        # (batch)
+        max_active_nodes = int(num_active_nodes.max())
+        # sort the active nodes first, then the inactive nodes,
+        # both in the order of their ids
+        node_ids = torch.arange(num_node, device=active_node_mask.device)
+        sort_keys = (~active_node_mask).long() * num_node + node_ids
+        # (batch, num_node)
+        ids = sort_keys.argsort(dim=1)[:, :max_active_nodes]
+        # (batch, max_active_node)
+        mask = (
+            node_ids[:max_active_nodes].unsqueeze(0) < num_active_nodes.unsqueeze(1)
+        ).float()
+        # (batch, max_active_node)
+        return cls(ids, mask)
+
+    def to_mask(self, num_node: int) -> torch.Tensor:
+        """
+        output: (batch, num_node)
+        """
+        active_node_mask = self.mask.new_zeros(self.ids.size(0), num_node)
+        return active_node_mask.scatter(1, self.ids, self.mask)
+
+    def gather_nodes(self, node_features: torch.Tensor) -> torch.Tensor:
+        """
+        node_features: (batch, num_node, ...)
+
+        output: (batch, max_active_node, ...)
+        """
+        batch_ids = torch.arange(self.ids.size(0), device=self.ids.device)
+        return node_features[batch_ids.unsqueeze(1), self.ids]
+
+    def mask_graph(self, subgraph: torch.Tensor) -> torch.Tensor:
+        """
+        Zero out the edges of the padding nodes.
+
+        subgraph: (batch, num_relation, max_active_node, max_active_node)
+
+        output: (batch, num_relation, max_active_node, max_active_node)
+        """
+        return subgraph * self.mask[:, None, :, None] * self.mask[:, None, None, :]
+
+    def gather_graph(self, graph: torch.Tensor) -> torch.Tensor:
+        """
+        graph: (batch, num_relation, num_node, num_node)
+
+        output: (batch, num_relation, max_active_node, max_active_node)
+        """
+        batch_ids = torch.arange(self.ids.size(0), device=self.ids.device)
+        subgraph = graph[
+            batch_ids[:, None, None], :, self.ids[:, :, None], self.ids[:, None, :]
+        ].permute(0, 3, 1, 2)
+        # (batch, num_relation, max_active_node, max_active_node)
+        return self.mask_graph(subgraph)
+
+    def scatter_graph(self, subgraph: torch.Tensor, num_node: int) -> torch.Tensor:
+        """
+        Scatter the subgraphs back to full graphs, where the edges of the inactive
+        nodes are zeros.
+
+        subgraph: (batch, num_relation, max_active_node, max_active_node)
+
+        output: (batch, num_relation, num_node, num_node)
+        """
+        batch_size, num_relation, _, _ = subgraph.size()
+        graph = subgraph.new_zeros(batch_size, num_relation, num_node, num_node)
+        batch_ids = torch.arange(batch_size, device=self.ids.device)
+        graph[
+            batch_ids[:, None, None], :, self.ids[:, :, None], self.ids[:, None, :]
+        ] = self.mask_graph(subgraph).permute(0, 2, 3, 1)
+        return graph
+
+
+@dataclass
+class PackedSequences:
+    """
+    A batch of variable length sequences packed into one sequence without (most of)
+    their paddings, i.e. (total_len, ...). The sequences can still be identified,
+    so that convolutions don't cross sequence boundaries and attention is calculated
+    per sequence.
+    """
+
+    # the original mask, which has to be right padded.
+    # (batch, seq_len)
+    mask: torch.Tensor
+    # indices of the packed positions in the flattened batch
+    # (total_len)
+    index: torch.Tensor
+    # ids of the sequences the packed positions belong to
+    # (total_len)
+    seq_ids: torch.Tensor
+    # positions in the sequences of the packed positions
+    # (total_len)
+    positions: torch.Tensor
+
+    @classmethod
+    def from_mask(
+        cls, mask: torch.Tensor, num_pads: Union[int, torch.Tensor] = 0
+    ) -> "PackedSequences":
+        """
+        mask: (batch, seq_len)
+        num_pads: the number of paddings right after each sequence to keep,
+            if there are that many. Either an int or (batch) for each sequence.
+        """
+        seq_len = mask.size(1)
+        if isinstance(num_pads, torch.Tensor):
+            num_pads = num_pads.unsqueeze(1)
+            # (batch, 1)
+        keep = torch.arange(seq_len, device=mask.device) < (
+            mask.sum(dim=1, keepdim=True) + num_pads
+        )
+        # (batch, seq_len)
+        index = keep.flatten().nonzero(as_tuple=True)[0]
+        return cls(mask, index, index // seq_len, index % seq_len)
+
+    @property
+    def batch_size(self) -> int:
+        return self.mask.size(0)
+
+    @property
+    def seq_len(self) -> int:
+        return self.mask.size(1)
+
+    @property
+    def total_len(self) -> int:
+        return self.index.size(0)
+
+    def pack(self, padded: torch.Tensor) -> torch.Tensor:
+        """
+        padded: (batch, seq_len, ...)
+
+        output: (total_len, ...)
+        """
+        return padded.flatten(end_dim=1)[self.index]
+
+    def unpack(self, packed: torch.Tensor) -> torch.Tensor:
+        """
+        Masked positions are filled with zeros.
+
+        packed: (total_len, ...)
+
+        output: (batch, seq_len, ...)
+        """
+        padded = packed.new_zeros(self.batch_size * self.seq_len, *packed.size()[1:])
+        return padded.index_copy(0, self.index, packed).view(
+            self.batch_size, self.seq_len, *packed.size()[1:]
+        )
+
+    def gapped_index(self, gap: int) -> torch.Tensor:
+        """
+        Indices of the packed positions in a sequence where the packed sequences are
+        separated by gap positions, as well as preceded and followed by them, i.e. of
+        length total_len + (batch + 1) * gap. If the gaps are filled with zeros,
+        a convolution with zero paddings of size gap over this sequence doesn't cross
+        sequence boundaries.
+
+        output: (total_len)
+        """
+        return torch.arange(self.total_len, device=self.index.device) + gap * (
+            self.seq_ids + 1
+        )
+
+
+TextMask = Union[torch.Tensor, PackedSequences]
+
+
+def checkpoint_module(enabled: bool, module: nn.Module, *args: Any) -> Any:
+    """
+    Call module(*args). If enabled, and module is being trained with gradients,
+    the intermediate activations of module are not kept for the backward pass,
+    but recalculated during it, trading computation for memory.
+
+    We use the non-reentrant implementation of activation checkpointing, which
+    supports non-tensor arguments, e.g. SparseAdjacency, and preserves the RNG
+    state for dropout.
+    """
+    if enabled and module.training and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(module, *args, use_reentrant=False)
+    return module(*args)
+
+
 class RelationalGraphConvolution(nn.Module):
     """
     Taken from the original GATA code (https://github.com/xingdi-eric-yuan/GATA-public),
@@ -23,6 +397,7 @@ class RelationalGraphConvolution(nn.Module):
         num_relations: int,
         out_dim: int,
         num_bases: int,
+        basis_first: bool = False,
     ) -> None:
         super().__init__()
         self.node_input_dim = node_input_dim
@@ -30,6 +405,10 @@ class RelationalGraphConvolution(nn.Module):
         self.out_dim = out_dim
         self.num_relations = num_relations
         self.num_bases = num_bases
+        # if True, project the node and relation features into num_bases dims
+        # before aggregating them over the adjacency matrix.
+        # See basis_first_get_supports() for more details.
+        self.basis_first = basis_first
 
         assert self.num_bases > 0
         self.bottleneck_layer = torch.nn.Linear(
@@ -45,16 +424,124 @@ class RelationalGraphConvolution(nn.Module):
         self.bias.data.fill_(0)
         torch.nn.init.xavier_uniform_(self.weight.weight.data)
 
+    def is_forward_half(self, adj_num_relations: int) -> bool:
+        """
+        Adjacency tensors can either have all the relations, or only the forward
+        half of the relations, i.e. (batch, num_relations // 2, num_node, num_node),
+        in which case the reverse relations are calculated from the transposed
+        forward relations without materializing them.
+        """
+        if adj_num_relations == self.num_relations:
+            return False
+        assert (
+            adj_num_relations * 2 == self.num_relations
+        ), "adj has to have either num_relations or num_relations // 2 relations"
+        return True
+
+    def relation_scales(self, adj: QuantizedAdjacency) -> torch.Tensor:
+        """
+        output: (batch, num_relations, 1, 1)
+        """
+        scales = adj.scales[:, :, None, None]
+        if not self.is_forward_half(adj.num_relations):
+            return scales
+        # the reverse relations have the same scales as the forward relations
+        return torch.cat([scales, scales], dim=1)
+
+    def multiply_adj(
+        self, adj: Union[torch.Tensor, QuantizedAdjacency], features: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        adj: (batch, num_relations, num_node, num_node)
+            or (batch, num_relations // 2, num_node, num_node) or QuantizedAdjacency
+        features: (batch, num_relations, num_node, dim)
+            or (num_relations, num_node, dim), which is broadcast over the batch
+
+        output: (batch, num_relations, num_node, dim)
+        """
+        if isinstance(adj, QuantizedAdjacency):
+            # the per-relation scales factor out of the matrix multiplication
+            if adj.values.is_floating_point():
+                supports = self.multiply_adj(adj.values, features.to(adj.values.dtype))
+            else:
+                supports = self.multiply_int_adj(adj.values, features)
+            return supports.to(features.dtype) * self.relation_scales(adj)
+        if not self.is_forward_half(adj.size(1)):
+            return torch.matmul(adj, features)
+        half = self.num_relations // 2
+        return torch.cat(
+            [
+                torch.matmul(adj, features[..., :half, :, :]),
+                torch.matmul(adj.transpose(2, 3), features[..., half:, :, :]),
+            ],
+            dim=1,
+        )
+
+    def multiply_int_adj(
+        self, values: torch.Tensor, features: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Multiply the unscaled integer values of a QuantizedAdjacency. Only one
+        relation is cast to the dtype of the features at a time, so that we don't
+        make a floating point copy of the whole adjacency tensor.
+
+        values: (batch, num_relations, num_node, num_node)
+            or (batch, num_relations // 2, num_node, num_node)
+        features: (batch, num_relations, num_node, dim)
+            or (num_relations, num_node, dim), which is broadcast over the batch
+
+        output: (batch, num_relations, num_node, dim)
+        """
+        forward_half = self.is_forward_half(values.size(1))
+        half = self.num_relations // 2
+        forward_supports: List[torch.Tensor] = []
+        reverse_supports: List[torch.Tensor] = []
+        for i in range(values.size(1)):
+            relation_adj = values[:, i].to(features.dtype)
+            # (batch, num_node, num_node)
+            forward_supports.append(torch.matmul(relation_adj, features[..., i, :, :]))
+            if forward_half:
+                reverse_supports.append(
+                    torch.matmul(
+                        relation_adj.transpose(1, 2), features[..., half + i, :, :]
+                    )
+                )
+        return torch.stack(forward_supports + reverse_supports, dim=1)
+
+    def adj_row_sums(
+        self, adj: Union[torch.Tensor, QuantizedAdjacency]
+    ) -> torch.Tensor:
+        """
+        adj: (batch, num_relations, num_node, num_node)
+            or (batch, num_relations // 2, num_node, num_node) or QuantizedAdjacency
+
+        output: (batch, num_relations, num_node, 1)
+        """
+        if isinstance(adj, QuantizedAdjacency):
+            values = adj.values
+            if values.is_floating_point():
+                # sum the floating point values in float32 for precision
+                values = values.to(adj.scales.dtype)
+            # integer values are summed in int64, so they don't overflow
+            row_sums = self.adj_row_sums(values).to(adj.scales.dtype)
+            return row_sums * self.relation_scales(adj)
+        row_sums = adj.sum(dim=3, keepdim=True)
+        if not self.is_forward_half(adj.size(1)):
+            return row_sums
+        # the row sums of the transposed forward relations are the column sums
+        return torch.cat([row_sums, adj.sum(dim=2).unsqueeze(3)], dim=1)
+
     def optimized_get_supports(
         self,
         node_features: torch.Tensor,
         relation_features: torch.Tensor,
-        adj: torch.Tensor,
+        adj: Union[torch.Tensor, QuantizedAdjacency],
     ) -> torch.Tensor:
         """
         node_features: (batch, num_node, node_input_dim)
         relation_features: (batch, num_relation, relation_input_dim)
         adj: (batch, num_relations, num_node, num_node)
+            or (batch, num_relations // 2, num_node, num_node) or QuantizedAdjacency
 
         output: (batch, num_node, (node_input_dim+relation_input_dim)*num_relations)
         """
@@ -73,7 +560,7 @@ class RelationalGraphConvolution(nn.Module):
             [expanded_n_features, expanded_r_features], dim=-1
         )
         # (batch, num_relation, num_node, node_input_dim + relation_input_dim)
-        supports = torch.matmul(adj, combined_node_features)
+        supports = self.multiply_adj(adj, combined_node_features)
         # (batch, num_relation, num_node, node_input_dim + relation_input_dim)
         return supports.transpose(1, 2).reshape(batch_size, num_node, -1)
         # (batch, num_node, (node_input_dim+relation_input_dim)*num_relations)
@@ -114,22 +601,190 @@ class RelationalGraphConvolution(nn.Module):
         return torch.cat(support_list, dim=-1)
         # (batch, num_node, num_bases)
 
+    def split_bottleneck_weight(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        The input features of the bottleneck layer are laid out as
+        [node features; relation features] for each relation,
+        so split its weights accordingly.
+
+        output: (
+            node weight: (num_bases, num_relation, node_input_dim),
+            relation weight: (num_bases, num_relation, relation_input_dim),
+        )
+        """
+        weight = self.bottleneck_layer.weight.view(
+            self.num_bases,
+            self.num_relations,
+            self.node_input_dim + self.relation_input_dim,
+        )
+        node_weight, relation_weight = weight.split(
+            [self.node_input_dim, self.relation_input_dim], dim=2
+        )
+        return node_weight, relation_weight
+
+    def project_node_features(self, node_features: torch.Tensor) -> torch.Tensor:
+        """
+        Project the node features through the per-relation slices
+        of the bottleneck layer weights.
+
+        node_features: (batch, num_node, node_input_dim) or (num_node, node_input_dim)
+
+        output: (batch, num_relation, num_node, num_bases)
+            or (num_relation, num_node, num_bases)
+        """
+        node_weight, _ = self.split_bottleneck_weight()
+        return torch.einsum("...nd,krd->...rnk", node_features, node_weight)
+
+    def project_relation_features(
+        self, relation_features: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Project the relation features through the per-relation slices
+        of the bottleneck layer weights.
+
+        relation_features: (batch, num_relation, relation_input_dim)
+            or (num_relation, relation_input_dim)
+
+        output: (batch, num_relation, num_bases) or (num_relation, num_bases)
+        """
+        _, relation_weight = self.split_bottleneck_weight()
+        return torch.einsum("...rd,krd->...rk", relation_features, relation_weight)
+
+    def project_features(
+        self, node_features: torch.Tensor, relation_features: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        node_features: (batch, num_node, node_input_dim)
+        relation_features: (batch, num_relation, relation_input_dim)
+
+        output: (
+            projected node features: (batch, num_relation, num_node, num_bases),
+            projected relation features: (batch, num_relation, num_bases),
+        )
+        """
+        return (
+            self.project_node_features(node_features),
+            self.project_relation_features(relation_features),
+        )
+
+    def basis_first_get_supports(
+        self,
+        node_features: torch.Tensor,
+        relation_features: torch.Tensor,
+        adj: Union[torch.Tensor, QuantizedAdjacency],
+        projected_features: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    ) -> torch.Tensor:
+        """
+        node_features: (batch, num_node, node_input_dim)
+        relation_features: (batch, num_relation, relation_input_dim)
+        adj: (batch, num_relations, num_node, num_node)
+            or (batch, num_relations // 2, num_node, num_node) or QuantizedAdjacency
+        projected_features: precomputed project_features(), see forward()
+
+        output: (batch, num_node, num_bases)
+
+        Equivalent to bottleneck_layer(optimized_get_supports(...)), but we never
+        build the concatenated node and relation features. As the bottleneck layer
+        is linear, we can first project the node features and relation features
+        into num_bases dims using the weights for each relation, W_r, then aggregate
+        over the adjacency matrix:
+        sum_r adj_r [X; r] W_r = sum_r adj_r (X W^n_r) + rowsum(adj_r) (r W^r_r)
+        where W^n_r and W^r_r are the node and relation parts of W_r.
+        """
+        if projected_features is None:
+            projected_features = self.project_features(node_features, relation_features)
+        projected_node_features, projected_relation_features = projected_features
+        # projected_node_features: (batch, num_relation, num_node, num_bases)
+        #   or (num_relation, num_node, num_bases)
+        # projected_relation_features: (batch, num_relation, num_bases)
+        #   or (num_relation, num_bases)
+        supports = self.multiply_adj(adj, projected_node_features)
+        # (batch, num_relation, num_node, num_bases)
+        supports += self.adj_row_sums(adj) * projected_relation_features.unsqueeze(-2)
+        # (batch, num_relation, num_node, num_bases)
+        return supports.sum(dim=1)
+        # (batch, num_node, num_bases)
+
+    def sparse_get_supports(
+        self,
+        node_features: torch.Tensor,
+        relation_features: torch.Tensor,
+        adj: SparseAdjacency,
+        projected_features: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    ) -> torch.Tensor:
+        """
+        node_features: (batch, num_node, node_input_dim)
+        relation_features: (batch, num_relation, relation_input_dim)
+        adj: sparse adjacency with either num_relations or num_relations // 2
+            relations
+        projected_features: precomputed project_features(), see forward()
+
+        output: (batch, num_node, num_bases)
+
+        Same as basis_first_get_supports(), but only the messages along the edges
+        of the sparse adjacency are calculated and summed with index_add_().
+        """
+        if self.is_forward_half(adj.num_relations):
+            adj = adj.with_reverse_relations()
+        batch_size, num_node, _ = node_features.size()
+        if projected_features is None:
+            projected_features = self.project_features(node_features, relation_features)
+        projected_node_features, projected_relation_features = projected_features
+        # unbatched projected features are broadcast over the batch
+        projected_node_features = projected_node_features.expand(batch_size, -1, -1, -1)
+        # (batch, num_relation, num_node, num_bases)
+        projected_relation_features = projected_relation_features.expand(
+            batch_size, -1, -1
+        )
+        # (batch, num_relation, num_bases)
+        batch_ids, relation_ids, target_ids, source_ids = adj.indices
+        messages = adj.weights.unsqueeze(1) * (
+            projected_node_features[batch_ids, relation_ids, source_ids]
+            + projected_relation_features[batch_ids, relation_ids]
+        )
+        # (num_edges, num_bases)
+        supports = messages.new_zeros(batch_size * num_node, self.num_bases)
+        supports.index_add_(0, batch_ids * num_node + target_ids, messages)
+        return supports.view(batch_size, num_node, self.num_bases)
+        # (batch, num_node, num_bases)
+
     def forward(
         self,
         node_features: torch.Tensor,
         relation_features: torch.Tensor,
-        adj: torch.Tensor,
+        adj: Adjacency,
+        projected_features: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> torch.Tensor:
         """
         node_features: (batch, num_node, node_input_dim)
         relation_features: (batch, num_relation, relation_input_dim)
         adj: (batch, num_relations, num_node, num_node)
+            or (batch, num_relations // 2, num_node, num_node)
+            or SparseAdjacency or QuantizedAdjacency
+            See is_forward_half() for more details.
+        projected_features: optional precomputed
+            project_features(node_features, relation_features). If the node and
+            relation features are the same for all the batch elements, they can be
+            projected once without the batch dimension, i.e.
+            ((num_relation, num_node, num_bases), (num_relation, num_bases)).
+            If given, the supports are calculated as in basis_first_get_supports().
 
         output: (batch, num_node, out_dim)
         """
-        supports = self.optimized_get_supports(node_features, relation_features, adj)
-        # (batch, num_node, (node_input_dim+relation_input_dim)*num_relations)
-        supports = self.bottleneck_layer(supports)
+        if isinstance(adj, SparseAdjacency):
+            supports = self.sparse_get_supports(
+                node_features, relation_features, adj, projected_features
+            )
+        elif self.basis_first or projected_features is not None:
+            supports = self.basis_first_get_supports(
+                node_features, relation_features, adj, projected_features
+            )
+        else:
+            supports = self.optimized_get_supports(
+                node_features, relation_features, adj
+            )
+            # (batch, num_node, (node_input_dim+relation_input_dim)*num_relations)
+            supports = self.bottleneck_layer(supports)
         # (batch, num_node, num_bases)
         output = self.weight(supports)
         # (batch, num_node, out_dim)
@@ -146,9 +801,15 @@ class RGCNHighwayConnections(RelationalGraphConvolution):
         num_relations: int,
         out_dim: int,
         num_bases: int,
+        basis_first: bool = False,
     ) -> None:
         super().__init__(
-            node_input_dim, relation_input_dim, num_relations, out_dim, num_bases
+            node_input_dim,
+            relation_input_dim,
+            num_relations,
+            out_dim,
+            num_bases,
+            basis_first=basis_first,
         )
         if self.node_input_dim != self.out_dim:
             self.input_linear = nn.Linear(self.node_input_dim, self.out_dim)
@@ -159,12 +820,15 @@ class RGCNHighwayConnections(RelationalGraphConvolution):
         self,
         node_features: torch.Tensor,
         relation_features: torch.Tensor,
-        adj: torch.Tensor,
+        adj: Adjacency,
+        projected_features: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> torch.Tensor:
         """
         node_features: (batch, num_node, node_input_dim)
         relation_features: (batch, num_relation, relation_input_dim)
         adj: (batch, num_relations, num_node, num_node)
+            or SparseAdjacency or QuantizedAdjacency
+        projected_features: see RelationalGraphConvolution.forward()
 
         output: (batch, num_node, out_dim)
         """
@@ -172,7 +836,7 @@ class RGCNHighwayConnections(RelationalGraphConvolution):
             prev = self.input_linear(node_features)
         else:
             prev = node_features
-        x = super().forward(node_features, relation_features, adj)
+        x = super().forward(node_features, relation_features, adj, projected_features)
         gate = self.highway_sigmoid(self.highway(x))
         return gate * x + (1 - gate) * prev
 
@@ -191,6 +855,8 @@ class GraphEncoder(nn.Module):
         num_relations: int,
         hidden_dims: List[int],
         num_bases: int,
+        basis_first: bool = False,
+        gradient_checkpointing: bool = False,
     ):
         super().__init__()
         self.node_input_dim = node_input_dim
@@ -198,6 +864,10 @@ class GraphEncoder(nn.Module):
         self.num_relations = num_relations
         self.hidden_dims = hidden_dims
         self.num_bases = num_bases
+        self.basis_first = basis_first
+        # if True, R-GCN layers are activation checkpointed during training.
+        # See checkpoint_module() for more details.
+        self.gradient_checkpointing = gradient_checkpointing
 
         # cool trick to iterate through a list pairwise
         # https://stackoverflow.com/questions/5434891/iterate-a-list-as-pair-current-next-in-python
@@ -214,6 +884,7 @@ class GraphEncoder(nn.Module):
                 self.num_relations,
                 output_dim,
                 self.num_bases,
+                basis_first=self.basis_first,
             )
             for input_dim, output_dim in dims
         )
@@ -222,21 +893,136 @@ class GraphEncoder(nn.Module):
         self,
         node_features: torch.Tensor,
         relation_features: torch.Tensor,
-        adj: torch.Tensor,
+        adj: Adjacency,
+        first_layer_projected_features: Optional[
+            Tuple[torch.Tensor, torch.Tensor]
+        ] = None,
     ) -> torch.Tensor:
         """
         node features: (batch, num_node, node_input_dim)
         relation features: (batch, num_relations, relation_input_dim)
         adjacency matrix: (batch, num_relations, num_node, num_node)
+            or (batch, num_relations // 2, num_node, num_node)
+            or SparseAdjacency or QuantizedAdjacency
+        first_layer_projected_features: optional precomputed projected features for
+            the first R-GCN layer, see RelationalGraphConvolution.forward()
 
         output: (batch, num_node, hidden_dims[-1])
         """
         x = node_features
-        for rgcn in self.rgcns:
-            x = rgcn(x, relation_features, adj)
+        for i, rgcn in enumerate(self.rgcns):
+            x = checkpoint_module(
+                self.gradient_checkpointing,
+                rgcn,
+                x,
+                relation_features,
+                adj,
+                first_layer_projected_features if i == 0 else None,
+            )
         return x
 
 
+class FactorizedGraphDecoder(nn.Module):
+    """
+    A low-rank alternative to the dense graph decoder of GraphUpdater, whose last
+    linear layer has num_relations * num_node * num_node outputs and grows
+    quadratically with the number of nodes.
+
+    The RNN hidden state is decoded into node embeddings U of rank rank and
+    relation matrices R_r, which are diagonal if relation_rank is None, or
+    low-rank, R_r = P_r Q_r^T, of rank relation_rank. Then the edges are scored as
+    adj[r, i, j] = tanh(U_i R_r U_j^T + bias_r).
+    """
+
+    def __init__(
+        self,
+        hidden_dim: int,
+        num_relations: int,
+        num_nodes: int,
+        rank: int,
+        relation_rank: Optional[int] = None,
+    ) -> None:
+        super().__init__()
+        self.num_relations = num_relations
+        self.num_nodes = num_nodes
+        self.rank = rank
+        self.relation_rank = relation_rank
+
+        self.hidden_layers = nn.Sequential(nn.Linear(hidden_dim, hidden_dim), nn.ReLU())
+        self.node_prj = nn.Linear(hidden_dim, num_nodes * rank)
+        self.relation_prj = nn.Linear(
+            hidden_dim,
+            num_relations * rank
+            if relation_rank is None
+            else num_relations * 2 * rank * relation_rank,
+        )
+        self.bias = nn.Parameter(torch.zeros(num_relations))
+
+    def forward(
+        self, rnn_hidden: torch.Tensor, node_ids: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        rnn_hidden: (batch, hidden_dim)
+        node_ids: (batch, num_node'), if given, only decode the edges between
+            these nodes, e.g. ActiveNodes.ids
+
+        output: (batch, num_relations, num_node, num_node)
+            or (batch, num_relations, num_node', num_node') if node_ids is given
+        """
+        batch_size = rnn_hidden.size(0)
+        h = self.hidden_layers(rnn_hidden)
+        # (batch, hidden_dim)
+        node_embs = self.node_prj(h).view(batch_size, self.num_nodes, self.rank)
+        # (batch, num_node, rank)
+        if node_ids is not None:
+            node_embs = node_embs.gather(
+                1, node_ids.unsqueeze(-1).expand(-1, -1, self.rank)
+            )
+            # (batch, num_node', rank)
+        node_embs = node_embs.unsqueeze(1)
+        # (batch, 1, num_node, rank)
+        if self.relation_rank is None:
+            diagonals = self.relation_prj(h).view(
+                batch_size, self.num_relations, 1, self.rank
+            )
+            # (batch, num_relations, 1, rank)
+            left = node_embs * diagonals
+            # (batch, num_relations, num_node, rank)
+            right = node_embs
+            # (batch, 1, num_node, rank)
+        else:
+            factors = self.relation_prj(h).view(
+                batch_size, self.num_relations, 2, self.rank, self.relation_rank
+            )
+            # (batch, num_relations, 2, rank, relation_rank)
+            left = torch.matmul(node_embs, factors[:, :, 0])
+            # (batch, num_relations, num_node, relation_rank)
+            right = torch.matmul(node_embs, factors[:, :, 1])
+            # (batch, num_relations, num_node, relation_rank)
+        return torch.tanh(
+            torch.matmul(left, right.transpose(2, 3)) + self.bias[:, None, None]
+        )
+        # (batch, num_relations, num_node, num_node)
+
+    def sparse_topk(
+        self,
+        rnn_hidden: torch.Tensor,
+        k: int,
+        node_ids: Optional[torch.Tensor] = None,
+    ) -> SparseAdjacency:
+        """
+        Same as forward(), but only keep the k edges with the largest magnitudes
+        of each relation of each graph.
+
+        rnn_hidden: (batch, hidden_dim)
+        node_ids: (batch, num_node'), see forward()
+
+        output: SparseAdjacency of (batch, num_relations, num_node, num_node)
+            or (batch, num_relations, num_node', num_node') if node_ids is given
+        """
+        return SparseAdjacency.from_dense_topk(self(rnn_hidden, node_ids=node_ids), k)
+
+
 class DepthwiseSeparableConv1d(nn.Module):
     """
     Depthwise, separable 1d convolution to save computation in exchange for
@@ -273,7 +1059,9 @@ class TextEncoderConvBlock(nn.Module):
     with a residual connection.
     """
 
-    def __init__(self, channels: int, kernel_size: int) -> None:
+    def __init__(
+        self, channels: int, kernel_size: int, channels_last: bool = False
+    ) -> None:
         super().__init__()
         assert (
             kernel_size % 2 == 1
@@ -281,16 +1069,67 @@ class TextEncoderConvBlock(nn.Module):
         self.layer_norm = nn.LayerNorm(channels)
         self.relu = nn.ReLU()
         self.conv = DepthwiseSeparableConv1d(channels, channels, kernel_size)
+        # if True, use channels_last_forward(). See it for more details.
+        self.channels_last = channels_last
 
-    def forward(self, input: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self, input: torch.Tensor, gap_mask: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
         """
         input: (batch, seq_len, channels)
-        output: (batch, seq_len, channels)
+        gap_mask: if given, input is the packed sequences separated by gaps,
+            (gapped_len, channels), and gap_mask is 0 for the gaps, (gapped_len, 1)
+            See PackedSequences.gapped_index() for more details.
+
+        output: (batch, seq_len, channels) or (gapped_len, channels)
         """
+        if self.channels_last:
+            return self.channels_last_forward(input, gap_mask=gap_mask)
         residual = input
         output = self.layer_norm(input)
-        output = self.relu(self.conv(output.transpose(1, 2))).transpose(1, 2)
-        return output + residual
+        if gap_mask is None:
+            output = self.relu(self.conv(output.transpose(1, 2))).transpose(1, 2)
+            return output + residual
+
+        # zero out the gaps, which act as the zero paddings of the convolution
+        # for each sequence, and convolve them all at once.
+        output = self.conv((output * gap_mask).t().unsqueeze(0)).squeeze(0).t()
+        return self.relu(output) + residual
+
+    def channels_last_forward(
+        self, input: torch.Tensor, gap_mask: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        Same as forward(), but the input stays in the channels-last layout,
+        (..., seq_len, channels). Only the depthwise convolution sees a transposed
+        view of it, and the pointwise convolution is calculated as a linear layer,
+        which is much faster than a convolution with kernel size 1.
+        The parameters are the same as forward(), so are the checkpoints.
+
+        input: (batch, seq_len, channels) or (gapped_len, channels)
+        gap_mask: see forward()
+
+        output: (batch, seq_len, channels) or (gapped_len, channels)
+        """
+        output = self.layer_norm(input)
+        if gap_mask is not None:
+            # zero out the gaps, see forward()
+            output = output * gap_mask
+        conv_input = output.transpose(-1, -2)
+        if conv_input.dim() == 2:
+            # older versions of PyTorch don't support unbatched inputs
+            conv_input = conv_input.unsqueeze(0)
+        output = (
+            self.conv.depthwise_conv(conv_input).transpose(-1, -2).reshape(input.size())
+        )
+        # (..., seq_len, channels)
+        output = F.linear(
+            output,
+            self.conv.pointwise_conv.weight.squeeze(-1),
+            self.conv.pointwise_conv.bias,
+        )
+        # (..., seq_len, channels)
+        return self.relu(output) + input
 
 
 class PositionalEncoder(nn.Module):
@@ -318,12 +1157,65 @@ class PositionalEncoder(nn.Module):
         return input + self.pe[: input.size(1), :]  # type: ignore
 
 
-class PositionalEncoderTensor2Tensor(nn.Module):
+# process-wide cache of the tensor2tensor positional encodings shared by all
+# PositionalEncoderTensor2Tensor's, see get_tensor2tensor_positional_encodings()
+tensor2tensor_positional_encodings: Dict[
+    Tuple[int, float, float, torch.dtype, torch.device], torch.Tensor
+] = {}
+
+
+def calculate_tensor2tensor_positional_encodings(
+    channels: int, max_len: int, min_timescale: float, max_timescale: float
+) -> torch.Tensor:
     """
-    Add positional encodings to the given input. This is the tensor2tensor
-    implementation of the positional encoding, which is slightly different
-    from the one used by the original Transformer paper.
-    Specifically, there are 2 key differences:
+    output: (max_len, channels)
+    """
+    position = torch.arange(max_len).float().unsqueeze(1)
+    num_timescales = channels // 2
+    log_timescale_increment = math.log(max_timescale / min_timescale) / (
+        num_timescales - 1
+    )
+    inv_timescales = min_timescale * torch.exp(
+        torch.arange(num_timescales).float() * -log_timescale_increment
+    ).unsqueeze(0)
+    scaled_time = position * inv_timescales
+    return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1).view(
+        max_len, channels
+    )
+
+
+def get_tensor2tensor_positional_encodings(
+    channels: int,
+    min_len: int,
+    dtype: torch.dtype,
+    device: torch.device,
+    min_timescale: float = 1.0,
+    max_timescale: float = 1e4,
+) -> torch.Tensor:
+    """
+    Return the cached positional encodings for at least min_len positions.
+    If the cached ones are too short, they're recalculated for the next power of 2
+    positions, so the cache only grows a few times.
+
+    output: (max_len, channels), where max_len >= min_len
+    """
+    key = (channels, min_timescale, max_timescale, dtype, device)
+    pe = tensor2tensor_positional_encodings.get(key)
+    if pe is None or pe.size(0) < min_len:
+        max_len = 1 << max(min_len - 1, 1).bit_length()
+        pe = calculate_tensor2tensor_positional_encodings(
+            channels, max_len, min_timescale, max_timescale
+        ).to(dtype=dtype, device=device)
+        tensor2tensor_positional_encodings[key] = pe
+    return pe
+
+
+class PositionalEncoderTensor2Tensor(nn.Module):
+    """
+    Add positional encodings to the given input. This is the tensor2tensor
+    implementation of the positional encoding, which is slightly different
+    from the one used by the original Transformer paper.
+    Specifically, there are 2 key differences:
     1. Sine and cosine values are concatenated rather than interweaved.
     2. The divisor is calculated differently
         ((d_model (or channels) // 2) -1 vs. d_model)
@@ -334,6 +1226,11 @@ class PositionalEncoderTensor2Tensor(nn.Module):
     including a small optimization that caches all the positional encodings, which
     was shown in the PyTorch Transformer tutorial
     (https://pytorch.org/tutorials/beginner/transformer_tutorial.html)
+
+    The positional encodings are not buffers, but cached in a process-wide cache
+    shared by all the positional encoders, and grow on demand,
+    so max_len is only the minimum number of positions to calculate.
+    See get_tensor2tensor_positional_encodings().
     """
 
     def __init__(
@@ -344,27 +1241,210 @@ class PositionalEncoderTensor2Tensor(nn.Module):
         max_timescale: float = 1e4,
     ) -> None:
         super().__init__()
-        position = torch.arange(max_len).float().unsqueeze(1)
-        num_timescales = channels // 2
-        log_timescale_increment = math.log(max_timescale / min_timescale) / (
-            num_timescales - 1
-        )
-        inv_timescales = min_timescale * torch.exp(
-            torch.arange(num_timescales).float() * -log_timescale_increment
-        ).unsqueeze(0)
-        scaled_time = position * inv_timescales
-        pe = torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1).view(
-            max_len, channels
+        self.channels = channels
+        self.max_len = max_len
+        self.min_timescale = min_timescale
+        self.max_timescale = max_timescale
+        # old checkpoints have the positional encodings as buffers
+        self._register_load_state_dict_pre_hook(self.drop_pe_buffer)
+
+    @staticmethod
+    def drop_pe_buffer(
+        state_dict: Dict[str, Any], prefix: str, *args: Any, **kwargs: Any
+    ) -> None:
+        state_dict.pop(prefix + "pe", None)
+
+    def get_pe(
+        self, min_len: int, dtype: torch.dtype, device: torch.device
+    ) -> torch.Tensor:
+        """
+        output: (len, channels), where len >= max(min_len, self.max_len)
+        """
+        return get_tensor2tensor_positional_encodings(
+            self.channels,
+            max(min_len, self.max_len),
+            dtype,
+            device,
+            min_timescale=self.min_timescale,
+            max_timescale=self.max_timescale,
         )
-        self.register_buffer("pe", pe)
 
-    def forward(self, input: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        input: torch.Tensor,
+        positions: Optional[torch.Tensor] = None,
+        seq_len: Optional[int] = None,
+    ) -> torch.Tensor:
         """
         input: (batch, seq_len, channels)
+        positions: if given, the positions of the packed input, (total_len)
+            See PackedSequences for more details.
+        seq_len: the length of the longest packed sequence. If not given, it's
+            calculated from positions, which syncs with the device.
         output: (batch, seq_len, channels)
+            or (total_len, channels) if positions is given.
         """
+        if positions is not None:
+            if seq_len is None:
+                seq_len = int(positions.max()) + 1
+            return input + self.get_pe(seq_len, input.dtype, input.device)[positions]
         # add positional encodings to the input using broadcast
-        return input + self.pe[: input.size(1)]  # type: ignore
+        seq_len = input.size(1)
+        return input + self.get_pe(seq_len, input.dtype, input.device)[:seq_len]
+
+
+class MaskedMultiheadAttention(nn.Module):
+    """
+    Multihead attention based on F.scaled_dot_product_attention. It has the same
+    parameters as nn.MultiheadAttention, so their checkpoints are interchangeable,
+    but it takes batch first inputs and explicit masks.
+
+    Unlike nn.MultiheadAttention, queries that can't attend to any keys, e.g.
+    the queries of fully masked sequences, output zeros instead of nan's.
+    https://github.com/pytorch/pytorch/issues/41508
+    """
+
+    def __init__(self, embed_dim: int, num_heads: int, dropout: float = 0.0) -> None:
+        super().__init__()
+        assert embed_dim % num_heads == 0, "embed_dim has to be divisible by num_heads"
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+        # same initialization as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def split_heads(self, input: torch.Tensor) -> torch.Tensor:
+        """
+        input: (batch, seq_len, embed_dim)
+
+        output: (batch, num_heads, seq_len, embed_dim // num_heads)
+        """
+        batch_size, seq_len, _ = input.size()
+        return input.view(batch_size, seq_len, self.num_heads, -1).transpose(1, 2)
+
+    def project_query(self, query: torch.Tensor) -> torch.Tensor:
+        """
+        query: (batch, query_len, embed_dim)
+
+        output: (batch, query_len, embed_dim)
+        """
+        return F.linear(
+            query,
+            self.in_proj_weight[: self.embed_dim],
+            self.in_proj_bias[: self.embed_dim],
+        )
+
+    def project_key_value(
+        self, key: torch.Tensor, value: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Project the keys and values, e.g. to cache them for incremental decoding.
+
+        key: (batch, key_len, embed_dim)
+        value: (batch, key_len, embed_dim)
+
+        output: (
+            projected key: (batch, key_len, embed_dim),
+            projected value: (batch, key_len, embed_dim),
+        )
+        """
+        if key is value:
+            k, v = F.linear(
+                key,
+                self.in_proj_weight[self.embed_dim :],
+                self.in_proj_bias[self.embed_dim :],
+            ).chunk(2, dim=-1)
+            return k, v
+        w_k, w_v = self.in_proj_weight[self.embed_dim :].chunk(2)
+        b_k, b_v = self.in_proj_bias[self.embed_dim :].chunk(2)
+        return F.linear(key, w_k, b_k), F.linear(value, w_v, b_v)
+
+    def forward(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        key_mask: Optional[torch.Tensor] = None,
+        causal: bool = False,
+    ) -> torch.Tensor:
+        """
+        query: (batch, query_len, embed_dim)
+        key: (batch, key_len, embed_dim)
+        value: (batch, key_len, embed_dim)
+        key_mask: 0 for the keys that should be ignored, (batch, key_len)
+        causal: if True, the i'th query doesn't attend to the keys after
+            the (key_len - query_len + i)'th key, i.e. the queries are the last
+            query_len positions of the keys.
+
+        output: (batch, query_len, embed_dim)
+        """
+        # project the query, key and value at once if possible
+        if query is key and key is value:
+            q, k, v = F.linear(query, self.in_proj_weight, self.in_proj_bias).chunk(
+                3, dim=-1
+            )
+        else:
+            q = self.project_query(query)
+            k, v = self.project_key_value(key, value)
+        # (batch, len, embed_dim)
+        return self.attend(q, k, v, key_mask=key_mask, causal=causal)
+
+    def attend(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        key_mask: Optional[torch.Tensor] = None,
+        causal: bool = False,
+    ) -> torch.Tensor:
+        """
+        Attend to the projected keys and values with the projected queries.
+        See forward() for the masks.
+
+        q: (batch, query_len, embed_dim)
+        k: (batch, key_len, embed_dim)
+        v: (batch, key_len, embed_dim)
+        key_mask: (batch, key_len)
+
+        output: (batch, query_len, embed_dim)
+        """
+        attn_mask: Optional[torch.Tensor] = None
+        if key_mask is not None:
+            attn_mask = key_mask.bool()[:, None, None, :]
+            # (batch, 1, 1, key_len)
+        if causal:
+            query_len = q.size(1)
+            key_len = k.size(1)
+            causal_mask = torch.ones(
+                query_len, key_len, dtype=torch.bool, device=q.device
+            ).tril(diagonal=key_len - query_len)
+            # (query_len, key_len)
+            attn_mask = causal_mask if attn_mask is None else attn_mask & causal_mask
+        empty_query_mask: Optional[torch.Tensor] = None
+        if attn_mask is not None:
+            # let the queries that can't attend to any keys attend to all of them
+            # so that softmax doesn't return nan's, then zero them out.
+            empty_query_mask = attn_mask.logical_not().all(dim=-1, keepdim=True)
+            # (batch or 1, 1, query_len or 1, 1)
+            attn_mask = attn_mask | empty_query_mask
+
+        output = F.scaled_dot_product_attention(
+            self.split_heads(q),
+            self.split_heads(k),
+            self.split_heads(v),
+            attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+        )
+        # (batch, num_heads, query_len, embed_dim // num_heads)
+        output = self.out_proj(output.transpose(1, 2).flatten(start_dim=2))
+        # (batch, query_len, embed_dim)
+        if empty_query_mask is not None:
+            output = output.masked_fill(empty_query_mask.squeeze(1), 0)
+        return output
 
 
 class TextEncoderBlock(nn.Module):
@@ -378,18 +1458,21 @@ class TextEncoderBlock(nn.Module):
         kernel_size: int,
         hidden_dim: int,
         num_heads: int,
+        channels_last: bool = False,
     ) -> None:
         super().__init__()
         assert hidden_dim % 2 == 0, "hidden_dim has to be even for positional encoding"
         self.pos_encoder = PositionalEncoderTensor2Tensor(hidden_dim, 512)
         self.conv_layers = nn.Sequential(
             *[
-                TextEncoderConvBlock(hidden_dim, kernel_size)
+                TextEncoderConvBlock(
+                    hidden_dim, kernel_size, channels_last=channels_last
+                )
                 for _ in range(num_conv_layers)
             ]
         )
         self.self_attn_layer_norm = nn.LayerNorm(hidden_dim)
-        self.self_attn = nn.MultiheadAttention(hidden_dim, num_heads)
+        self.self_attn = MaskedMultiheadAttention(hidden_dim, num_heads)
         self.linear_layer_norm = nn.LayerNorm(hidden_dim)
         self.linear_layers = nn.Sequential(
             nn.Linear(hidden_dim, hidden_dim),
@@ -397,13 +1480,18 @@ class TextEncoderBlock(nn.Module):
             nn.Linear(hidden_dim, hidden_dim),
         )
 
-    def forward(self, input: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    def forward(self, input: torch.Tensor, mask: TextMask) -> torch.Tensor:
         """
         input: (batch, seq_len, hidden_dim)
-        mask: (batch, seq_len)
+            or (total_len, hidden_dim) if mask is PackedSequences
+        mask: (batch, seq_len) or PackedSequences
 
         output: (batch, seq_len, hidden_dim)
+            or (total_len, hidden_dim) if mask is PackedSequences
         """
+        if isinstance(mask, PackedSequences):
+            return self.packed_forward(input, mask)
+
         # add the positional encodings
         output = self.pos_encoder(input)
 
@@ -412,14 +1500,68 @@ class TextEncoderBlock(nn.Module):
 
         # self attention layer
         residual = output
-        # MultiheadAttention expects batch dim to be 1 for q, k, v
-        # but 0 for key_padding_mask, so we need to transpose
-        output = output.transpose(0, 1)
         output = self.self_attn_layer_norm(output)
-        output, _ = self.self_attn(output, output, output, key_padding_mask=mask == 0)
-        output = output.transpose(0, 1)
+        output = self.self_attn(output, output, output, key_mask=mask)
+        output += residual
+
+        # linear layer
+        residual = output
+        output = self.linear_layer_norm(output)
+        output = self.linear_layers(output)
         output += residual
 
+        return output
+
+    def packed_forward(
+        self, input: torch.Tensor, packed: PackedSequences
+    ) -> torch.Tensor:
+        """
+        Same as forward(), but the positional encodings, convolutions and linear
+        layers skip the paddings that are not packed. Paddings leak into the
+        unmasked positions through the convolutions, so the first
+        TextEncoder.num_leaking_pads paddings of each sequence need to be packed
+        for the unmasked outputs to be the same as forward().
+
+        Self attention is calculated over the padded sequences with key padding masks,
+        b/c block diagonal attention over the packed sequence grows quadratically
+        with total_len instead.
+
+        input: (total_len, hidden_dim)
+        packed: PackedSequences
+
+        output: (total_len, hidden_dim)
+        """
+        # add the positional encodings
+        output = self.pos_encoder(
+            input, positions=packed.positions, seq_len=packed.seq_len
+        )
+
+        # conv layers over the packed sequences separated by gaps
+        gap = max(
+            conv_layer.conv.depthwise_conv.padding[0] for conv_layer in self.conv_layers
+        )
+        gapped_index = packed.gapped_index(gap)
+        # (total_len)
+        gapped_len = packed.total_len + (packed.batch_size + 1) * gap
+        gap_mask = output.new_zeros(gapped_len, 1).index_fill(0, gapped_index, 1)
+        # (gapped_len, 1)
+        output = output.new_zeros(gapped_len, output.size(1)).index_copy(
+            0, gapped_index, output
+        )
+        # (gapped_len, hidden_dim)
+        for conv_layer in self.conv_layers:
+            output = conv_layer(output, gap_mask=gap_mask)
+        output = output[gapped_index]
+        # (total_len, hidden_dim)
+
+        # self attention layer
+        residual = output
+        output = packed.unpack(self.self_attn_layer_norm(output))
+        # (batch, seq_len, hidden_dim)
+        output = self.self_attn(output, output, output, key_mask=packed.mask)
+        output = packed.pack(output) + residual
+        # (total_len, hidden_dim)
+
         # linear layer
         residual = output
         output = self.linear_layer_norm(output)
@@ -437,31 +1579,51 @@ class TextEncoder(nn.Module):
         enc_block_kernel_size: int,
         enc_block_hidden_dim: int,
         enc_block_num_heads: int,
+        gradient_checkpointing: bool = False,
+        channels_last: bool = False,
     ) -> None:
         super().__init__()
+        # if True, encoder blocks are activation checkpointed during training.
+        # See checkpoint_module() for more details.
+        self.gradient_checkpointing = gradient_checkpointing
         self.enc_blocks = nn.ModuleList(
             TextEncoderBlock(
                 enc_block_num_conv_layers,
                 enc_block_kernel_size,
                 enc_block_hidden_dim,
                 enc_block_num_heads,
+                channels_last=channels_last,
             )
             for _ in range(num_enc_blocks)
         )
 
-    def forward(
-        self, input_word_embs: torch.Tensor, mask: torch.Tensor
-    ) -> torch.Tensor:
+    @property
+    def num_leaking_pads(self) -> int:
+        """
+        The number of paddings right after each sequence that can affect
+        the unmasked outputs, i.e. the receptive field of the convolutions.
+        """
+        return sum(
+            conv_layer.conv.depthwise_conv.padding[0]
+            for enc_block in self.enc_blocks
+            for conv_layer in enc_block.conv_layers
+        )
+
+    def forward(self, input_word_embs: torch.Tensor, mask: TextMask) -> torch.Tensor:
         """
         input_word_embs: (batch_size, seq_len, enc_block_hidden_dim)
-        mask: (batch_size, seq_len)
+            or (total_len, enc_block_hidden_dim) if mask is PackedSequences
+        mask: (batch_size, seq_len) or PackedSequences
         output:
             encoded: (batch_size, seq_len, enc_block_hidden_dim)
+                or (total_len, enc_block_hidden_dim) if mask is PackedSequences
         """
         output = input_word_embs
         # (batch_size, seq_len, enc_block_hidden_dim)
         for enc_block in self.enc_blocks:
-            output = enc_block(output, mask)
+            output = checkpoint_module(
+                self.gradient_checkpointing, enc_block, output, mask
+            )
         # (batch_size, seq_len, enc_block_hidden_dim)
 
         return output
@@ -489,6 +1651,14 @@ class ContextQueryAttention(nn.Module):
         torch.nn.init.constant_(bias, 0)
         self.bias = torch.nn.Parameter(bias)
 
+        # the evaluation order of Q = s_query @ s_ctx^T @ ctx
+        # "left": (s_query @ s_ctx^T) @ ctx,
+        #   O(ctx_seq_len^2 * (query_seq_len + hidden_dim))
+        # "right": s_query @ (s_ctx^T @ ctx),
+        #   O(ctx_seq_len * query_seq_len * hidden_dim)
+        # "auto": the cheaper one for the given shapes
+        self.ctx_to_query_order = "auto"
+
     def forward(
         self,
         ctx: torch.Tensor,
@@ -502,13 +1672,59 @@ class ContextQueryAttention(nn.Module):
         ctx_mask: (batch, ctx_seq_len)
         query_mask: (batch, query_seq_len)
 
+        output: (batch, ctx_seq_len, 4 * hidden_dim)
+        """
+        # (batch, ctx_seq_len, query_seq_len)
+        similarity = self.trilinear_for_attention(ctx, query)
+        return self.attend(similarity, ctx, query, ctx_mask, query_mask)
+
+    def bidirectional_forward(
+        self,
+        ctx: torch.Tensor,
+        query: torch.Tensor,
+        ctx_mask: torch.Tensor,
+        query_mask: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Same as (forward(ctx, query, ...), forward(query, ctx, ...)), but the
+        similarity matrices of both directions are calculated in one pass.
+
+        ctx: (batch, ctx_seq_len, hidden_dim)
+        query: (batch, query_seq_len, hidden_dim)
+        ctx_mask: (batch, ctx_seq_len)
+        query_mask: (batch, query_seq_len)
+
+        output: (batch, ctx_seq_len, 4 * hidden_dim),
+            (batch, query_seq_len, 4 * hidden_dim)
+        """
+        similarity, reverse_similarity = self.bidirectional_trilinear_for_attention(
+            ctx, query
+        )
+        return (
+            self.attend(similarity, ctx, query, ctx_mask, query_mask),
+            self.attend(reverse_similarity, query, ctx, query_mask, ctx_mask),
+        )
+
+    def attend(
+        self,
+        similarity: torch.Tensor,
+        ctx: torch.Tensor,
+        query: torch.Tensor,
+        ctx_mask: torch.Tensor,
+        query_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        similarity: (batch, ctx_seq_len, query_seq_len)
+        ctx: (batch, ctx_seq_len, hidden_dim)
+        query: (batch, query_seq_len, hidden_dim)
+        ctx_mask: (batch, ctx_seq_len)
+        query_mask: (batch, query_seq_len)
+
         output: (batch, ctx_seq_len, 4 * hidden_dim)
         """
         ctx_seq_len = ctx.size(1)
         query_seq_len = query.size(1)
 
-        # (batch, ctx_seq_len, query_seq_len)
-        similarity = self.trilinear_for_attention(ctx, query)
         # (batch, ctx_seq_len, query_seq_len)
         s_ctx = masked_softmax(
             similarity, ctx_mask.unsqueeze(2).expand(-1, -1, query_seq_len), dim=1
@@ -520,11 +1736,39 @@ class ContextQueryAttention(nn.Module):
         # (batch, ctx_seq_len, hidden_dim)
         P = torch.bmm(s_query, query)
         # (batch, ctx_seq_len, hidden_dim)
-        Q = torch.bmm(torch.bmm(s_query, s_ctx.transpose(1, 2)), ctx)
+        Q = self.ctx_to_query(s_query, s_ctx, ctx)
 
         # (batch, ctx_seq_len, 4 * hidden_dim)
         return torch.cat([ctx, P, ctx * P, ctx * Q], dim=2)
 
+    def ctx_to_query(
+        self, s_query: torch.Tensor, s_ctx: torch.Tensor, ctx: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Calculate s_query @ s_ctx^T @ ctx in the order given by
+        self.ctx_to_query_order.
+
+        s_query: (batch, ctx_seq_len, query_seq_len)
+        s_ctx: (batch, ctx_seq_len, query_seq_len)
+        ctx: (batch, ctx_seq_len, hidden_dim)
+
+        output: (batch, ctx_seq_len, hidden_dim)
+        """
+        order = self.ctx_to_query_order
+        if order == "auto":
+            _, ctx_seq_len, query_seq_len = s_query.size()
+            hidden_dim = ctx.size(2)
+            # compare the number of multiplications of the two orders
+            left_cost = ctx_seq_len * ctx_seq_len * (query_seq_len + hidden_dim)
+            right_cost = 2 * ctx_seq_len * query_seq_len * hidden_dim
+            order = "left" if left_cost <= right_cost else "right"
+        if order == "left":
+            # (batch, ctx_seq_len, ctx_seq_len) @ (batch, ctx_seq_len, hidden_dim)
+            return torch.bmm(torch.bmm(s_query, s_ctx.transpose(1, 2)), ctx)
+        assert order == "right", f"unknown ctx_to_query_order: {order}"
+        # (batch, ctx_seq_len, query_seq_len) @ (batch, query_seq_len, hidden_dim)
+        return torch.bmm(s_query, torch.bmm(s_ctx.transpose(1, 2), ctx))
+
     def trilinear_for_attention(
         self, ctx: torch.Tensor, query: torch.Tensor
     ) -> torch.Tensor:
@@ -562,6 +1806,35 @@ class ContextQueryAttention(nn.Module):
 
         return res_C + res_Q.transpose(1, 2) + res_CQ + self.bias
 
+    def bidirectional_trilinear_for_attention(
+        self, ctx: torch.Tensor, query: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        ctx: (batch, ctx_seq_len, hidden_dim), context C
+        query: (batch, query_seq_len, hidden_dim), query Q
+        output: (batch, ctx_seq_len, query_seq_len), similarity matrix S of C and Q
+            (batch, query_seq_len, ctx_seq_len), similarity matrix S' of Q and C
+
+        S and S' are not transposes of each other as w_C and w_Q switch places,
+        S'_ji = w_C Q_j + w_Q C_i + w_{C * Q} C_i Q_j,
+        but the expensive C * Q term is shared, so we calculate it once for both.
+        """
+        # (hidden_dim, 2)
+        w = torch.cat([self.w_C, self.w_Q], dim=1)
+        # (batch, ctx_seq_len, 2)
+        res_ctx = torch.matmul(ctx, w)
+        # (batch, 1, query_seq_len, 2)
+        res_query = torch.matmul(query, w).unsqueeze(1)
+        # (batch, ctx_seq_len, query_seq_len)
+        res_CQ = torch.matmul(self.w_CQ.squeeze() * ctx, query.transpose(1, 2))
+
+        # (batch, ctx_seq_len, query_seq_len)
+        similarity = res_ctx[:, :, :1] + res_query[..., 1] + res_CQ + self.bias
+        # (batch, ctx_seq_len, query_seq_len)
+        reverse_similarity = res_ctx[:, :, 1:] + res_query[..., 0] + res_CQ + self.bias
+
+        return similarity, reverse_similarity.transpose(1, 2)
+
 
 class ReprAggregator(nn.Module):
     def __init__(self, hidden_dim: int) -> None:
@@ -584,16 +1857,95 @@ class ReprAggregator(nn.Module):
 
         output: (batch, repr1_seq_len, hidden_dim), (batch, repr2_seq_len, hidden_dim)
         """
-        return (
-            self.prj(self.cqattn(repr1, repr2, repr1_mask, repr2_mask)),
-            self.prj(self.cqattn(repr2, repr1, repr2_mask, repr1_mask)),
+        repr12, repr21 = self.cqattn.bidirectional_forward(
+            repr1, repr2, repr1_mask, repr2_mask
         )
+        return self.prj(repr12), self.prj(repr21)
+
+    def aggregate(
+        self,
+        repr1: torch.Tensor,
+        repr2: torch.Tensor,
+        repr1_mask: torch.Tensor,
+        repr2_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Only aggregate repr1 with repr2, i.e. forward(...)[0], without calculating
+        the other direction.
+
+        repr1: (batch, repr1_seq_len, hidden_dim)
+        repr2: (batch, repr2_seq_len, hidden_dim)
+        repr1_mask: (batch, repr1_seq_len)
+        repr2_mask: (batch, repr2_seq_len)
+
+        output: (batch, repr1_seq_len, hidden_dim)
+        """
+        return self.prj(self.cqattn(repr1, repr2, repr1_mask, repr2_mask))
+
+
+class TextEncodingCache:
+    """
+    A bounded LRU cache of the encodings of sequences. The size of the cache is
+    the total number of bytes of the cached encodings, and the least recently used
+    encodings are evicted to keep it under max_bytes.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # the storages and version counters of the weights of the encoder
+        self.weight_key: Optional[Tuple[Tuple[int, int], ...]] = None
+
+    def validate(self, weight_key: Tuple[Tuple[int, int], ...]) -> None:
+        """
+        Clear the cache if the weights of the encoder have been updated in-place
+        or moved since the encodings were cached.
+        """
+        if weight_key != self.weight_key:
+            self.clear()
+            self.weight_key = weight_key
+
+    def get(self, key: Hashable) -> Optional[torch.Tensor]:
+        encoding = self.entries.get(key)
+        if encoding is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return encoding
+
+    def put(self, key: Hashable, encoding: torch.Tensor) -> None:
+        num_bytes = encoding.numel() * encoding.element_size()
+        if num_bytes > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = encoding
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= evicted.numel() * evicted.element_size()
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        num_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / num_lookups if num_lookups > 0 else 0.0,
+            "num_entries": len(self.entries),
+            "num_bytes": self.num_bytes,
+        }
 
 
 class EncoderMixin(abc.ABC):
     word_embeddings: nn.Module
     text_encoder: nn.Module
-    graph_encoder: nn.Module
+    graph_encoder: GraphEncoder
     node_embeddings: nn.Embedding
     relation_embeddings: nn.Embedding
 
@@ -602,27 +1954,299 @@ class EncoderMixin(abc.ABC):
     rel_name_word_ids: torch.Tensor
     rel_name_mask: torch.Tensor
 
+    # if set, dense graphs are converted into SparseAdjacency's, keeping only
+    # the edges whose magnitudes are greater than this threshold, before encoding.
+    sparse_graph_threshold: Optional[float] = None
+
+    # if True, the node and relation features, which are the same for all graphs,
+    # are projected by the first R-GCN layer once, instead of for each graph.
+    # See get_first_layer_projected_features() for more details.
+    precompute_first_layer_projection = False
+
+    # if True, text is encoded as PackedSequences, skipping the paddings that don't
+    # affect the unmasked outputs. See TextEncoderBlock.packed_forward() for details.
+    packed_text_encoding = False
+
+    # the maximum size in bytes of the cache of the encoded sequences, which is used
+    # when the text encoder is frozen or in eval mode. 0 turns off the cache.
+    # See encode_text() for more details.
+    text_encoding_cache_max_bytes = 0
+
+    # if True, the word embeddings and their projection are folded into one
+    # (num_words, text_encoder.hidden_dim) lookup table when we don't need gradients
+    # for them. See embed_words() for more details.
+    fold_word_embeddings = False
+
     def encode_text(self, word_ids: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        Encode the given text. If the parameters of the word embeddings and the text
+        encoder are frozen, or they're in eval mode and we don't need gradients,
+        the encoding of each sequence is cached, so that only the sequences that
+        are not in the cache are encoded.
+
+        Paddings leak into the encodings through the convolutions, so the cache key
+        of a sequence is its word ids and the word ids of the paddings that can
+        affect it, i.e. up to TextEncoder.num_leaking_pads. So the unmasked outputs
+        are the same as calculate_encoded_text(). The key also has the autocast
+        state, so that e.g. the bfloat16 encodings are not reused without autocast.
+
+        word_ids: (batch, seq_len)
+        mask: (batch, seq_len), right padded
+
+        output: (batch, seq_len, text_encoder.hidden_dim)
+            the masked positions are zeros if the cache is used.
+        """
+        if not self.use_text_encoding_cache():
+            return self.calculate_encoded_text(word_ids, mask)
+        if word_ids.size(0) == 0:
+            # nothing to look up, and there are no encodings to concatenate
+            return self.embed_words(word_ids)
+            # (0, seq_len, text_encoder.hidden_dim)
+
+        weights = self.text_encoding_weights()
+        cache = self.text_encoding_cache
+        cache.validate(tuple((w.data_ptr(), w._version) for w in weights))
+        seq_len = mask.size(1)
+        num_leaking_pads = self.text_encoder.num_leaking_pads
+        lengths = mask.sum(dim=1).long().tolist()
+        autocast = autocast_state(word_ids.device)
+        keys = [
+            (
+                autocast,
+                length,
+                tuple(ids[: length + min(seq_len - length, num_leaking_pads)]),
+            )
+            for ids, length in zip(word_ids.tolist(), lengths)
+        ]
+        encodings = [cache.get(key) for key in keys]
+
+        # encode the sequences that are not in the cache
+        missed: Dict[Hashable, List[int]] = {}
+        for i, encoding in enumerate(encodings):
+            if encoding is None:
+                missed.setdefault(keys[i], []).append(i)
+        if missed:
+            missed_ids = [ids[0] for ids in missed.values()]
+            index = torch.tensor(missed_ids, device=word_ids.device)
+            encoded = self.calculate_encoded_text(word_ids[index], mask[index])
+            # (num_missed, seq_len, text_encoder.hidden_dim)
+            for j, (key, ids) in enumerate(missed.items()):
+                # clone so that the cached encoding doesn't keep the batch alive
+                encoding = encoded[j, : lengths[ids[0]]].clone()
+                cache.put(key, encoding)
+                for i in ids:
+                    encodings[i] = encoding
+
+        # rebuild the padded batch
+        return PackedSequences.from_mask(mask).unpack(torch.cat(encodings))
+        # (batch, seq_len, text_encoder.hidden_dim)
+
+    def text_encoding_weights(self) -> List[torch.Tensor]:
+        return list(
+            itertools.chain(
+                self.word_embeddings.parameters(), self.text_encoder.parameters()
+            )
+        )
+
+    def use_text_encoding_cache(self) -> bool:
+        """
+        Whether encode_text() uses the cache, i.e. if it's turned on, and the word
+        embeddings and the text encoder are frozen, or they're in eval mode and
+        we don't need gradients.
+        """
+        frozen = not any(
+            weight.requires_grad for weight in self.text_encoding_weights()
+        )
+        return self.text_encoding_cache_max_bytes > 0 and (
+            frozen or (not self.text_encoder.training and not torch.is_grad_enabled())
+        )
+
+    def encode_text_steps(
+        self, word_ids: List[torch.Tensor], masks: List[torch.Tensor]
+    ) -> List[torch.Tensor]:
+        """
+        Encode the texts of multiple steps, e.g. the observations and previous
+        actions of a truncated BPTT window, in one batched call to the text encoder.
+        The unmasked outputs are the same as encode_text() of each step.
+
+        The steps are padded to different lengths, and the paddings leak into the
+        encodings, so instead of padding them to the same length, the steps are
+        packed as PackedSequences with the paddings of each step that can affect it.
+        If encode_text() uses the cache, the steps are encoded one by one, b/c the
+        cache already skips the sequences that have been encoded.
+
+        word_ids: [(batch_i, seq_len_i), ...]
+        masks: [(batch_i, seq_len_i), ...], right padded
+
+        output: [(batch_i, seq_len_i, text_encoder.hidden_dim), ...]
+            the masked positions are zeros.
+        """
+        if self.use_text_encoding_cache():
+            return [self.encode_text(ids, mask) for ids, mask in zip(word_ids, masks)]
+
+        seq_len = max(mask.size(1) for mask in masks)
+        num_leaking_pads = self.text_encoder.num_leaking_pads
+        packed = PackedSequences.from_mask(
+            torch.cat([F.pad(mask, (0, seq_len - mask.size(1))) for mask in masks]),
+            num_pads=torch.cat(
+                [
+                    (mask.size(1) - mask.sum(dim=1)).clamp(max=num_leaking_pads)
+                    for mask in masks
+                ]
+            ),
+        )
+        word_embs = self.embed_words(
+            packed.pack(
+                torch.cat([F.pad(ids, (0, seq_len - ids.size(1))) for ids in word_ids])
+            )
+        )
+        # (total_len, text_encoder.hidden_dim)
+        encoded = packed.unpack(self.text_encoder(word_embs, packed))
+        # (sum(batch_i), seq_len, text_encoder.hidden_dim)
+        # zero out the paddings that were packed
+        return [
+            step_encoded[:, : mask.size(1)] * mask.unsqueeze(-1)
+            for step_encoded, mask in zip(
+                encoded.split([mask.size(0) for mask in masks]), masks
+            )
+        ]
+
+    @property
+    def text_encoding_cache(self) -> TextEncodingCache:
+        cache: TextEncodingCache = self.__dict__.setdefault(
+            "_text_encoding_cache",
+            TextEncodingCache(self.text_encoding_cache_max_bytes),
+        )
+        cache.max_bytes = self.text_encoding_cache_max_bytes
+        return cache
+
+    def calculate_encoded_text(
+        self, word_ids: torch.Tensor, mask: torch.Tensor
+    ) -> torch.Tensor:
         """
         word_ids: (batch, seq_len)
         mask: (batch, seq_len)
 
         output: (batch, seq_len, text_encoder.hidden_dim)
+            the masked positions are zeros if packed_text_encoding is True.
         """
-        word_embs = self.word_embeddings(word_ids)
+        if self.packed_text_encoding:
+            packed = PackedSequences.from_mask(
+                mask, num_pads=self.text_encoder.num_leaking_pads
+            )
+            word_embs = self.embed_words(packed.pack(word_ids))
+            # (total_len, text_encoder.hidden_dim)
+            return packed.unpack(self.text_encoder(word_embs, packed))
+            # (batch, seq_len, text_encoder.hidden_dim)
+
+        word_embs = self.embed_words(word_ids)
         # (batch, seq_len, text_encoder.hidden_dim)
         return self.text_encoder(word_embs, mask)
         # (batch, seq_len, text_encoder.hidden_dim)
 
+    def embed_words(self, word_ids: torch.Tensor) -> torch.Tensor:
+        """
+        Embed the given words with word_embeddings. If fold_word_embeddings is True,
+        and we don't need gradients for word_embeddings, the embeddings are looked up
+        from the folded lookup table, get_folded_word_embeddings(), so we don't have
+        to project them for each word.
+
+        word_ids: (*)
+
+        output: (*, text_encoder.hidden_dim)
+        """
+        if self.fold_word_embeddings and not (
+            torch.is_grad_enabled()
+            and any(param.requires_grad for param in self.word_embeddings.parameters())
+        ):
+            return F.embedding(word_ids, self.get_folded_word_embeddings())
+        return self.word_embeddings(word_ids)
+
+    def get_folded_word_embeddings(self) -> torch.Tensor:
+        """
+        Return the embeddings of all the words, i.e. word_embeddings folded into
+        a lookup table. The result is cached if we don't need gradients.
+
+        output: (num_words, text_encoder.hidden_dim)
+        """
+        return self.cached_static_tensor(
+            "folded_word_embeddings",
+            self.word_embeddings.parameters(),
+            self.calculate_folded_word_embeddings,
+        )
+
+    def calculate_folded_word_embeddings(self) -> torch.Tensor:
+        """
+        output: (num_words, text_encoder.hidden_dim)
+        """
+        embedding = next(
+            module
+            for module in self.word_embeddings.modules()
+            if isinstance(module, nn.Embedding)
+        )
+        return self.word_embeddings(
+            torch.arange(embedding.num_embeddings, device=embedding.weight.device)
+        )
+
+    def cached_static_tensor(
+        self,
+        name: str,
+        dependencies: Iterable[torch.Tensor],
+        compute: Callable[[], torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        Memoize the result of compute(), which only depends on the given parameters
+        and buffers. The cached result is keyed on the storages and version counters
+        of the dependencies, so it's recalculated after they're updated in-place,
+        e.g. by an optimizer step or load_state_dict(), or moved to another device,
+        as well as the autocast state, as compute() may run under autocast.
+
+        We can't reuse the cached result if we need gradients for the dependencies,
+        so in that case, compute() is always called.
+        """
+        dependencies = list(dependencies)
+        if torch.is_grad_enabled() and any(t.requires_grad for t in dependencies):
+            return compute()
+        key = (
+            autocast_state(dependencies[0].device),
+            tuple((t.data_ptr(), t._version) for t in dependencies),
+        )
+        cache: Dict[str, Tuple[Any, torch.Tensor]] = self.__dict__.setdefault(
+            "_static_tensor_cache", {}
+        )
+        if name in cache and cache[name][0] == key:
+            return cache[name][1]
+        tensor = compute()
+        cache[name] = (key, tensor)
+        return tensor
+
     def get_node_features(self) -> torch.Tensor:
         """
         Return node features by concatenating the masked mean
         node name embeddings and node embeddings.
+        The result is cached if we don't need gradients.
+
+        output: (num_node, text_encoder.hidden_dim + node_emb_dim)
+        """
+        return self.cached_static_tensor(
+            "node_features",
+            itertools.chain(
+                self.word_embeddings.parameters(),
+                [
+                    self.node_embeddings.weight,
+                    self.node_name_word_ids,
+                    self.node_name_mask,
+                ],
+            ),
+            self.calculate_node_features,
+        )
 
+    def calculate_node_features(self) -> torch.Tensor:
+        """
         output: (num_node, text_encoder.hidden_dim + node_emb_dim)
         """
         node_name_embeddings = masked_mean(
-            self.word_embeddings(self.node_name_word_ids),
+            self.embed_words(self.node_name_word_ids),
             self.node_name_mask,  # type: ignore
         )
         # (num_node, hidden_dim)
@@ -633,32 +2257,167 @@ class EncoderMixin(abc.ABC):
         """
         Return relation features by concatenating the masked mean
         relation name embeddings and relation embeddings.
+        The result is cached if we don't need gradients.
 
+        output: (num_relations, text_encoder.hidden_dim + relation_emb_dim)
+        """
+        return self.cached_static_tensor(
+            "relation_features",
+            itertools.chain(
+                self.word_embeddings.parameters(),
+                [
+                    self.relation_embeddings.weight,
+                    self.rel_name_word_ids,
+                    self.rel_name_mask,
+                ],
+            ),
+            self.calculate_relation_features,
+        )
+
+    def calculate_relation_features(self) -> torch.Tensor:
+        """
         output: (num_relations, text_encoder.hidden_dim + relation_emb_dim)
         """
         rel_name_embeddings = masked_mean(
-            self.word_embeddings(self.rel_name_word_ids),
+            self.embed_words(self.rel_name_word_ids),
             self.rel_name_mask,  # type: ignore
         )
         # (num_relations, hidden_dim)
         return torch.cat([rel_name_embeddings, self.relation_embeddings.weight], dim=1)
         # (num_relations, hidden_dim + relation_emb_dim)
 
-    def encode_graph(self, adj: torch.Tensor) -> torch.Tensor:
+    def get_first_layer_projected_features(
+        self,
+    ) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Project the static node and relation features by the first R-GCN layer of
+        the graph encoder, which is the largest layer as node_input_dim is
+        hidden_dim + node_emb_dim. This way, the first layer only has to aggregate
+        the projected features over the adjacency matrices.
+        The results are cached if we don't need gradients, so they're reused
+        until the weights are updated.
+
+        output: None if precompute_first_layer_projection is False, otherwise (
+            projected node features: (num_relation, num_node, num_bases),
+            projected relation features: (num_relation, num_bases),
+        )
+        """
+        if not self.precompute_first_layer_projection:
+            return None
+        first_layer = self.graph_encoder.rgcns[0]
+        return (
+            self.cached_static_tensor(
+                "first_layer_projected_node_features",
+                itertools.chain(
+                    self.word_embeddings.parameters(),
+                    [
+                        self.node_embeddings.weight,
+                        self.node_name_word_ids,
+                        self.node_name_mask,
+                        first_layer.bottleneck_layer.weight,
+                    ],
+                ),
+                lambda: first_layer.project_node_features(self.get_node_features()),
+            ),
+            self.cached_static_tensor(
+                "first_layer_projected_relation_features",
+                itertools.chain(
+                    self.word_embeddings.parameters(),
+                    [
+                        self.relation_embeddings.weight,
+                        self.rel_name_word_ids,
+                        self.rel_name_mask,
+                        first_layer.bottleneck_layer.weight,
+                    ],
+                ),
+                lambda: first_layer.project_relation_features(
+                    self.get_relation_features()
+                ),
+            ),
+        )
+
+    def prepare_graph(self, adj: Adjacency) -> Adjacency:
+        """
+        Convert the given dense or quantized graph into a SparseAdjacency
+        if sparse_graph_threshold is set.
+
+        adj: (batch, num_relation, num_node, num_node)
+            or (batch, num_relation // 2, num_node, num_node)
+            or SparseAdjacency or QuantizedAdjacency
+        """
+        if self.sparse_graph_threshold is None or isinstance(adj, SparseAdjacency):
+            return adj
+        if isinstance(adj, QuantizedAdjacency):
+            adj = adj.to_dense()
+        return SparseAdjacency.from_dense(adj, threshold=self.sparse_graph_threshold)
+
+    def encode_graph(
+        self,
+        adj: Adjacency,
+        active_nodes: Optional[ActiveNodes] = None,
+    ) -> torch.Tensor:
         """
         adj: (batch, num_relation, num_node, num_node)
+            or (batch, num_relation // 2, num_node, num_node)
+            or SparseAdjacency or QuantizedAdjacency
+        active_nodes: if given, adj is the subgraph of the active nodes, i.e.
+            (batch, num_relation, max_active_node, max_active_node)
+            or (batch, num_relation // 2, max_active_node, max_active_node),
+            and only the active nodes are encoded.
 
         output: (batch, num_node, graph_encoder.hidden_dim)
+            or (batch, max_active_node, graph_encoder.hidden_dim)
         """
-        batch_size = adj.size(0)
+        adj = self.prepare_graph(adj)
+        batch_size = (
+            adj.batch_size
+            if isinstance(adj, (SparseAdjacency, QuantizedAdjacency))
+            else adj.size(0)
+        )
         node_features = self.get_node_features().unsqueeze(0).expand(batch_size, -1, -1)
         # (batch, num_node, hidden_dim + node_emb_dim)
         relation_features = (
             self.get_relation_features().unsqueeze(0).expand(batch_size, -1, -1)
         )
         # (batch, num_relations, hidden_dim + relation_emb_dim)
-        return self.graph_encoder(node_features, relation_features, adj)
-        # (batch, num_node, hidden_dim)
+        first_layer_projected_features = self.get_first_layer_projected_features()
+        if active_nodes is not None:
+            node_features = active_nodes.gather_nodes(node_features)
+            # (batch, max_active_node, hidden_dim + node_emb_dim)
+            if first_layer_projected_features is not None:
+                (
+                    projected_node_features,
+                    projected_relation_features,
+                ) = first_layer_projected_features
+                first_layer_projected_features = (
+                    projected_node_features[:, active_nodes.ids].transpose(0, 1),
+                    projected_relation_features,
+                )
+                # projected node features:
+                #   (batch, num_relation, max_active_node, num_bases)
+        return self.graph_encoder(
+            node_features, relation_features, adj, first_layer_projected_features
+        )
+        # (batch, num_node, hidden_dim) or (batch, max_active_node, hidden_dim)
+
+    def find_mentioned_nodes(
+        self, word_ids: torch.Tensor, mask: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Find the nodes mentioned in the given text,
+        i.e. all the words of their names appear in the text.
+
+        word_ids: (batch, seq_len)
+        mask: (batch, seq_len)
+
+        output: (batch, num_node)
+        """
+        word_matches = (
+            self.node_name_word_ids[None, :, :, None] == word_ids[:, None, None, :]
+        ) & mask.bool()[:, None, None, :]
+        # (batch, num_node, node_name_len, seq_len)
+        return (word_matches.any(dim=3) | ~self.node_name_mask.bool()).all(dim=2)
+        # (batch, num_node)
 
 
 class WordNodeRelInitMixin(abc.ABC):
@@ -119,13 +119,18 @@ class RAdam(Optimizer):
                         )
                     denom = exp_avg_sq.sqrt().add_(group["eps"])
                     p_data_fp32.addcdiv_(-step_size * group["lr"], exp_avg, denom)
-                    p.data.copy_(p_data_fp32)
+                    # copy through p instead of p.data so that the version counter
+                    # of p is bumped, which EncoderMixin relies on to invalidate
+                    # its caches.
+                    with torch.no_grad():
+                        p.copy_(p_data_fp32)
                 elif step_size > 0:
                     if group["weight_decay"] != 0:
                         p_data_fp32.add_(
                             -group["weight_decay"] * group["lr"], p_data_fp32
                         )
                     p_data_fp32.add_(-step_size * group["lr"], exp_avg)
-                    p.data.copy_(p_data_fp32)
+                    with torch.no_grad():
+                        p.copy_(p_data_fp32)
 
         return loss
@@ -25,6 +25,7 @@ if __name__ == "__main__":
         gata_double_dqn.action_selector,
         gata_double_dqn.preprocessor,
     )
+    agent.active_node_mode = gata_double_dqn.hparams.active_node_mode
 
     env_id = textworld.gym.register_game(
         args.game_file, request_infos=request_infos_for_eval()
@@ -32,16 +33,16 @@ if __name__ == "__main__":
     env = gym.make(env_id)
 
     prev_actions = None
-    rnn_prev_hidden = None
+    prev_state = None
     ob, info = env.reset()
     print(ob)
     for step in itertools.count():
         input("Press Enter to make a move ")
-        actions, rnn_prev_hidden = agent.act(
+        actions, prev_state = agent.act_with_state(
             [ob],
             [info["admissible_commands"]],
             prev_actions=prev_actions,
-            rnn_prev_hidden=rnn_prev_hidden,
+            prev_state=prev_state,
         )
         action = actions[0]
         print(f"\n>> {action}\n")
@@ -2,6 +2,7 @@ import pytest
 import torch
 
 from action_selector import ActionScorer, ActionSelector
+from layers import ActiveNodes
 from utils import increasing_mask
 
 
@@ -39,6 +40,25 @@ def test_action_scorer(
     )
 
 
+def test_action_scorer_node_mask():
+    action_scorer = ActionScorer(8, 2)
+    inputs = (
+        torch.rand(2, 3, 4, 8),
+        increasing_mask(3, 4).unsqueeze(0).expand(2, -1, -1),
+        torch.ones(2, 3),
+        torch.rand(2, 5, 8),
+    )
+    h_go = torch.rand(2, 6, 8)
+    obs_mask = increasing_mask(2, 5)
+    # the padding nodes are ignored
+    assert action_scorer(
+        *inputs, h_go, obs_mask, node_mask=torch.tensor([[1, 1, 1, 1, 0, 0]] * 2)
+    ).allclose(action_scorer(*inputs, h_go[:, :4], obs_mask), atol=1e-6)
+    assert action_scorer(*inputs, h_go, obs_mask, node_mask=torch.ones(2, 6)).allclose(
+        action_scorer(*inputs, h_go, obs_mask), atol=1e-6
+    )
+
+
 @pytest.mark.parametrize(
     "hidden_dim,num_words,word_emb_dim,num_nodes,node_emb_dim,num_relations,"
     "relation_emb_dim,text_encoder_num_blocks,text_encoder_num_conv_layers,"
@@ -106,6 +126,122 @@ def test_action_selector(
     )
 
 
+def test_action_selector_padded_action_cands():
+    num_words = 100
+    num_nodes = 5
+    num_relations = 10
+    action_selector = ActionSelector(
+        12,
+        num_words,
+        24,
+        num_nodes,
+        24,
+        num_relations,
+        36,
+        1,
+        1,
+        3,
+        1,
+        1,
+        3,
+        1,
+        torch.randint(num_words, (num_nodes, 3)),
+        increasing_mask(num_nodes, 3),
+        torch.randint(num_words, (num_relations, 3)),
+        increasing_mask(num_relations, 3),
+    )
+    obs_word_ids = torch.randint(num_words, (2, 5))
+    obs_mask = increasing_mask(2, 5)
+    current_graph = torch.rand(2, num_relations, num_nodes, num_nodes)
+    action_cand_word_ids = torch.randint(num_words, (2, 3, 4))
+    action_cand_mask = torch.ones(2, 3, 4)
+    # the second game only has one action candidate,
+    # the rest is padded with fully masked action candidates
+    action_cand_word_ids[1, 1:] = 0
+    action_cand_mask[1, 1:] = 0
+    action_mask = torch.tensor([[1, 1, 1], [1, 0, 0]]).float()
+    action_scores = action_selector(
+        obs_word_ids,
+        obs_mask,
+        current_graph,
+        action_cand_word_ids,
+        action_cand_mask,
+        action_mask,
+    )
+    assert not action_scores.isnan().any()
+    assert action_scores[1, 1:].equal(torch.zeros(2))
+    assert action_scores[1, :1].allclose(
+        action_selector(
+            obs_word_ids[1:],
+            obs_mask[1:],
+            current_graph[1:],
+            action_cand_word_ids[1:, :1],
+            action_cand_mask[1:, :1],
+            action_mask[1:, :1],
+        )[0],
+        atol=1e-6,
+    )
+
+
+def test_action_selector_active_nodes():
+    num_words = 100
+    num_nodes = 6
+    num_relations = 4
+    action_selector = ActionSelector(
+        12,
+        num_words,
+        24,
+        num_nodes,
+        24,
+        num_relations,
+        36,
+        1,
+        1,
+        3,
+        1,
+        2,
+        3,
+        1,
+        torch.randint(num_words, (num_nodes, 3)),
+        increasing_mask(num_nodes, 3),
+        torch.randint(num_words, (num_relations, 3)),
+        increasing_mask(num_relations, 3),
+    )
+    obs_word_ids = torch.randint(num_words, (2, 5))
+    obs_mask = increasing_mask(2, 5)
+    graph = torch.rand(2, num_relations, num_nodes, num_nodes)
+    action_cand_word_ids = torch.randint(num_words, (2, 3, 4))
+    action_cand_mask = increasing_mask(6, 4).view(2, 3, 4)
+    action_mask = torch.ones(2, 3)
+    active_node_mask = torch.tensor(
+        [[0, 1, 0, 0, 1, 0], [1, 1, 0, 1, 0, 1]], dtype=torch.bool
+    )
+    active_nodes = ActiveNodes.from_mask(active_node_mask)
+    action_scores = action_selector(
+        obs_word_ids,
+        obs_mask,
+        active_nodes.gather_graph(graph),
+        action_cand_word_ids,
+        action_cand_mask,
+        action_mask,
+        active_nodes=active_nodes,
+    )
+    assert action_scores.size() == (2, 3)
+
+    # the results don't depend on the padding nodes
+    for i in range(2):
+        unpadded_active_nodes = ActiveNodes.from_mask(active_node_mask[i : i + 1])
+        assert action_selector(
+            obs_word_ids[i : i + 1],
+            obs_mask[i : i + 1],
+            unpadded_active_nodes.gather_graph(graph[i : i + 1]),
+            action_cand_word_ids[i : i + 1],
+            action_cand_mask[i : i + 1],
+            action_mask[i : i + 1],
+            active_nodes=unpadded_active_nodes,
+        ).allclose(action_scores[i : i + 1], atol=1e-5)
+
+
 @pytest.mark.parametrize(
     "action_scores,action_mask,max_q_actions",
     [
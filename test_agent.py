@@ -71,15 +71,15 @@ def eps_greedy_agent():
             torch.tensor(
                 [
                     [[2, 3, 4, 5], [2, 3, 0, 0]],
-                    [[2, 5, 0, 0], [1, 0, 0, 0]],
-                    [[2, 3, 0, 0], [1, 0, 0, 0]],
+                    [[2, 5, 0, 0], [0, 0, 0, 0]],
+                    [[2, 3, 0, 0], [0, 0, 0, 0]],
                 ]
             ),
             torch.tensor(
                 [
                     [[1, 1, 1, 1], [1, 1, 0, 0]],
-                    [[1, 1, 0, 0], [1, 0, 0, 0]],
-                    [[1, 1, 0, 0], [1, 0, 0, 0]],
+                    [[1, 1, 0, 0], [0, 0, 0, 0]],
+                    [[1, 1, 0, 0], [0, 0, 0, 0]],
                 ],
                 dtype=torch.float,
             ),
@@ -197,6 +197,7 @@ def test_agent_filter_action_cands(agent, batch_action_cands, expected_filtered)
         ),
     ],
 )
+@pytest.mark.parametrize("bf16_autocast", [True, False])
 def test_agent_calculate_action_scores(
     agent,
     obs,
@@ -205,7 +206,9 @@ def test_agent_calculate_action_scores(
     rnn_prev_hidden,
     batch,
     num_action_cands,
+    bf16_autocast,
 ):
+    agent.bf16_autocast = bf16_autocast
     results = agent.calculate_action_scores(
         obs,
         action_cands,
@@ -223,6 +226,97 @@ def test_agent_calculate_action_scores(
         agent.graph_updater.num_nodes,
         agent.graph_updater.num_nodes,
     )
+    assert results["action_scores"].dtype == torch.float
+    assert results["rnn_curr_hidden"].dtype == torch.float
+    assert results["curr_graph"].dtype == torch.float
+
+
+def test_agent_calculate_action_scores_active_nodes():
+    with open("vocabs/node_vocab.txt") as f:
+        node_ids = {name.strip(): i for i, name in enumerate(f)}
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+    graph_updater_obs_gen = GraphUpdaterObsGen(**vocab_paths)
+    agent = Agent(
+        graph_updater_obs_gen.graph_updater,
+        GATADoubleDQN(**vocab_paths).action_selector,
+        graph_updater_obs_gen.preprocessor,
+    )
+    # active node mode is not supported for pretraining
+    agent.graph_updater.pretraining = False
+    agent.active_node_mode = True
+    obs = ["you see a cookbook on the counter", "there is a red apple"]
+    action_cands = [["examine cookbook", "go east"], ["eat red apple"]]
+    results = agent.calculate_action_scores(obs, action_cands)
+    num_nodes = agent.graph_updater.num_nodes
+    assert results["action_scores"].size() == (2, 2)
+    assert results["curr_graph"].size() == (
+        2,
+        agent.graph_updater.num_relations,
+        num_nodes,
+        num_nodes,
+    )
+    mentioned = torch.zeros(2, num_nodes, dtype=torch.bool)
+    mentioned[0, [node_ids["cookbook"], node_ids["counter"]]] = True
+    mentioned[1, node_ids["red apple"]] = True
+    active_node_mask = results["active_node_mask"]
+    assert active_node_mask.equal(mentioned)
+    # the inactive nodes don't have any edges
+    assert results["curr_graph"][:, :, ~mentioned[0]][0].eq(0).all()
+    assert results["curr_graph"][:, :, :, ~mentioned[1]][1].eq(0).all()
+
+    # the active nodes are carried over
+    results = agent.calculate_action_scores(
+        ["you are in the kitchen"] * 2,
+        [["go east"], ["go west"]],
+        rnn_prev_hidden=results["rnn_curr_hidden"],
+        prev_active_node_mask=active_node_mask,
+    )
+    mentioned[:, node_ids["kitchen"]] = True
+    assert results["active_node_mask"].equal(mentioned)
+
+
+def test_agent_act_with_state_active_nodes():
+    with open("vocabs/node_vocab.txt") as f:
+        node_ids = {name.strip(): i for i, name in enumerate(f)}
+    vocab_paths = {
+        "word_vocab_path": "vocabs/word_vocab.txt",
+        "node_vocab_path": "vocabs/node_vocab.txt",
+        "relation_vocab_path": "vocabs/relation_vocab.txt",
+    }
+    graph_updater_obs_gen = GraphUpdaterObsGen(**vocab_paths)
+    agent = Agent(
+        graph_updater_obs_gen.graph_updater,
+        GATADoubleDQN(**vocab_paths).action_selector,
+        graph_updater_obs_gen.preprocessor,
+    )
+    agent.graph_updater.pretraining = False
+    agent.active_node_mode = True
+
+    # the active nodes grow over the steps of the episodes
+    actions, state = agent.act_with_state(
+        ["you see a cookbook on the counter"], [["examine cookbook", "go east"]]
+    )
+    assert state.active_node_mask[0, node_ids["cookbook"]]
+    actions, state = agent.act_with_state(
+        ["you are in the kitchen"],
+        [["go west"]],
+        prev_actions=actions,
+        prev_state=state,
+    )
+    assert state.active_node_mask[0, node_ids["kitchen"]]
+    actions, state = agent.act_with_state(
+        ["there is a red apple"],
+        [["eat red apple"]],
+        prev_actions=actions,
+        prev_state=state,
+    )
+    assert state.active_node_mask[0, node_ids["cookbook"]]
+    assert state.active_node_mask[0, node_ids["kitchen"]]
+    assert state.active_node_mask[0, node_ids["red apple"]]
 
 
 @pytest.mark.parametrize(
@@ -285,6 +379,27 @@ def test_agent_act(
     assert rnn_curr_hidden.size() == (len(obs), agent.graph_updater.hidden_dim)
 
 
+def test_agent_act_with_state(agent):
+    agent.graph_updater.pretraining = False
+    obs = ["you see a cookbook on the counter", "there is a red apple"]
+    action_cands = [["examine cookbook", "go east"], ["eat red apple", "go west"]]
+    actions, rnn_curr_hidden = agent.act(obs, action_cands)
+    state_actions, state = agent.act_with_state(obs, action_cands)
+    assert state_actions == actions
+    assert state.h_t.equal(rnn_curr_hidden)
+    assert state.g_t is not None
+
+    # the next step reuses the graph of the previous step
+    next_actions, next_rnn_curr_hidden = agent.act(
+        obs, action_cands, prev_actions=actions, rnn_prev_hidden=rnn_curr_hidden
+    )
+    next_state_actions, next_state = agent.act_with_state(
+        obs, action_cands, prev_actions=actions, prev_state=state
+    )
+    assert next_state_actions == next_actions
+    assert next_state.h_t.allclose(next_rnn_curr_hidden, atol=1e-6)
+
+
 def test_eps_greedy_agent_select_epsilon_greedy(eps_greedy_agent):
     max_q_actions_idx = torch.randint(5, (3,))
     random_actions_idx = torch.randint(5, (3,))
@@ -1,8 +1,11 @@
 import pytest
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from graph_updater import GraphUpdater
+from graph_updater import GraphUpdater, GraphUpdaterState
+from layers import ActiveNodes, QuantizedAdjacency
+from utils import increasing_mask
 
 
 @pytest.mark.parametrize(
@@ -79,3 +82,326 @@ def test_graph_updater_forward(
     assert results["g_t"].size() == (batch, num_relations, num_nodes, num_nodes)
     assert results["h_ag"].size() == (batch, prev_action_len, hidden_dim)
     assert results["h_ga"].size() == (batch, num_nodes, hidden_dim)
+
+
+@pytest.mark.parametrize("pretraining", [True, False])
+def test_graph_updater_forward_half_graph(pretraining):
+    num_words = 100
+    num_nodes = 5
+    num_relations = 8
+    gu = GraphUpdater(
+        12,
+        24,
+        num_nodes,
+        32,
+        num_relations,
+        16,
+        1,
+        2,
+        5,
+        4,
+        4,
+        3,
+        nn.Embedding(num_words, 24),
+        torch.randint(num_words, (num_nodes, 5)),
+        increasing_mask(num_nodes, 5),
+        torch.randint(num_words, (num_relations, 3)),
+        increasing_mask(num_relations, 3),
+    )
+    gu.pretraining = pretraining
+    inputs = (
+        torch.randint(num_words, (3, 7)),
+        torch.randint(num_words, (3, 3)),
+        increasing_mask(3, 7),
+        increasing_mask(3, 3),
+        torch.rand(3, 12),
+    )
+    results = gu(*inputs)
+
+    gu.forward_half_graph = True
+    half_results = gu(*inputs)
+    assert half_results["g_t"].size() == (3, num_relations // 2, num_nodes, num_nodes)
+    assert half_results["g_t"].equal(results["g_t"][:, : num_relations // 2])
+    assert half_results["h_t"].allclose(results["h_t"], atol=1e-6)
+    if pretraining:
+        assert half_results["h_ga"].allclose(results["h_ga"], atol=1e-6)
+
+
+@pytest.mark.parametrize("forward_half_graph", [True, False])
+def test_graph_updater_active_nodes(forward_half_graph):
+    num_words = 100
+    num_nodes = 6
+    num_relations = 8
+    gu = GraphUpdater(
+        12,
+        24,
+        num_nodes,
+        32,
+        num_relations,
+        16,
+        1,
+        2,
+        5,
+        4,
+        4,
+        3,
+        nn.Embedding(num_words, 24),
+        torch.randint(num_words, (num_nodes, 5)),
+        increasing_mask(num_nodes, 5),
+        torch.randint(num_words, (num_relations, 3)),
+        increasing_mask(num_relations, 3),
+    )
+    gu.forward_half_graph = forward_half_graph
+    active_nodes = ActiveNodes.from_mask(
+        torch.tensor([[0, 1, 1, 0, 1, 0], [1, 0, 0, 0, 0, 1]], dtype=torch.bool)
+    )
+    rnn_hidden = torch.rand(2, 12)
+    # f_d only decodes the subgraphs
+    assert gu.f_d(rnn_hidden, active_nodes=active_nodes).allclose(
+        active_nodes.gather_graph(gu.f_d(rnn_hidden)), atol=1e-6
+    )
+
+    results = gu(
+        torch.randint(num_words, (2, 7)),
+        torch.randint(num_words, (2, 3)),
+        increasing_mask(2, 7),
+        increasing_mask(2, 3),
+        rnn_hidden,
+        active_nodes=active_nodes,
+    )
+    num_graph_relations = num_relations // 2 if forward_half_graph else num_relations
+    assert results["h_t"].size() == (2, 12)
+    assert results["g_t"].size() == (2, num_graph_relations, 3, 3)
+    assert results["g_t"][1, :, 2:].eq(0).all()
+    assert results["g_t"][1, :, :, 2:].eq(0).all()
+
+    # not supported for pretraining
+    gu.pretraining = True
+    with pytest.raises(AssertionError):
+        gu(
+            torch.randint(num_words, (2, 7)),
+            torch.randint(num_words, (2, 3)),
+            increasing_mask(2, 7),
+            increasing_mask(2, 3),
+            rnn_hidden,
+            active_nodes=active_nodes,
+        )
+
+
+@pytest.mark.parametrize("dtype", [torch.int8, torch.bfloat16])
+def test_graph_updater_quantized_graph(dtype):
+    num_words = 100
+    gu = GraphUpdater(
+        12,
+        24,
+        5,
+        32,
+        8,
+        16,
+        1,
+        2,
+        5,
+        4,
+        4,
+        3,
+        nn.Embedding(num_words, 24),
+        torch.randint(num_words, (5, 5)),
+        increasing_mask(5, 5),
+        torch.randint(num_words, (8, 3)),
+        increasing_mask(8, 3),
+    )
+    rnn_hidden = torch.rand(3, 12)
+    graph = gu.f_d(rnn_hidden)
+    gu.quantized_graph_dtype = dtype
+    quantized_graph = gu.f_d(rnn_hidden)
+    assert isinstance(quantized_graph, QuantizedAdjacency)
+    assert quantized_graph.values.dtype == dtype
+    assert quantized_graph.to_dense().allclose(graph, atol=1e-2)
+
+    results = gu(
+        torch.randint(num_words, (3, 7)),
+        torch.randint(num_words, (3, 3)),
+        increasing_mask(3, 7),
+        increasing_mask(3, 3),
+        rnn_hidden,
+    )
+    assert isinstance(results["g_t"], QuantizedAdjacency)
+    assert results["g_t"].values.size() == (3, 8, 5, 5)
+    assert results["h_t"].size() == (3, 12)
+
+
+def small_graph_updater(num_words, num_nodes, num_relations, **kwargs):
+    return GraphUpdater(
+        12,
+        24,
+        num_nodes,
+        32,
+        num_relations,
+        16,
+        1,
+        2,
+        5,
+        4,
+        4,
+        3,
+        nn.Embedding(num_words, 24),
+        torch.randint(num_words, (num_nodes, 5)),
+        increasing_mask(num_nodes, 5),
+        torch.randint(num_words, (num_relations, 3)),
+        increasing_mask(num_relations, 3),
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("relation_rank", [None, 2])
+@pytest.mark.parametrize("forward_half_graph", [True, False])
+def test_graph_updater_factorized_graph_decoder(relation_rank, forward_half_graph):
+    num_words = 100
+    num_nodes = 6
+    num_relations = 8
+    gu = small_graph_updater(
+        num_words,
+        num_nodes,
+        num_relations,
+        graph_decoder_rank=4,
+        graph_decoder_relation_rank=relation_rank,
+    )
+    assert gu.f_d_layers is None
+    gu.forward_half_graph = forward_half_graph
+    num_graph_relations = num_relations // 2 if forward_half_graph else num_relations
+    rnn_hidden = torch.rand(2, 12)
+    graph = gu.f_d(rnn_hidden)
+    assert graph.size() == (2, num_graph_relations, num_nodes, num_nodes)
+
+    # f_d only decodes the subgraphs
+    active_nodes = ActiveNodes.from_mask(
+        torch.tensor([[0, 1, 1, 0, 1, 0], [1, 0, 0, 0, 0, 1]], dtype=torch.bool)
+    )
+    assert gu.f_d(rnn_hidden, active_nodes=active_nodes).allclose(
+        active_nodes.gather_graph(graph), atol=1e-6
+    )
+
+    results = gu(
+        torch.randint(num_words, (2, 7)),
+        torch.randint(num_words, (2, 3)),
+        increasing_mask(2, 7),
+        increasing_mask(2, 3),
+        rnn_hidden,
+    )
+    assert results["h_t"].size() == (2, 12)
+    assert results["g_t"].size() == (2, num_graph_relations, num_nodes, num_nodes)
+
+
+def test_graph_updater_distill_factorized_graph_decoder():
+    torch.manual_seed(42)
+    num_nodes = 6
+    num_relations = 8
+    gu = small_graph_updater(100, num_nodes, num_relations)
+    rnn_hidden = torch.rand(4, 12) * 2 - 1
+    dense_graph = gu.f_d(rnn_hidden)
+    losses = gu.distill_factorized_graph_decoder(4, num_steps=200, learning_rate=1e-2)
+    assert len(losses) == 200
+    assert losses[-1] < losses[0]
+    assert gu.f_d_layers is None
+    assert gu.factorized_graph_decoder is not None
+    graph = gu.f_d(rnn_hidden)
+    assert graph.size() == (4, num_relations, num_nodes, num_nodes)
+    assert F.mse_loss(graph, dense_graph) < losses[0]
+
+    # the dense graph decoder is gone
+    with pytest.raises(AssertionError):
+        gu.distill_factorized_graph_decoder(4)
+
+    # from the given hidden states
+    gu = small_graph_updater(100, num_nodes, num_relations)
+    losses = gu.distill_factorized_graph_decoder(
+        2, relation_rank=2, rnn_hiddens=rnn_hidden, num_steps=5, batch_size=3
+    )
+    assert len(losses) == 5
+    assert gu.f_d(rnn_hidden).size() == (4, num_relations, num_nodes, num_nodes)
+
+
+@pytest.mark.parametrize("forward_half_graph", [True, False])
+@pytest.mark.parametrize("pretraining", [True, False])
+def test_graph_updater_prev_state(pretraining, forward_half_graph):
+    num_words = 100
+    num_nodes = 6
+    num_relations = 8
+    gu = small_graph_updater(num_words, num_nodes, num_relations)
+    gu.pretraining = pretraining
+    gu.forward_half_graph = forward_half_graph
+    steps = [
+        (
+            torch.randint(num_words, (2, 7)),
+            torch.randint(num_words, (2, 3)),
+            increasing_mask(2, 7),
+            increasing_mask(2, 3),
+        )
+        for _ in range(3)
+    ]
+    f_d_calls = 0
+    f_d = gu.f_d
+
+    def count_f_d(*args, **kwargs):
+        nonlocal f_d_calls
+        f_d_calls += 1
+        return f_d(*args, **kwargs)
+
+    gu.f_d = count_f_d
+
+    # recompute the previous graphs from the rnn hidden states
+    rnn_prev_hidden = torch.rand(2, 12)
+    hidden_results = []
+    for step in steps:
+        results = gu(*step, rnn_prev_hidden=rnn_prev_hidden)
+        rnn_prev_hidden = results["h_t"]
+        hidden_results.append(results)
+    assert f_d_calls == 2 * len(steps)
+
+    # reuse the previous graphs
+    f_d_calls = 0
+    prev_state = hidden_results[0]["state"]
+    state_results = [hidden_results[0]]
+    for step in steps[1:]:
+        results = gu(*step, prev_state=prev_state)
+        prev_state = results["state"]
+        state_results.append(results)
+    assert f_d_calls == len(steps) - 1
+    for results, expected in zip(state_results, hidden_results):
+        assert results["h_t"].equal(expected["h_t"])
+        assert results["g_t"].equal(expected["g_t"])
+        assert results["state"].g_t is results["g_t"]
+        if pretraining:
+            assert results["h_ga"].equal(expected["h_ga"])
+            assert results["state"].encoded_g_t.size() == (2, num_nodes, 12)
+        else:
+            assert results["state"].encoded_g_t is None
+
+    # fall back to recomputing the previous graph from h_t
+    results = gu(*steps[1], prev_state=GraphUpdaterState(hidden_results[0]["h_t"]))
+    assert results["h_t"].equal(hidden_results[1]["h_t"])
+    assert results["g_t"].equal(hidden_results[1]["g_t"])
+
+    # can't give both
+    with pytest.raises(AssertionError):
+        gu(*steps[0], rnn_prev_hidden=torch.rand(2, 12), prev_state=prev_state)
+
+
+def test_graph_updater_prev_state_active_nodes():
+    num_words = 100
+    gu = small_graph_updater(num_words, 6, 8)
+    active_nodes = ActiveNodes.from_mask(
+        torch.tensor([[0, 1, 1, 0, 1, 0], [1, 0, 0, 0, 0, 1]], dtype=torch.bool)
+    )
+    inputs = (
+        torch.randint(num_words, (2, 7)),
+        torch.randint(num_words, (2, 3)),
+        increasing_mask(2, 7),
+        increasing_mask(2, 3),
+    )
+    prev_state = gu(*inputs, rnn_prev_hidden=torch.rand(2, 12))["state"]
+    # the graph of the previous state is ignored, b/c the active nodes may differ
+    results = gu(*inputs, active_nodes=active_nodes, prev_state=prev_state)
+    expected = gu(*inputs, rnn_prev_hidden=prev_state.h_t, active_nodes=active_nodes)
+    assert results["h_t"].equal(expected["h_t"])
+    assert results["g_t"].equal(expected["g_t"])
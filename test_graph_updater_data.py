@@ -45,17 +45,26 @@ def test_graph_updater_obs_gen_data_module_prepare_batch():
     assert len(prepared_batch) == 7
     for episode, expected_step_mask in zip(prepared_batch, expected_step_masks):
         assert episode["step_mask"].equal(expected_step_mask)
-        # if step_mask == 0, observations should be [<bos>, <pad>, ...]
+        # if step_mask == 0, observations, previous actions and
+        # ground truth observations should be fully masked
+        assert (episode["obs_mask"].sum(dim=1) == 0).equal(episode["step_mask"] == 0)
+        assert (episode["prev_action_mask"].sum(dim=1) == 0).equal(
+            episode["step_mask"] == 0
+        )
+        assert (episode["groundtruth_obs_word_ids"].sum(dim=1) == 0).equal(
+            episode["step_mask"] == 0
+        )
+        # otherwise, observations should start with <bos> and
+        # ground truth observations should end with <eos>
         assert (
-            episode["obs_word_ids"][episode["step_mask"] == 0][:, 0]
+            episode["obs_word_ids"][episode["step_mask"] == 1][:, 0]
             == data_module.preprocessor.word_to_id(BOS)
         ).all()
-        assert (episode["prev_action_word_ids"].sum(dim=1) == 0).equal(
-            episode["step_mask"] == 0
-        )
-        # if episode_mask == 0, ground truth observations should be [<eos>, <pad>, ...]
         assert (
-            episode["groundtruth_obs_word_ids"][episode["step_mask"] == 0][:, 0]
+            episode["groundtruth_obs_word_ids"][
+                episode["step_mask"] == 1,
+                episode["obs_mask"][episode["step_mask"] == 1].sum(dim=1).long() - 1,
+            ]
             == data_module.preprocessor.word_to_id(EOS)
         ).all()
 
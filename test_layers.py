@@ -4,21 +4,28 @@ import torch.nn.functional as F
 import torch.nn as nn
 
 from layers import (
+    SparseAdjacency,
+    QuantizedAdjacency,
+    ActiveNodes,
+    PackedSequences,
     RelationalGraphConvolution,
     RGCNHighwayConnections,
     GraphEncoder,
+    FactorizedGraphDecoder,
     DepthwiseSeparableConv1d,
     PositionalEncoder,
     PositionalEncoderTensor2Tensor,
     TextEncoderConvBlock,
+    MaskedMultiheadAttention,
     TextEncoderBlock,
     TextEncoder,
     ContextQueryAttention,
     ReprAggregator,
     EncoderMixin,
     WordNodeRelInitMixin,
+    TextEncodingCache,
 )
-from utils import increasing_mask
+from utils import increasing_mask, bf16_autocast
 from preprocessor import PAD, UNK, BOS, EOS
 
 
@@ -80,6 +87,314 @@ def test_r_gcn_get_supports(
     )
 
 
+@pytest.mark.parametrize(
+    "node_input_dim,relation_input_dim,num_relations,out_dim,"
+    "num_bases,num_nodes,batch_size",
+    [
+        (10, 20, 5, 25, 3, 7, 5),
+        (20, 20, 10, 20, 5, 10, 3),
+    ],
+)
+def test_r_gcn_basis_first(
+    node_input_dim,
+    relation_input_dim,
+    num_relations,
+    out_dim,
+    num_bases,
+    num_nodes,
+    batch_size,
+):
+    rgcn = RelationalGraphConvolution(
+        node_input_dim, relation_input_dim, num_relations, out_dim, num_bases
+    )
+    node_features = torch.rand(batch_size, num_nodes, node_input_dim)
+    relation_features = torch.rand(batch_size, num_relations, relation_input_dim)
+    adj = torch.rand(batch_size, num_relations, num_nodes, num_nodes)
+    supports = rgcn.bottleneck_layer(
+        rgcn.optimized_get_supports(node_features, relation_features, adj)
+    )
+    assert rgcn.basis_first_get_supports(
+        node_features, relation_features, adj
+    ).allclose(supports, atol=1e-5)
+    output = rgcn(node_features, relation_features, adj)
+    rgcn.basis_first = True
+    assert rgcn(node_features, relation_features, adj).allclose(output, atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "batch_size,num_relations,num_nodes,threshold",
+    [(1, 2, 3, 0.0), (3, 4, 5, 0.5)],
+)
+def test_sparse_adjacency(batch_size, num_relations, num_nodes, threshold):
+    adj = torch.rand(batch_size, num_relations, num_nodes, num_nodes) * 2 - 1
+    sparse_adj = SparseAdjacency.from_dense(adj, threshold=threshold)
+    assert sparse_adj.indices.size() == (4, (adj.abs() > threshold).sum())
+    assert sparse_adj.weights.abs().gt(threshold).all()
+    assert sparse_adj.to_dense().equal(adj * (adj.abs() > threshold))
+
+
+@pytest.mark.parametrize(
+    "batch_size,num_relations,num_nodes,k",
+    [(1, 2, 3, 1), (3, 4, 5, 7), (2, 2, 2, 10)],
+)
+def test_sparse_adjacency_from_dense_topk(batch_size, num_relations, num_nodes, k):
+    adj = torch.rand(batch_size, num_relations, num_nodes, num_nodes) * 2 - 1
+    sparse_adj = SparseAdjacency.from_dense_topk(adj, k)
+    num_edges = min(k, num_nodes * num_nodes)
+    assert sparse_adj.indices.size() == (4, batch_size * num_relations * num_edges)
+    dense = sparse_adj.to_dense()
+    assert dense.ne(0).flatten(start_dim=2).sum(dim=2).eq(num_edges).all()
+    # the kept edges are the ones with the largest magnitudes
+    kth_largest = (
+        adj.flatten(start_dim=2).abs().topk(num_edges, dim=2)[0][:, :, -1:, None]
+    )
+    assert dense.equal(adj * (adj.abs() >= kth_largest))
+
+
+def test_quantized_adjacency():
+    adj = torch.rand(3, 4, 5, 5) * 2 - 1
+    # relations without any edges
+    adj[0, 1] = 0
+    quantized_adj = QuantizedAdjacency.from_dense(adj)
+    assert quantized_adj.values.dtype == torch.int8
+    assert quantized_adj.scales.size() == (3, 4)
+    assert (quantized_adj.batch_size, quantized_adj.num_relations) == (3, 4)
+    assert quantized_adj.num_nodes == 5
+    assert quantized_adj.values.abs().max() == 127
+    dequantized_adj = quantized_adj.to_dense()
+    assert dequantized_adj[0, 1].eq(0).all()
+    assert (
+        (dequantized_adj - adj).abs() <= quantized_adj.scales[:, :, None, None] / 2
+    ).all()
+
+    bf16_adj = QuantizedAdjacency.from_dense(adj, dtype=torch.bfloat16)
+    assert bf16_adj.values.dtype == torch.bfloat16
+    assert bf16_adj.scales.eq(1).all()
+    assert bf16_adj.to_dense().allclose(adj, atol=1e-2)
+
+    with pytest.raises(AssertionError):
+        QuantizedAdjacency.from_dense(adj, dtype=torch.int32)
+
+
+@pytest.mark.parametrize("dtype,atol", [(torch.int8, 1e-5), (torch.bfloat16, 1e-2)])
+@pytest.mark.parametrize("forward_half", [True, False])
+@pytest.mark.parametrize("basis_first", [True, False])
+def test_r_gcn_quantized(basis_first, forward_half, dtype, atol):
+    num_relations = 6
+    rgcn = RelationalGraphConvolution(10, 20, num_relations, 25, 3, basis_first)
+    node_features = torch.rand(5, 7, 10)
+    relation_features = torch.rand(5, num_relations, 20)
+    adj = torch.rand(
+        5, num_relations // 2 if forward_half else num_relations, 7, 7
+    ).uniform_(-1, 1)
+    quantized_adj = QuantizedAdjacency.from_dense(adj, dtype=dtype)
+    assert rgcn(node_features, relation_features, quantized_adj).allclose(
+        rgcn(node_features, relation_features, quantized_adj.to_dense()), atol=atol
+    )
+
+
+@pytest.mark.parametrize("forward_half", [True, False])
+@pytest.mark.parametrize("batched_features", [True, False])
+def test_r_gcn_multiply_int_adj(batched_features, forward_half):
+    num_relations = 6
+    rgcn = RelationalGraphConvolution(10, 20, num_relations, 25, 3)
+    values = torch.randint(
+        -127, 128, (5, num_relations // 2 if forward_half else num_relations, 7, 7)
+    ).to(torch.int8)
+    features = torch.rand(
+        (5, num_relations, 7, 4) if batched_features else (num_relations, 7, 4)
+    )
+    assert rgcn.multiply_int_adj(values, features).allclose(
+        rgcn.multiply_adj(values.float(), features), atol=1e-4
+    )
+
+
+def test_active_nodes():
+    active_node_mask = torch.tensor(
+        [[0, 1, 0, 1, 1], [1, 0, 0, 0, 0], [0, 0, 0, 0, 0]], dtype=torch.bool
+    )
+    active_nodes = ActiveNodes.from_mask(active_node_mask)
+    # the padding ids are the ids of the inactive nodes
+    # the first node of the graph without any active nodes is active
+    assert active_nodes.ids.equal(torch.tensor([[1, 3, 4], [0, 1, 2], [0, 1, 2]]))
+    assert active_nodes.mask.equal(
+        torch.tensor([[1, 1, 1], [1, 0, 0], [1, 0, 0]], dtype=torch.float)
+    )
+    expected_mask = active_node_mask.float()
+    expected_mask[2, 0] = 1
+    assert active_nodes.to_mask(5).equal(expected_mask)
+
+    node_features = torch.rand(3, 5, 4)
+    assert active_nodes.gather_nodes(node_features)[0].equal(
+        node_features[0, [1, 3, 4]]
+    )
+    assert active_nodes.gather_nodes(node_features)[1, 0].equal(node_features[1, 0])
+
+    graph = torch.rand(3, 2, 5, 5)
+    subgraph = active_nodes.gather_graph(graph)
+    assert subgraph.size() == (3, 2, 3, 3)
+    assert subgraph[0].equal(graph[0][:, [1, 3, 4]][:, :, [1, 3, 4]])
+    assert subgraph[1, :, 0, 0].equal(graph[1, :, 0, 0])
+    assert subgraph[1:, :, 1:].eq(0).all()
+    assert subgraph[1:, :, :, 1:].eq(0).all()
+
+    # scatter back to the full graphs. the inactive nodes don't have any edges.
+    expected_graph = graph * expected_mask[:, None, :, None]
+    expected_graph *= expected_mask[:, None, None, :]
+    assert active_nodes.scatter_graph(subgraph, 5).equal(expected_graph)
+
+
+def test_packed_sequences():
+    mask = torch.tensor(
+        [[1.0, 1.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0], [1.0, 1.0, 1.0, 1.0]]
+    )
+    padded = torch.arange(12).view(3, 4)
+    packed = PackedSequences.from_mask(mask)
+    assert packed.batch_size == 3
+    assert packed.seq_len == 4
+    assert packed.total_len == 6
+    assert packed.seq_ids.equal(torch.tensor([0, 0, 2, 2, 2, 2]))
+    assert packed.positions.equal(torch.tensor([0, 1, 0, 1, 2, 3]))
+    assert packed.pack(padded).equal(torch.tensor([0, 1, 8, 9, 10, 11]))
+    assert packed.unpack(packed.pack(padded)).equal(padded * mask.long())
+    # 1 gap before, between and after each sequence
+    assert packed.gapped_index(1).equal(torch.tensor([1, 2, 5, 6, 7, 8]))
+
+    # keep up to 1 padding
+    packed = PackedSequences.from_mask(mask, num_pads=1)
+    assert packed.total_len == 8
+    assert packed.pack(padded).equal(torch.tensor([0, 1, 2, 4, 8, 9, 10, 11]))
+    assert packed.positions.equal(torch.tensor([0, 1, 2, 0, 0, 1, 2, 3]))
+
+    # keep different numbers of paddings for each sequence
+    packed = PackedSequences.from_mask(mask, num_pads=torch.tensor([2, 1, 1]))
+    assert packed.total_len == 9
+    assert packed.pack(padded).equal(torch.tensor([0, 1, 2, 3, 4, 8, 9, 10, 11]))
+
+
+@pytest.mark.parametrize(
+    "node_input_dim,relation_input_dim,num_relations,out_dim,"
+    "num_bases,num_nodes,batch_size,threshold",
+    [
+        (10, 20, 5, 25, 3, 7, 5, 0.0),
+        (20, 20, 10, 20, 5, 10, 3, 0.8),
+    ],
+)
+def test_r_gcn_sparse(
+    node_input_dim,
+    relation_input_dim,
+    num_relations,
+    out_dim,
+    num_bases,
+    num_nodes,
+    batch_size,
+    threshold,
+):
+    rgcn = RelationalGraphConvolution(
+        node_input_dim, relation_input_dim, num_relations, out_dim, num_bases
+    )
+    node_features = torch.rand(batch_size, num_nodes, node_input_dim)
+    relation_features = torch.rand(batch_size, num_relations, relation_input_dim)
+    adj = torch.rand(batch_size, num_relations, num_nodes, num_nodes) * 2 - 1
+    sparse_adj = SparseAdjacency.from_dense(adj, threshold=threshold)
+    assert rgcn(node_features, relation_features, sparse_adj).allclose(
+        rgcn(node_features, relation_features, sparse_adj.to_dense()), atol=1e-6
+    )
+
+
+@pytest.mark.parametrize("basis_first", [True, False])
+@pytest.mark.parametrize(
+    "node_input_dim,relation_input_dim,num_relations,out_dim,"
+    "num_bases,num_nodes,batch_size",
+    [
+        (10, 20, 6, 25, 3, 7, 5),
+        (20, 20, 10, 20, 5, 10, 3),
+    ],
+)
+def test_r_gcn_forward_half(
+    node_input_dim,
+    relation_input_dim,
+    num_relations,
+    out_dim,
+    num_bases,
+    num_nodes,
+    batch_size,
+    basis_first,
+):
+    rgcn = RelationalGraphConvolution(
+        node_input_dim,
+        relation_input_dim,
+        num_relations,
+        out_dim,
+        num_bases,
+        basis_first=basis_first,
+    )
+    node_features = torch.rand(batch_size, num_nodes, node_input_dim)
+    relation_features = torch.rand(batch_size, num_relations, relation_input_dim)
+    half_adj = torch.rand(batch_size, num_relations // 2, num_nodes, num_nodes)
+    adj = torch.cat([half_adj, half_adj.transpose(2, 3)], dim=1)
+    output = rgcn(node_features, relation_features, adj)
+    assert rgcn(node_features, relation_features, half_adj).allclose(output, atol=1e-6)
+    assert rgcn(
+        node_features, relation_features, SparseAdjacency.from_dense(half_adj)
+    ).allclose(output, atol=1e-6)
+
+    # wrong number of relations
+    with pytest.raises(AssertionError):
+        rgcn(node_features, relation_features, half_adj[:, :1])
+
+
+@pytest.mark.parametrize("forward_half", [True, False])
+@pytest.mark.parametrize(
+    "node_input_dim,relation_input_dim,num_relations,out_dim,"
+    "num_bases,num_nodes,batch_size",
+    [
+        (10, 20, 6, 25, 3, 7, 5),
+        (20, 20, 10, 20, 5, 10, 3),
+    ],
+)
+def test_r_gcn_projected_features(
+    node_input_dim,
+    relation_input_dim,
+    num_relations,
+    out_dim,
+    num_bases,
+    num_nodes,
+    batch_size,
+    forward_half,
+):
+    rgcn = RelationalGraphConvolution(
+        node_input_dim, relation_input_dim, num_relations, out_dim, num_bases
+    )
+    node_features = torch.rand(num_nodes, node_input_dim)
+    relation_features = torch.rand(num_relations, relation_input_dim)
+    adj = torch.rand(
+        batch_size,
+        num_relations // 2 if forward_half else num_relations,
+        num_nodes,
+        num_nodes,
+    )
+    batched_node_features = node_features.unsqueeze(0).expand(batch_size, -1, -1)
+    batched_relation_features = relation_features.unsqueeze(0).expand(
+        batch_size, -1, -1
+    )
+    output = rgcn(batched_node_features, batched_relation_features, adj)
+
+    # unbatched projected features
+    projected_features = rgcn.project_features(node_features, relation_features)
+    assert projected_features[0].size() == (num_relations, num_nodes, num_bases)
+    assert projected_features[1].size() == (num_relations, num_bases)
+    assert rgcn(
+        batched_node_features, batched_relation_features, adj, projected_features
+    ).allclose(output, atol=1e-6)
+    assert rgcn(
+        batched_node_features,
+        batched_relation_features,
+        SparseAdjacency.from_dense(adj),
+        projected_features,
+    ).allclose(output, atol=1e-6)
+
+
 @pytest.mark.parametrize(
     "node_input_dim,relation_input_dim,num_relations,out_dim,"
     "num_bases,num_nodes,batch_size,output_size",
@@ -143,6 +458,131 @@ def test_graph_encoder(
     )
 
 
+@pytest.mark.parametrize(
+    "node_input_dim,relation_input_dim,num_relations,hidden_dims,"
+    "num_bases,num_nodes,batch_size",
+    [
+        (10, 20, 5, [10, 20, 30], 3, 7, 5),
+        (20, 20, 10, [30, 20, 10], 5, 10, 3),
+    ],
+)
+def test_graph_encoder_basis_first(
+    node_input_dim,
+    relation_input_dim,
+    num_relations,
+    hidden_dims,
+    num_bases,
+    num_nodes,
+    batch_size,
+):
+    graph_encoder = GraphEncoder(
+        node_input_dim, relation_input_dim, num_relations, hidden_dims, num_bases
+    )
+    basis_first_graph_encoder = GraphEncoder(
+        node_input_dim,
+        relation_input_dim,
+        num_relations,
+        hidden_dims,
+        num_bases,
+        basis_first=True,
+    )
+    basis_first_graph_encoder.load_state_dict(graph_encoder.state_dict())
+    node_features = torch.rand(batch_size, num_nodes, node_input_dim)
+    relation_features = torch.rand(batch_size, num_relations, relation_input_dim)
+    adj = torch.rand(batch_size, num_relations, num_nodes, num_nodes)
+    assert basis_first_graph_encoder(node_features, relation_features, adj).allclose(
+        graph_encoder(node_features, relation_features, adj), atol=1e-6
+    )
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize(
+    "node_input_dim,relation_input_dim,num_relations,hidden_dims,"
+    "num_bases,num_nodes,batch_size",
+    [
+        (10, 20, 4, [10, 20, 30], 3, 7, 5),
+        (20, 20, 10, [30, 20, 10], 5, 10, 3),
+    ],
+)
+def test_graph_encoder_gradient_checkpointing(
+    sparse,
+    node_input_dim,
+    relation_input_dim,
+    num_relations,
+    hidden_dims,
+    num_bases,
+    num_nodes,
+    batch_size,
+):
+    graph_encoder = GraphEncoder(
+        node_input_dim, relation_input_dim, num_relations, hidden_dims, num_bases
+    )
+    ckpt_graph_encoder = GraphEncoder(
+        node_input_dim,
+        relation_input_dim,
+        num_relations,
+        hidden_dims,
+        num_bases,
+        gradient_checkpointing=True,
+    )
+    ckpt_graph_encoder.load_state_dict(graph_encoder.state_dict())
+    node_features = torch.rand(batch_size, num_nodes, node_input_dim)
+    relation_features = torch.rand(batch_size, num_relations, relation_input_dim)
+    adj = torch.rand(batch_size, num_relations, num_nodes, num_nodes)
+    if sparse:
+        adj = SparseAdjacency.from_dense(adj, threshold=0.5)
+
+    output = graph_encoder(node_features, relation_features, adj)
+    output.sum().backward()
+    ckpt_output = ckpt_graph_encoder(node_features, relation_features, adj)
+    ckpt_output.sum().backward()
+    assert ckpt_output.equal(output)
+    for param, ckpt_param in zip(
+        graph_encoder.parameters(), ckpt_graph_encoder.parameters()
+    ):
+        assert ckpt_param.grad.allclose(param.grad, atol=1e-6)
+
+    # no checkpointing in eval mode
+    ckpt_graph_encoder.eval()
+    assert ckpt_graph_encoder(node_features, relation_features, adj).equal(output)
+
+
+@pytest.mark.parametrize("relation_rank", [None, 1, 3])
+@pytest.mark.parametrize(
+    "hidden_dim,num_relations,num_nodes,rank,batch_size",
+    [(8, 1, 3, 2, 1), (12, 5, 10, 4, 3)],
+)
+def test_factorized_graph_decoder(
+    relation_rank, hidden_dim, num_relations, num_nodes, rank, batch_size
+):
+    decoder = FactorizedGraphDecoder(
+        hidden_dim, num_relations, num_nodes, rank, relation_rank=relation_rank
+    )
+    rnn_hidden = torch.rand(batch_size, hidden_dim)
+    adj = decoder(rnn_hidden)
+    assert adj.size() == (batch_size, num_relations, num_nodes, num_nodes)
+    assert adj.abs().le(1).all()
+    if relation_rank is None:
+        # U_i diag(r) U_j^T is symmetric
+        assert adj.allclose(adj.transpose(2, 3), atol=1e-6)
+
+    # only decode the subgraphs of the given nodes
+    node_ids = torch.randint(num_nodes, (batch_size, 2))
+    batch_ids = torch.arange(batch_size)[:, None, None]
+    assert decoder(rnn_hidden, node_ids=node_ids).allclose(
+        adj[batch_ids, :, node_ids[:, :, None], node_ids[:, None, :]].permute(
+            0, 3, 1, 2
+        ),
+        atol=1e-6,
+    )
+
+    sparse_adj = decoder.sparse_topk(rnn_hidden, 2)
+    assert isinstance(sparse_adj, SparseAdjacency)
+    assert sparse_adj.to_dense().allclose(
+        SparseAdjacency.from_dense_topk(adj, 2).to_dense()
+    )
+
+
 @pytest.mark.parametrize(
     "in_channels,out_channels,kernel_size,batch_size,seq_len_in,seq_len_out",
     [
@@ -187,6 +627,32 @@ def test_pos_encoder_tensor2tensor(channels, max_len, batch_size, seq_len):
         )
 
 
+def test_pos_encoder_tensor2tensor_shared_cache():
+    pe = PositionalEncoderTensor2Tensor(8, 10)
+    other_pe = PositionalEncoderTensor2Tensor(8, 10)
+    # the positional encodings are shared, not buffers
+    assert pe.get_pe(10, torch.float, torch.device("cpu")) is other_pe.get_pe(
+        10, torch.float, torch.device("cpu")
+    )
+    assert pe.state_dict() == {}
+
+    # they grow on demand past max_len
+    encoded = pe(torch.zeros(2, 20, 8))
+    assert encoded[0, :, 0].equal(torch.sin(torch.arange(20).float()))
+    assert encoded[0, :, 4].equal(torch.cos(torch.arange(20).float()))
+    assert pe.get_pe(0, torch.float, torch.device("cpu")).size(0) >= 20
+    packed = PackedSequences.from_mask(torch.ones(2, 40))
+    assert pe(torch.zeros(packed.total_len, 8), positions=packed.positions).equal(
+        packed.pack(pe(torch.zeros(2, 40, 8)))
+    )
+
+    # old checkpoints with the positional encodings as buffers still load
+    encoder = TextEncoder(1, 1, 3, 8, 1)
+    state_dict = encoder.state_dict()
+    state_dict["enc_blocks.0.pos_encoder.pe"] = torch.rand(512, 8)
+    encoder.load_state_dict(state_dict)
+
+
 @pytest.mark.parametrize(
     "d_model,max_len,batch_size,seq_len",
     [
@@ -228,6 +694,102 @@ def test_text_enc_conv_block(channels, kernel_size, batch_size, seq_len):
     )
 
 
+@pytest.mark.parametrize(
+    "channels,kernel_size,batch_size,seq_len",
+    [
+        (10, 3, 2, 5),
+        (15, 5, 3, 10),
+        (15, 11, 5, 20),
+    ],
+)
+def test_text_enc_conv_block_channels_last(channels, kernel_size, batch_size, seq_len):
+    conv = TextEncoderConvBlock(channels, kernel_size)
+    channels_last_conv = TextEncoderConvBlock(channels, kernel_size, channels_last=True)
+    # same parameters, so same checkpoints
+    channels_last_conv.load_state_dict(conv.state_dict())
+
+    input = torch.rand(batch_size, seq_len, channels)
+    output = conv(input)
+    output.sum().backward()
+    channels_last_output = channels_last_conv(input)
+    channels_last_output.sum().backward()
+    assert channels_last_output.allclose(output, atol=1e-6)
+    for param, channels_last_param in zip(
+        conv.parameters(), channels_last_conv.parameters()
+    ):
+        assert channels_last_param.grad.allclose(param.grad, atol=1e-5)
+
+    # packed sequences separated by gaps
+    gapped_input = torch.rand(seq_len, channels)
+    gap_mask = torch.ones(seq_len, 1)
+    gap_mask[: kernel_size // 2] = 0
+    gap_mask[-(kernel_size // 2) :] = 0
+    assert channels_last_conv(gapped_input, gap_mask=gap_mask).allclose(
+        conv(gapped_input, gap_mask=gap_mask), atol=1e-6
+    )
+
+
+@pytest.mark.parametrize(
+    "embed_dim,num_heads,batch_size,query_len,key_len,self_attn,causal",
+    [
+        (4, 1, 1, 1, 1, True, False),
+        (8, 2, 3, 5, 5, True, False),
+        (8, 2, 3, 5, 5, True, True),
+        (12, 3, 4, 6, 3, False, False),
+    ],
+)
+def test_masked_multihead_attention(
+    embed_dim, num_heads, batch_size, query_len, key_len, self_attn, causal
+):
+    mha = nn.MultiheadAttention(embed_dim, num_heads)
+    masked_mha = MaskedMultiheadAttention(embed_dim, num_heads)
+    # same parameters, so same checkpoints
+    masked_mha.load_state_dict(mha.state_dict())
+
+    query = torch.rand(batch_size, query_len, embed_dim)
+    key = query if self_attn else torch.rand(batch_size, key_len, embed_dim)
+    # random masks, but each query should be able to attend to at least one key
+    key_mask = torch.randint(2, (batch_size, key_len)).float()
+    key_mask[:, 0] = 1
+    attn_mask = None
+    if causal:
+        attn_mask = torch.ones(query_len, key_len).triu(diagonal=1).bool()
+    expected, _ = mha(
+        query.transpose(0, 1),
+        key.transpose(0, 1),
+        key.transpose(0, 1),
+        key_padding_mask=key_mask == 0,
+        attn_mask=attn_mask,
+    )
+    assert masked_mha(query, key, key, key_mask=key_mask, causal=causal).allclose(
+        expected.transpose(0, 1), atol=1e-6
+    )
+
+
+def test_masked_multihead_attention_fully_masked():
+    masked_mha = MaskedMultiheadAttention(8, 2)
+    input = torch.rand(3, 5, 8, requires_grad=True)
+    key_mask = increasing_mask(3, 5)
+    key_mask[1] = 0
+    output = masked_mha(input, input, input, key_mask=key_mask)
+    # the fully masked sequence should be zeros, not nan's,
+    # and the others shouldn't be affected by it
+    assert output[1].equal(torch.zeros(5, 8))
+    assert output[[0, 2]].allclose(
+        masked_mha(
+            input[[0, 2]], input[[0, 2]], input[[0, 2]], key_mask=key_mask[[0, 2]]
+        )
+    )
+    output.sum().backward()
+    assert not input.grad.isnan().any()
+
+    # the first query can't attend to anything if the first key is masked
+    key_mask = torch.tensor([[0, 1, 1, 1, 1]]).float()
+    output = masked_mha(input[:1], input[:1], input[:1], key_mask=key_mask, causal=True)
+    assert output[0, 0].equal(torch.zeros(8))
+    assert not output.isnan().any()
+
+
 @pytest.mark.parametrize(
     "num_conv_layers,kernel_size,hidden_dim,num_heads,batch_size,seq_len",
     [
@@ -251,6 +813,15 @@ def test_text_enc_block(
         hidden_dim,
     )
 
+    # fully masked sequences shouldn't produce nan's
+    mask = increasing_mask(batch_size, seq_len)
+    mask[0] = 0
+    assert (
+        not text_enc_block(torch.rand(batch_size, seq_len, hidden_dim), mask)
+        .isnan()
+        .any()
+    )
+
 
 @pytest.mark.parametrize(
     "num_enc_blocks,enc_block_num_conv_layers,enc_block_kernel_size,"
@@ -290,6 +861,102 @@ def test_text_encoder(
     )
 
 
+@pytest.mark.parametrize(
+    "num_enc_blocks,enc_block_num_conv_layers,enc_block_kernel_size,"
+    "enc_block_hidden_dim,enc_block_num_heads,batch_size,seq_len",
+    [
+        (1, 1, 3, 8, 1, 2, 5),
+        (3, 5, 5, 10, 5, 3, 7),
+    ],
+)
+def test_text_encoder_gradient_checkpointing(
+    num_enc_blocks,
+    enc_block_num_conv_layers,
+    enc_block_kernel_size,
+    enc_block_hidden_dim,
+    enc_block_num_heads,
+    batch_size,
+    seq_len,
+):
+    text_encoder = TextEncoder(
+        num_enc_blocks,
+        enc_block_num_conv_layers,
+        enc_block_kernel_size,
+        enc_block_hidden_dim,
+        enc_block_num_heads,
+    )
+    ckpt_text_encoder = TextEncoder(
+        num_enc_blocks,
+        enc_block_num_conv_layers,
+        enc_block_kernel_size,
+        enc_block_hidden_dim,
+        enc_block_num_heads,
+        gradient_checkpointing=True,
+    )
+    ckpt_text_encoder.load_state_dict(text_encoder.state_dict())
+    input_word_embs = torch.rand(
+        batch_size, seq_len, enc_block_hidden_dim, requires_grad=True
+    )
+    mask = torch.tensor(
+        [[1.0] * (i + 1) + [0.0] * (seq_len - i - 1) for i in range(batch_size)]
+    )
+
+    output = text_encoder(input_word_embs, mask)
+    output.sum().backward()
+    grad = input_word_embs.grad
+    input_word_embs.grad = None
+    ckpt_output = ckpt_text_encoder(input_word_embs, mask)
+    ckpt_output.sum().backward()
+    assert ckpt_output.allclose(output, atol=1e-6)
+    assert input_word_embs.grad.allclose(grad, atol=1e-5)
+    for param, ckpt_param in zip(
+        text_encoder.parameters(), ckpt_text_encoder.parameters()
+    ):
+        assert ckpt_param.grad.allclose(param.grad, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "num_enc_blocks,enc_block_num_conv_layers,enc_block_kernel_size,"
+    "enc_block_hidden_dim,enc_block_num_heads,lengths",
+    [
+        (1, 1, 3, 8, 1, [1]),
+        (1, 1, 3, 8, 1, [3, 1, 5]),
+        (1, 5, 5, 10, 1, [4, 30, 2, 17]),
+        (3, 2, 5, 10, 2, [4, 30, 2, 17, 0]),
+    ],
+)
+def test_text_encoder_packed(
+    num_enc_blocks,
+    enc_block_num_conv_layers,
+    enc_block_kernel_size,
+    enc_block_hidden_dim,
+    enc_block_num_heads,
+    lengths,
+):
+    text_encoder = TextEncoder(
+        num_enc_blocks,
+        enc_block_num_conv_layers,
+        enc_block_kernel_size,
+        enc_block_hidden_dim,
+        enc_block_num_heads,
+    )
+    text_encoder.eval()
+    assert text_encoder.num_leaking_pads == (
+        num_enc_blocks * enc_block_num_conv_layers * (enc_block_kernel_size // 2)
+    )
+    seq_len = max(lengths)
+    mask = torch.tensor([[1.0] * n + [0.0] * (seq_len - n) for n in lengths])
+    input_word_embs = torch.rand(len(lengths), seq_len, enc_block_hidden_dim)
+    packed = PackedSequences.from_mask(mask, num_pads=text_encoder.num_leaking_pads)
+    packed_output = packed.unpack(
+        text_encoder(packed.pack(input_word_embs), packed)
+    ) * mask.unsqueeze(-1)
+    output = text_encoder(input_word_embs, mask) * mask.unsqueeze(-1)
+    non_empty = mask.sum(dim=1) > 0
+    assert packed_output[non_empty].allclose(output[non_empty], atol=1e-6)
+    assert packed_output[~non_empty].eq(0).all()
+
+
 @pytest.mark.parametrize(
     "hidden_dim,batch_size,ctx_seq_len,query_seq_len",
     [
@@ -351,6 +1018,74 @@ def test_cqattn(hidden_dim, batch_size, ctx_seq_len, query_seq_len):
     assert output.equal(no_mask_output)
 
 
+@pytest.mark.parametrize("seed", range(5))
+def test_cqattn_ctx_to_query_order(seed):
+    # the evaluation orders should give the same outputs for random shapes and masks
+    torch.manual_seed(seed)
+    hidden_dim, batch_size, ctx_seq_len, query_seq_len = torch.randint(
+        1, 40, (4,)
+    ).tolist()
+    ra = ContextQueryAttention(hidden_dim)
+    ctx = torch.rand(batch_size, ctx_seq_len, hidden_dim)
+    query = torch.rand(batch_size, query_seq_len, hidden_dim)
+    ctx_mask = torch.randint(2, (batch_size, ctx_seq_len)).float()
+    query_mask = torch.randint(2, (batch_size, query_seq_len)).float()
+
+    outputs = {}
+    for order in ["left", "right", "auto"]:
+        ra.ctx_to_query_order = order
+        outputs[order] = ra(ctx, query, ctx_mask, query_mask)
+    assert outputs["right"].allclose(outputs["left"], atol=1e-5)
+    assert outputs["auto"].allclose(outputs["left"], atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "ctx_seq_len,query_seq_len,hidden_dim,expected",
+    [(3, 5, 10, "left"), (200, 99, 64, "right"), (500, 1, 8, "right")],
+)
+def test_cqattn_ctx_to_query_order_auto(
+    ctx_seq_len, query_seq_len, hidden_dim, expected
+):
+    ra = ContextQueryAttention(hidden_dim)
+    s_query = torch.rand(2, ctx_seq_len, query_seq_len)
+    s_ctx = torch.rand(2, ctx_seq_len, query_seq_len)
+    ctx = torch.rand(2, ctx_seq_len, hidden_dim)
+    output = ra.ctx_to_query(s_query, s_ctx, ctx)
+    ra.ctx_to_query_order = expected
+    assert output.equal(ra.ctx_to_query(s_query, s_ctx, ctx))
+
+
+@pytest.mark.parametrize(
+    "hidden_dim,batch_size,ctx_seq_len,query_seq_len",
+    [
+        (10, 1, 3, 5),
+        (10, 3, 5, 7),
+        (1, 2, 4, 1),
+    ],
+)
+def test_cqattn_bidirectional(hidden_dim, batch_size, ctx_seq_len, query_seq_len):
+    ra = ContextQueryAttention(hidden_dim)
+    ctx = torch.rand(batch_size, ctx_seq_len, hidden_dim)
+    query = torch.rand(batch_size, query_seq_len, hidden_dim)
+    ctx_mask = increasing_mask(batch_size, ctx_seq_len)
+    query_mask = increasing_mask(batch_size, query_seq_len)
+
+    similarity, reverse_similarity = ra.bidirectional_trilinear_for_attention(
+        ctx, query
+    )
+    assert similarity.allclose(ra.trilinear_for_attention(ctx, query), atol=1e-6)
+    assert reverse_similarity.allclose(
+        ra.trilinear_for_attention(query, ctx), atol=1e-6
+    )
+
+    # compare against two single direction passes
+    ctx_output, query_output = ra.bidirectional_forward(
+        ctx, query, ctx_mask, query_mask
+    )
+    assert ctx_output.allclose(ra(ctx, query, ctx_mask, query_mask), atol=1e-6)
+    assert query_output.allclose(ra(query, ctx, query_mask, ctx_mask), atol=1e-6)
+
+
 @pytest.mark.parametrize(
     "hidden_dim,batch_size,repr1_seq_len,repr2_seq_len",
     [
@@ -371,6 +1106,14 @@ def test_repr_aggr(hidden_dim, batch_size, repr1_seq_len, repr2_seq_len):
     assert repr12.size() == (batch_size, repr1_seq_len, hidden_dim)
     assert repr21.size() == (batch_size, repr2_seq_len, hidden_dim)
 
+    # aggregate() only calculates the first direction
+    assert ra.aggregate(
+        repr1,
+        repr2,
+        torch.ones(batch_size, repr1_seq_len),
+        torch.ones(batch_size, repr2_seq_len),
+    ).allclose(repr12, atol=1e-6)
+
 
 @pytest.mark.parametrize(
     "num_words,hidden_dim,node_emb_dim,rel_emb_dim,num_node,num_relations,"
@@ -422,9 +1165,395 @@ def test_encoder_mixin(
         num_relations,
         hidden_dim + rel_emb_dim,
     )
-    assert te.encode_graph(
-        torch.rand(batch_size, num_relations, num_node, num_node)
-    ).size() == (batch_size, num_node, hidden_dim)
+    adj = torch.rand(batch_size, num_relations, num_node, num_node)
+    encoded_graph = te.encode_graph(adj)
+    assert encoded_graph.size() == (batch_size, num_node, hidden_dim)
+
+    # sparse graphs
+    assert te.encode_graph(SparseAdjacency.from_dense(adj)).allclose(
+        encoded_graph, atol=1e-6
+    )
+    te.sparse_graph_threshold = 0.0
+    assert te.encode_graph(adj).allclose(encoded_graph, atol=1e-6)
+
+
+def test_encoder_mixin_packed_text_encoding():
+    class TestEncoder(EncoderMixin, nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.word_embeddings = nn.Embedding(10, 8)
+            self.text_encoder = TextEncoder(1, 3, 5, 8, 1)
+
+    te = TestEncoder()
+    te.eval()
+    word_ids = torch.randint(10, (3, 20))
+    mask = torch.zeros(3, 20)
+    mask[0, :20] = 1
+    mask[1, :3] = 1
+    mask[2, :9] = 1
+    encoded = te.encode_text(word_ids, mask)
+    te.packed_text_encoding = True
+    packed_encoded = te.encode_text(word_ids, mask)
+    assert packed_encoded.size() == encoded.size()
+    assert (packed_encoded * mask.unsqueeze(-1)).allclose(
+        encoded * mask.unsqueeze(-1), atol=1e-6
+    )
+
+
+@pytest.mark.parametrize("training", [True, False])
+def test_encoder_mixin_encode_text_steps(training):
+    class TestEncoder(EncoderMixin, nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.word_embeddings = nn.Embedding(10, 8)
+            self.text_encoder = TextEncoder(1, 3, 5, 8, 1)
+
+    te = TestEncoder()
+    te.train(training)
+    # steps padded to different lengths, some with fewer paddings than
+    # num_leaking_pads, which leak into the encodings
+    word_ids = [
+        torch.randint(1, 10, (3, 20)),
+        torch.randint(1, 10, (3, 6)),
+        torch.randint(1, 10, (2, 11)),
+    ]
+    masks = [increasing_mask(3, 20, start_with_zero=True), increasing_mask(3, 6)]
+    masks.append(torch.tensor([[1.0] * 9 + [0.0] * 2, [1.0] * 11]))
+    encoded = te.encode_text_steps(word_ids, masks)
+    assert len(encoded) == 3
+    for step_encoded, ids, mask in zip(encoded, word_ids, masks):
+        assert step_encoded.size() == (ids.size(0), ids.size(1), 8)
+        assert step_encoded.allclose(
+            te.calculate_encoded_text(ids, mask) * mask.unsqueeze(-1), atol=1e-5
+        )
+    if training:
+        # one backward pass for all the steps
+        torch.stack([step_encoded.sum() for step_encoded in encoded]).sum().backward()
+        assert te.word_embeddings.weight.grad is not None
+
+
+def test_text_encoding_cache():
+    # each encoding is 4 * 2 * 4 = 32 bytes
+    cache = TextEncodingCache(64)
+    assert cache.get("a") is None
+    cache.put("a", torch.zeros(4, 2))
+    cache.put("b", torch.ones(4, 2))
+    assert cache.get("a").equal(torch.zeros(4, 2))
+    assert cache.num_bytes == 64
+    # "b" is the least recently used
+    cache.put("c", torch.ones(4, 2))
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.num_bytes == 64
+    # too big to be cached
+    cache.put("d", torch.ones(8, 4))
+    assert cache.get("d") is None
+    assert cache.stats() == {
+        "hits": 2,
+        "misses": 3,
+        "hit_rate": 0.4,
+        "num_entries": 2,
+        "num_bytes": 64,
+    }
+    cache.validate(((1, 0),))
+    assert cache.stats()["num_entries"] == 0
+    assert cache.num_bytes == 0
+
+
+def test_encoder_mixin_text_encoding_cache():
+    class TestEncoder(EncoderMixin, nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.word_embeddings = nn.Embedding(10, 8)
+            self.text_encoder = TextEncoder(1, 2, 3, 8, 1)
+
+    te = TestEncoder()
+    # the cache is off by default
+    assert te.text_encoding_cache_max_bytes == 0
+    te.text_encoding_cache_max_bytes = 64 * 1024 ** 2
+    word_ids = torch.tensor(
+        [[1, 2, 3, 4, 5, 6, 7, 8], [1, 2, 0, 0, 0, 0, 0, 0], [1, 2, 0, 0, 0, 0, 0, 0]]
+    )
+    mask = (word_ids != 0).float()
+
+    # training mode, and we need gradients, so no caching
+    assert te.encode_text(word_ids, mask).requires_grad
+    assert te.text_encoding_cache.stats()["misses"] == 0
+
+    te.eval()
+    expected = te.calculate_encoded_text(word_ids, mask) * mask.unsqueeze(-1)
+    with torch.no_grad():
+        assert te.encode_text(word_ids, mask).allclose(expected, atol=1e-6)
+        # the last two are the same, so they're encoded once
+        assert te.text_encoding_cache.stats()["misses"] == 3
+        assert te.text_encoding_cache.stats()["num_entries"] == 2
+        assert te.encode_text(word_ids, mask).allclose(expected, atol=1e-6)
+        assert te.text_encoding_cache.stats()["hits"] == 3
+
+        # only 2 paddings can affect the encodings, so cache hits
+        assert te.encode_text(word_ids[1:, :4], mask[1:, :4]).allclose(
+            te.calculate_encoded_text(word_ids[1:, :4], mask[1:, :4])
+            * mask[1:, :4].unsqueeze(-1),
+            atol=1e-6,
+        )
+        assert te.text_encoding_cache.stats()["hits"] == 5
+
+        # different paddings that can affect the encodings, so cache misses
+        assert te.encode_text(word_ids[1:, :3], mask[1:, :3]).allclose(
+            te.calculate_encoded_text(word_ids[1:, :3], mask[1:, :3])
+            * mask[1:, :3].unsqueeze(-1),
+            atol=1e-6,
+        )
+        assert te.text_encoding_cache.stats()["misses"] == 5
+
+        # empty batches
+        assert te.encode_text(word_ids[:0], mask[:0]).size() == (0, 8, 8)
+
+    # frozen, so we can cache even if we need gradients
+    te.train()
+    for param in te.parameters():
+        param.requires_grad = False
+    te.encode_text(word_ids, mask)
+    assert te.text_encoding_cache.stats()["hits"] == 8
+
+    # updating the weights invalidates the cache
+    with torch.no_grad():
+        te.word_embeddings.weight.add_(1)
+    te.encode_text(word_ids, mask)
+    assert te.text_encoding_cache.stats()["misses"] == 8
+
+    # turn off the cache
+    te.text_encoding_cache_max_bytes = 0
+    te.encode_text(word_ids, mask)
+    assert te.text_encoding_cache.stats()["misses"] == 8
+
+
+def test_encoder_mixin_text_encoding_cache_autocast():
+    class TestEncoder(EncoderMixin, nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.word_embeddings = nn.Embedding(10, 8)
+            self.text_encoder = TextEncoder(1, 2, 3, 8, 1)
+
+    te = TestEncoder()
+    te.text_encoding_cache_max_bytes = 64 * 1024 ** 2
+    te.eval()
+    word_ids = torch.tensor([[1, 2, 3, 4], [1, 2, 0, 0]])
+    mask = (word_ids != 0).float()
+    with torch.no_grad():
+        encoded = te.encode_text(word_ids, mask)
+        assert te.text_encoding_cache.stats()["misses"] == 2
+
+        # the encodings under autocast are cached separately
+        with bf16_autocast(word_ids.device):
+            bf16_encoded = te.encode_text(word_ids, mask)
+            assert te.text_encoding_cache.stats()["misses"] == 4
+            assert te.encode_text(word_ids, mask).equal(bf16_encoded)
+            assert te.text_encoding_cache.stats()["hits"] == 2
+            assert bf16_encoded.dtype == te.calculate_encoded_text(word_ids, mask).dtype
+        assert not bf16_encoded.equal(encoded)
+
+        assert te.encode_text(word_ids, mask).equal(encoded)
+        assert te.text_encoding_cache.stats()["hits"] == 4
+
+
+def test_encoder_mixin_fold_word_embeddings():
+    class TestEncoder(EncoderMixin, nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.word_embeddings = nn.Sequential(
+                nn.Embedding(10, 6), nn.Linear(6, 8, bias=False)
+            )
+
+    te = TestEncoder()
+    te.fold_word_embeddings = True
+    word_ids = torch.randint(10, (3, 5))
+    assert te.get_folded_word_embeddings().size() == (10, 8)
+
+    # we need gradients, so no folding
+    word_embs = te.embed_words(word_ids)
+    assert word_embs.requires_grad
+    assert word_embs.equal(te.word_embeddings(word_ids))
+
+    with torch.no_grad():
+        folded = te.get_folded_word_embeddings()
+        assert te.get_folded_word_embeddings() is folded
+        assert te.embed_words(word_ids).allclose(
+            te.word_embeddings(word_ids), atol=1e-6
+        )
+
+        # updating the weights recalculates the folded lookup table
+        te.word_embeddings[1].weight.mul_(2)
+        assert te.get_folded_word_embeddings() is not folded
+        assert te.embed_words(word_ids).allclose(
+            te.word_embeddings(word_ids), atol=1e-6
+        )
+
+    # frozen, so the folded lookup table is used even with gradients enabled
+    for param in te.parameters():
+        param.requires_grad = False
+    folded = te.get_folded_word_embeddings()
+    assert te.get_folded_word_embeddings() is folded
+    assert te.embed_words(word_ids).allclose(te.word_embeddings(word_ids), atol=1e-6)
+
+
+def test_encoder_mixin_static_feature_cache():
+    class TestEncoder(EncoderMixin, nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.word_embeddings = nn.Sequential(
+                nn.Embedding(10, 6), nn.Linear(6, 8, bias=False)
+            )
+            self.node_embeddings = nn.Embedding(4, 3)
+            self.relation_embeddings = nn.Embedding(2, 5)
+            self.register_buffer("node_name_word_ids", torch.randint(10, (4, 3)))
+            self.register_buffer("node_name_mask", increasing_mask(4, 3))
+            self.register_buffer("rel_name_word_ids", torch.randint(10, (2, 2)))
+            self.register_buffer("rel_name_mask", increasing_mask(2, 2))
+
+    te = TestEncoder()
+
+    # we need gradients, so no caching
+    node_features = te.get_node_features()
+    assert node_features.requires_grad
+    assert te.get_node_features() is not node_features
+    assert node_features.equal(te.calculate_node_features())
+
+    with torch.no_grad():
+        node_features = te.get_node_features()
+        rel_features = te.get_relation_features()
+        assert te.get_node_features() is node_features
+        assert te.get_relation_features() is rel_features
+        assert node_features.equal(te.calculate_node_features())
+        assert rel_features.equal(te.calculate_relation_features())
+
+    # an optimizer step invalidates the cache
+    te.calculate_node_features().sum().backward()
+    torch.optim.SGD(te.parameters(), lr=0.1).step()
+    with torch.no_grad():
+        new_node_features = te.get_node_features()
+        assert new_node_features is not node_features
+        assert not new_node_features.equal(node_features)
+        assert new_node_features.equal(te.calculate_node_features())
+        # the relation embeddings haven't been updated, but the word embeddings have
+        assert te.get_relation_features() is not rel_features
+
+    # so does load_state_dict()
+    te.load_state_dict(TestEncoder().state_dict())
+    with torch.no_grad():
+        assert te.get_node_features().equal(te.calculate_node_features())
+        assert te.get_relation_features().equal(te.calculate_relation_features())
+
+    # so does autocast
+    with torch.no_grad():
+        node_features = te.get_node_features()
+        with bf16_autocast(node_features.device):
+            bf16_node_features = te.get_node_features()
+            assert bf16_node_features.equal(te.calculate_node_features())
+            assert te.get_node_features() is bf16_node_features
+        assert not bf16_node_features.equal(node_features)
+        assert te.get_node_features().equal(node_features)
+
+    # frozen parameters are cached even if gradients are enabled
+    te.requires_grad_(requires_grad=False)
+    node_features = te.get_node_features()
+    assert te.get_node_features() is node_features
+
+
+def test_encoder_mixin_first_layer_projection():
+    class TestEncoder(EncoderMixin, nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.word_embeddings = nn.Sequential(
+                nn.Embedding(10, 6), nn.Linear(6, 8, bias=False)
+            )
+            self.graph_encoder = GraphEncoder(8 + 3, 8 + 5, 4, [8, 8], 2)
+            self.node_embeddings = nn.Embedding(6, 3)
+            self.relation_embeddings = nn.Embedding(4, 5)
+            self.register_buffer("node_name_word_ids", torch.randint(10, (6, 3)))
+            self.register_buffer("node_name_mask", increasing_mask(6, 3))
+            self.register_buffer("rel_name_word_ids", torch.randint(10, (4, 2)))
+            self.register_buffer("rel_name_mask", increasing_mask(4, 2))
+
+    te = TestEncoder()
+    adj = torch.rand(3, 4, 6, 6)
+    te.precompute_first_layer_projection = False
+    assert te.get_first_layer_projected_features() is None
+    encoded_graph = te.encode_graph(adj)
+    te.precompute_first_layer_projection = True
+    assert te.encode_graph(adj).allclose(encoded_graph, atol=1e-6)
+    assert te.encode_graph(adj[:, :2]).allclose(
+        te.encode_graph(torch.cat([adj[:, :2], adj[:, :2].transpose(2, 3)], dim=1)),
+        atol=1e-6,
+    )
+
+    with torch.no_grad():
+        (
+            projected_node_features,
+            projected_relation_features,
+        ) = te.get_first_layer_projected_features()
+        assert projected_node_features.size() == (4, 6, 2)
+        assert projected_relation_features.size() == (4, 2)
+        assert te.get_first_layer_projected_features()[0] is projected_node_features
+
+        # updating the first layer invalidates the cache
+        te.graph_encoder.rgcns[0].bottleneck_layer.weight.mul_(2)
+        assert te.get_first_layer_projected_features()[0].allclose(
+            projected_node_features * 2
+        )
+        assert te.get_first_layer_projected_features()[1].allclose(
+            projected_relation_features * 2
+        )
+
+
+def test_encoder_mixin_active_nodes():
+    class TestEncoder(EncoderMixin, nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.word_embeddings = nn.Sequential(
+                nn.Embedding(10, 6), nn.Linear(6, 8, bias=False)
+            )
+            self.graph_encoder = GraphEncoder(8 + 3, 8 + 5, 4, [8, 8], 2)
+            self.node_embeddings = nn.Embedding(6, 3)
+            self.relation_embeddings = nn.Embedding(4, 5)
+            self.register_buffer(
+                "node_name_word_ids",
+                torch.tensor([[2, 0], [3, 0], [4, 5], [5, 0], [6, 7], [8, 9]]),
+            )
+            self.register_buffer(
+                "node_name_mask",
+                torch.tensor([[1, 0], [1, 0], [1, 1], [1, 0], [1, 1], [1, 1]]).float(),
+            )
+            self.register_buffer("rel_name_word_ids", torch.randint(10, (4, 2)))
+            self.register_buffer("rel_name_mask", increasing_mask(4, 2))
+
+    te = TestEncoder()
+    assert te.find_mentioned_nodes(
+        torch.tensor([[5, 3, 4, 0], [6, 9, 2, 1]]),
+        torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0]]).float(),
+    ).equal(
+        torch.tensor(
+            [
+                [False, True, True, True, False, False],
+                [False, False, False, False, False, False],
+            ]
+        )
+    )
+
+    active_nodes = ActiveNodes.from_mask(
+        torch.tensor([[0, 1, 1, 0, 1, 0], [1, 0, 0, 0, 0, 1]], dtype=torch.bool)
+    )
+    # the inactive nodes don't have any edges
+    graph = active_nodes.scatter_graph(torch.rand(2, 4, 3, 3), 6)
+    # so the encoded active nodes are the same
+    for precompute_first_layer_projection in [True, False]:
+        te.precompute_first_layer_projection = precompute_first_layer_projection
+        encoded_subgraph = te.encode_graph(
+            active_nodes.gather_graph(graph), active_nodes=active_nodes
+        )
+        assert encoded_subgraph.size() == (2, 3, 8)
+        assert encoded_subgraph[0].allclose(te.encode_graph(graph)[0, [1, 2, 4]])
+        assert encoded_subgraph[1, :2].allclose(te.encode_graph(graph)[1, [0, 5]])
 
 
 def test_word_node_rel_init_mixin():
@@ -14,11 +14,14 @@ from train_gata import (
     TransitionCache,
     Transition,
     ReplayBuffer,
+    quantize_dynamic_agent,
     main,
 )
+from train_graph_updater import GraphUpdaterObsGen
 from agent import EpsilonGreedyAgent
 from preprocessor import PAD, UNK, BOS, EOS
 from utils import increasing_mask
+from layers import QuantizedAdjacency
 
 
 def test_request_infos_for_train():
@@ -252,6 +255,91 @@ def test_gata_double_dqn_update_target_action_selector():
         assert online.equal(target)
 
 
+def test_gata_double_dqn_mode_hparams():
+    gata_ddqn = GATADoubleDQN()
+    encoders = [
+        gata_ddqn.action_selector,
+        gata_ddqn.target_action_selector,
+        gata_ddqn.graph_updater,
+    ]
+    for encoder in encoders:
+        assert not any(rgcn.basis_first for rgcn in encoder.graph_encoder.rgcns)
+        assert not any(
+            conv.channels_last
+            for block in encoder.text_encoder.enc_blocks
+            for conv in block.conv_layers
+        )
+        assert encoder.sparse_graph_threshold is None
+        assert not encoder.precompute_first_layer_projection
+        assert not encoder.packed_text_encoding
+        assert encoder.text_encoding_cache_max_bytes == 0
+    assert not gata_ddqn.graph_updater.forward_half_graph
+    assert gata_ddqn.graph_updater.quantized_graph_dtype is None
+    assert not gata_ddqn.agent.active_node_mode
+
+    gata_ddqn = GATADoubleDQN(
+        basis_first=True,
+        channels_last=True,
+        sparse_graph_threshold=0.1,
+        forward_half_graph=True,
+        quantized_graph_dtype="int8",
+        precompute_first_layer_projection=True,
+        packed_text_encoding=True,
+        text_encoding_cache_max_bytes=1024,
+        active_node_mode=True,
+    )
+    encoders = [
+        gata_ddqn.action_selector,
+        gata_ddqn.target_action_selector,
+        gata_ddqn.graph_updater,
+    ]
+    for encoder in encoders:
+        assert all(rgcn.basis_first for rgcn in encoder.graph_encoder.rgcns)
+        assert all(
+            conv.channels_last
+            for block in encoder.text_encoder.enc_blocks
+            for conv in block.conv_layers
+        )
+        assert encoder.sparse_graph_threshold == 0.1
+        assert encoder.precompute_first_layer_projection
+        assert encoder.packed_text_encoding
+        assert encoder.text_encoding_cache_max_bytes == 1024
+    assert gata_ddqn.graph_updater.forward_half_graph
+    assert gata_ddqn.graph_updater.quantized_graph_dtype == torch.int8
+    assert gata_ddqn.agent.active_node_mode
+
+
+def test_gata_double_dqn_factorized_graph_decoder():
+    gata_ddqn = GATADoubleDQN(graph_decoder_rank=4, graph_decoder_relation_rank=2)
+    assert gata_ddqn.graph_updater.f_d_layers is None
+    assert gata_ddqn.graph_updater.factorized_graph_decoder.relation_rank == 2
+
+    # the dense graph decoder of the pretrained graph updater has to be distilled
+    with pytest.raises(AssertionError):
+        GATADoubleDQN(
+            graph_decoder_rank=4,
+            pretrained_graph_updater=GraphUpdaterObsGen().graph_updater,
+        )
+    graph_updater_obs_gen = GraphUpdaterObsGen()
+    graph_updater_obs_gen.distill_factorized_graph_decoder(4, num_steps=2)
+    pretrained_graph_updater = graph_updater_obs_gen.graph_updater
+    gata_ddqn = GATADoubleDQN(
+        graph_decoder_rank=4, pretrained_graph_updater=pretrained_graph_updater
+    )
+    assert gata_ddqn.graph_updater.f_d_layers is None
+    assert gata_ddqn.graph_updater.factorized_graph_decoder.relation_rank is None
+    for param in gata_ddqn.graph_updater.parameters():
+        assert param.requires_grad is False
+    graph = gata_ddqn.graph_updater.f_d(torch.rand(2, gata_ddqn.hparams.hidden_dim))
+    assert graph.size() == (
+        2,
+        gata_ddqn.num_relations,
+        gata_ddqn.num_nodes,
+        gata_ddqn.num_nodes,
+    )
+
+
+@pytest.mark.parametrize("bf16_autocast", [True, False])
 @pytest.mark.parametrize(
     "batch_size,obs_len,prev_action_len,num_action_cands,action_cand_len",
     [(1, 5, 3, 4, 10), (3, 6, 4, 5, 12)],
@@ -262,8 +350,10 @@ def test_gata_double_dqn_forward(
     prev_action_len,
     num_action_cands,
     action_cand_len,
+    bf16_autocast,
 ):
-    gata_ddqn = GATADoubleDQN()
+    gata_ddqn = GATADoubleDQN(bf16_autocast=bf16_autocast)
+    assert gata_ddqn.agent.bf16_autocast == bf16_autocast
     results = gata_ddqn(
         torch.randint(gata_ddqn.num_words, (batch_size, obs_len)),
         increasing_mask(batch_size, obs_len),
@@ -289,6 +379,10 @@ def test_gata_double_dqn_forward(
         gata_ddqn.num_nodes,
         gata_ddqn.num_nodes,
     )
+    # the outputs are float32 even with bfloat16 autocast
+    assert results["action_scores"].dtype == torch.float
+    assert results["rnn_curr_hidden"].dtype == torch.float
+    assert results["current_graph"].dtype == torch.float
 
 
 @pytest.mark.parametrize(
@@ -557,6 +651,108 @@ def eps_greedy_agent():
     )
 
 
+def test_quantize_dynamic_agent():
+    gata_double_dqn = GATADoubleDQN(
+        word_vocab_path="vocabs/word_vocab.txt",
+        node_vocab_path="vocabs/node_vocab.txt",
+        relation_vocab_path="vocabs/relation_vocab.txt",
+    )
+    agent = quantize_dynamic_agent(gata_double_dqn)
+    quantized_linear = torch.ao.nn.quantized.dynamic.Linear
+
+    # the linear layers are quantized, except for the ones of R-GCN's
+    assert isinstance(agent.graph_updater.f_d_layers[2], quantized_linear)
+    assert isinstance(agent.action_selector.action_scorer.linear2, quantized_linear)
+    assert isinstance(agent.action_selector.repr_aggr.prj, quantized_linear)
+    for graph_encoder in [
+        agent.graph_updater.graph_encoder,
+        agent.action_selector.graph_encoder,
+    ]:
+        assert all(
+            not isinstance(module, quantized_linear)
+            for module in graph_encoder.modules()
+        )
+    # the original modules are not quantized
+    assert isinstance(gata_double_dqn.graph_updater.f_d_layers[2], nn.Linear)
+    assert isinstance(gata_double_dqn.action_selector.action_scorer.linear2, nn.Linear)
+
+    obs = ["you see a cookbook on the counter", "there is a red apple"]
+    action_cands = [["examine cookbook", "go east"], ["eat red apple"]]
+    results = agent.calculate_action_scores(obs, action_cands)
+    assert results["action_scores"].size() == (2, 2)
+    assert not results["action_scores"].isnan().any()
+    actions, rnn_curr_hidden = agent.act(obs, action_cands)
+    assert len(actions) == 2
+    assert rnn_curr_hidden.size() == (2, gata_double_dqn.hparams.hidden_dim)
+
+    # active node mode gathers the dequantized weights of f_d_layers
+    agent.active_node_mode = True
+    active_node_results = agent.calculate_action_scores(obs, action_cands)
+    assert active_node_results["action_scores"].size() == (2, 2)
+
+
+def test_quantize_dynamic_agent_settings():
+    gata_double_dqn = GATADoubleDQN(active_node_mode=True, bf16_autocast=True)
+    agent = quantize_dynamic_agent(gata_double_dqn)
+    assert agent.active_node_mode
+    assert agent.bf16_autocast
+
+    agent = quantize_dynamic_agent(GATADoubleDQN())
+    assert not agent.active_node_mode
+    assert not agent.bf16_autocast
+
+
+@pytest.mark.parametrize("quantized_graph_dtype", ["int8", "bfloat16"])
+def test_gata_double_dqn_quantized_graph_dtype(quantized_graph_dtype):
+    gata_ddqn = GATADoubleDQN(
+        quantized_graph_dtype=quantized_graph_dtype,
+        train_sample_batch_size=3,
+        replay_buffer_capacity=20,
+    )
+    hidden_dim = gata_ddqn.hparams.hidden_dim
+    batch = {
+        "obs_word_ids": torch.randint(4, (3, 6)),
+        "obs_mask": increasing_mask(3, 6),
+        "prev_action_word_ids": torch.randint(4, (3, 4)),
+        "prev_action_mask": increasing_mask(3, 4),
+        "rnn_prev_hidden": torch.rand(3, hidden_dim),
+        "action_cand_word_ids": torch.randint(4, (3, 5, 7)),
+        "action_cand_mask": increasing_mask(15, 7).view(3, 5, 7),
+        "action_mask": increasing_mask(3, 5),
+        "actions_idx": torch.zeros(3, dtype=torch.long),
+        "rewards": torch.rand(3),
+        "next_obs_word_ids": torch.randint(4, (3, 6)),
+        "next_obs_mask": increasing_mask(3, 6),
+        "curr_action_word_ids": torch.randint(4, (3, 4)),
+        "curr_action_mask": increasing_mask(3, 4),
+        "next_action_cand_word_ids": torch.randint(4, (3, 5, 7)),
+        "next_action_cand_mask": increasing_mask(15, 7).view(3, 5, 7),
+        "next_action_mask": increasing_mask(3, 5),
+        "rnn_curr_hidden": torch.rand(3, hidden_dim),
+        "steps": torch.randint(1, 4, (3,)),
+        "weights": torch.rand(3),
+        "indices": torch.tensor(list(range(3))),
+    }
+    results = gata_ddqn(
+        batch["obs_word_ids"],
+        batch["obs_mask"],
+        batch["prev_action_word_ids"],
+        batch["prev_action_mask"],
+        batch["rnn_prev_hidden"],
+        batch["action_cand_word_ids"],
+        batch["action_cand_mask"],
+        batch["action_mask"],
+    )
+    assert results["action_scores"].size() == (3, 5)
+    assert isinstance(results["current_graph"], QuantizedAdjacency)
+    assert results["current_graph"].values.dtype == getattr(
+        torch, quantized_graph_dtype
+    )
+    loss = gata_ddqn.training_step(batch, 0)
+    assert loss.ndimension() == 0
+    assert loss.isfinite()
+
+
 @pytest.fixture
 def replay_buffer_gata_double_dqn():
     return GATADoubleDQN(
@@ -981,6 +1177,12 @@ def test_gata_double_dqn_gen_tain_batch(replay_buffer_gata_double_dqn):
     next(replay_buffer_gata_double_dqn.gen_train_batch())
 
 
+def test_main_hydra_entry_point():
+    # main() is the hydra-wrapped entry point, not quantize_dynamic_agent()
+    assert main.__wrapped__.__name__ == "main"
+    assert not hasattr(quantize_dynamic_agent, "__wrapped__")
+
+
 def test_main(tmp_path):
     with initialize(config_path="train_gata_conf"):
         cfg = compose(
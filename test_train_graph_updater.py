@@ -5,6 +5,7 @@ from hydra.experimental import initialize, compose
 
 from train_graph_updater import TextDecoderBlock, TextDecoder, main, GraphUpdaterObsGen
 from preprocessor import PAD, UNK, BOS, EOS
+from utils import increasing_mask
 
 
 @pytest.mark.parametrize(
@@ -82,6 +83,97 @@ def test_text_decoder(
     )
 
 
+@pytest.mark.parametrize(
+    "num_dec_blocks,dec_block_hidden_dim,dec_block_num_heads,"
+    "batch_size,input_seq_len,num_node,prev_action_len",
+    [
+        (1, 10, 1, 1, 3, 5, 4),
+        (3, 20, 2, 3, 5, 10, 8),
+    ],
+)
+def test_text_decoder_incremental_forward(
+    num_dec_blocks,
+    dec_block_hidden_dim,
+    dec_block_num_heads,
+    batch_size,
+    input_seq_len,
+    num_node,
+    prev_action_len,
+):
+    decoder = TextDecoder(num_dec_blocks, dec_block_hidden_dim, dec_block_num_heads)
+    input = torch.rand(batch_size, input_seq_len, dec_block_hidden_dim)
+    input_mask = increasing_mask(batch_size, input_seq_len)
+    node_hidden = torch.rand(batch_size, num_node, dec_block_hidden_dim)
+    prev_action_hidden = torch.rand(batch_size, prev_action_len, dec_block_hidden_dim)
+    prev_action_mask = increasing_mask(batch_size, prev_action_len)
+    expected = decoder(
+        input, input_mask, node_hidden, prev_action_hidden, prev_action_mask
+    )
+
+    # decoding one position at a time should give the same outputs
+    caches = decoder.init_cache(node_hidden, prev_action_hidden)
+    for i in range(input_seq_len):
+        output, caches = decoder.incremental_forward(
+            input[:, i : i + 1], input_mask[:, : i + 1], prev_action_mask, caches
+        )
+        assert output.size() == (batch_size, 1, dec_block_hidden_dim)
+        assert output.allclose(expected[:, i : i + 1], atol=1e-6)
+        for cache in caches:
+            assert cache.self_attn_key.size() == (
+                batch_size,
+                i + 1,
+                dec_block_hidden_dim,
+            )
+
+
+@pytest.mark.parametrize(
+    "num_dec_blocks,dec_block_hidden_dim,dec_block_num_heads,"
+    "batch_size,input_seq_len,num_node,prev_action_len",
+    [
+        (1, 10, 1, 1, 3, 5, 4),
+        (3, 20, 2, 3, 5, 10, 8),
+    ],
+)
+def test_text_decoder_gradient_checkpointing(
+    num_dec_blocks,
+    dec_block_hidden_dim,
+    dec_block_num_heads,
+    batch_size,
+    input_seq_len,
+    num_node,
+    prev_action_len,
+):
+    decoder = TextDecoder(num_dec_blocks, dec_block_hidden_dim, dec_block_num_heads)
+    ckpt_decoder = TextDecoder(
+        num_dec_blocks,
+        dec_block_hidden_dim,
+        dec_block_num_heads,
+        gradient_checkpointing=True,
+    )
+    ckpt_decoder.load_state_dict(decoder.state_dict())
+    input = torch.rand(batch_size, input_seq_len, dec_block_hidden_dim)
+    input_mask = torch.tensor(
+        [[1.0] * (i + 1) + [0.0] * (input_seq_len - i - 1) for i in range(batch_size)]
+    )
+    node_hidden = torch.rand(batch_size, num_node, dec_block_hidden_dim)
+    prev_action_hidden = torch.rand(batch_size, prev_action_len, dec_block_hidden_dim)
+    prev_action_mask = torch.tensor(
+        [[1.0] * (i + 1) + [0.0] * (prev_action_len - i - 1) for i in range(batch_size)]
+    )
+
+    output = decoder(
+        input, input_mask, node_hidden, prev_action_hidden, prev_action_mask
+    )
+    output.sum().backward()
+    ckpt_output = ckpt_decoder(
+        input, input_mask, node_hidden, prev_action_hidden, prev_action_mask
+    )
+    ckpt_output.sum().backward()
+    assert ckpt_output.allclose(output, atol=1e-6)
+    for param, ckpt_param in zip(decoder.parameters(), ckpt_decoder.parameters()):
+        assert ckpt_param.grad.allclose(param.grad, atol=1e-5)
+
+
 def test_graph_updater_obs_gen_default_init():
     g = GraphUpdaterObsGen()
     default_word_vocab = [PAD, UNK, BOS, EOS]
@@ -100,6 +192,43 @@ def test_graph_updater_obs_gen_default_init():
     assert g.graph_updater.rel_name_mask.size() == (len(g.relation_vocab), 2)
 
 
+def test_graph_updater_obs_gen_mode_hparams():
+    g = GraphUpdaterObsGen()
+    assert not any(rgcn.basis_first for rgcn in g.graph_updater.graph_encoder.rgcns)
+    assert not any(
+        conv.channels_last
+        for block in g.graph_updater.text_encoder.enc_blocks
+        for conv in block.conv_layers
+    )
+    assert g.graph_updater.sparse_graph_threshold is None
+    assert not g.graph_updater.forward_half_graph
+    assert not g.graph_updater.precompute_first_layer_projection
+    assert not g.graph_updater.packed_text_encoding
+    assert g.graph_updater.text_encoding_cache_max_bytes == 0
+
+    g = GraphUpdaterObsGen(
+        basis_first=True,
+        channels_last=True,
+        sparse_graph_threshold=0.1,
+        forward_half_graph=True,
+        precompute_first_layer_projection=True,
+        packed_text_encoding=True,
+        text_encoding_cache_max_bytes=1024,
+    )
+    assert all(rgcn.basis_first for rgcn in g.graph_updater.graph_encoder.rgcns)
+    assert all(
+        conv.channels_last
+        for block in g.graph_updater.text_encoder.enc_blocks
+        for conv in block.conv_layers
+    )
+    assert g.graph_updater.sparse_graph_threshold == 0.1
+    assert g.graph_updater.forward_half_graph
+    assert g.graph_updater.precompute_first_layer_projection
+    assert g.graph_updater.packed_text_encoding
+    assert g.graph_updater.text_encoding_cache_max_bytes == 1024
+
+
+@pytest.mark.parametrize("bf16_autocast", [True, False])
 @pytest.mark.parametrize("training", [True, False])
 @pytest.mark.parametrize("rnn_prev_hidden", [True, False])
 @pytest.mark.parametrize(
@@ -110,9 +239,9 @@ def test_graph_updater_obs_gen_default_init():
     ],
 )
 def test_graph_updater_obs_gen_forward(
-    batch_size, obs_len, prev_action_len, rnn_prev_hidden, training
+    batch_size, obs_len, prev_action_len, rnn_prev_hidden, training, bf16_autocast
 ):
-    g = GraphUpdaterObsGen()
+    g = GraphUpdaterObsGen(bf16_autocast=bf16_autocast)
     g.train(training)
     episode_data = {
         "obs_word_ids": torch.randint(g.num_words, (batch_size, obs_len)),
@@ -131,6 +260,9 @@ def test_graph_updater_obs_gen_forward(
     )
     assert results["h_t"].size() == (batch_size, g.hparams.hidden_dim)
     assert results["batch_loss"].size() == (batch_size,)
+    # the hidden states and losses are float32 even with bfloat16 autocast
+    assert results["h_t"].dtype == torch.float
+    assert results["batch_loss"].dtype == torch.float
     if not training:
         assert results["pred_obs_word_ids"].size() == (batch_size, obs_len)
         # decoded_obs_word_ids has variable lengths
@@ -156,6 +288,64 @@ def test_graph_updater_obs_gen_greedy_decode(batch_size, num_node, prev_action_l
     )
 
 
+@pytest.mark.parametrize("seed", [0, 1])
+def test_graph_updater_obs_gen_kv_cached_greedy_decode(seed):
+    torch.manual_seed(seed)
+    g = GraphUpdaterObsGen(
+        text_decoder_num_blocks=2, text_decoder_num_heads=2, max_decode_len=30
+    )
+    g.eval()
+    node_hidden = torch.randn(8, 10, g.hparams.hidden_dim) * 3
+    prev_action_hidden = torch.randn(8, 5, g.hparams.hidden_dim) * 3
+    prev_action_mask = increasing_mask(8, 5)
+    with torch.no_grad():
+        # make the sequences end with eos at different lengths
+        g.target_word_prj.weight[g.preprocessor.word_to_id(EOS)] *= 1.5
+        expected = g.greedy_decode(node_hidden, prev_action_hidden, prev_action_mask)
+        g.hparams.kv_cached_greedy_decode = True
+        decoded = g.greedy_decode(node_hidden, prev_action_hidden, prev_action_mask)
+    # token for token the same as decoding the whole prefix every step
+    assert decoded.equal(expected)
+
+
+@pytest.mark.parametrize("kv_cached", [True, False])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_graph_updater_obs_gen_compact_greedy_decode(kv_cached, seed):
+    torch.manual_seed(seed)
+    g = GraphUpdaterObsGen(
+        text_decoder_num_blocks=2,
+        text_decoder_num_heads=2,
+        max_decode_len=30,
+        kv_cached_greedy_decode=kv_cached,
+    )
+    g.eval()
+    eos_id = g.preprocessor.word_to_id(EOS)
+    node_hidden = torch.randn(8, 10, g.hparams.hidden_dim) * 3
+    prev_action_hidden = torch.randn(8, 5, g.hparams.hidden_dim) * 3
+    prev_action_mask = increasing_mask(8, 5)
+    with torch.no_grad():
+        # make the sequences end with eos at different lengths
+        g.target_word_prj.weight[eos_id] *= 1.5
+        expected, expected_fraction = g.greedy_decode_with_active_fraction(
+            node_hidden, prev_action_hidden, prev_action_mask
+        )
+        g.hparams.compact_greedy_decode = True
+        decoded, fraction = g.greedy_decode_with_active_fraction(
+            node_hidden, prev_action_hidden, prev_action_mask
+        )
+    # dropping the finished sequences doesn't change the decoded word ids
+    assert decoded.equal(expected)
+    assert fraction == expected_fraction
+
+    # each sequence is active until it decodes eos
+    num_steps = decoded.size(1) - 1
+    num_active_steps = sum(
+        word_ids.index(eos_id) if eos_id in word_ids else num_steps
+        for word_ids in decoded.tolist()
+    )
+    assert fraction.item() == pytest.approx(num_active_steps / (8 * num_steps))
+
+
 @pytest.mark.parametrize("training", [True, False])
 @pytest.mark.parametrize("hidden", [True, False])
 @pytest.mark.parametrize(
@@ -200,10 +390,225 @@ def test_graph_updater_obs_gen_process_batch(
         assert len(results["decoded"]) == max_episode_len
         assert all(dec.ndim == 2 for dec in results["decoded"])
         assert all(dec.size(0) == batch_size for dec in results["decoded"])
+        assert len(results["decode_active_fractions"]) == max_episode_len
+        assert all(0 < fraction <= 1 for fraction in results["decode_active_fractions"])
         assert len(results["f1s"]) <= max_episode_len * batch_size
         assert all(f1.ndim == 0 for f1 in results["f1s"])
 
 
+def test_graph_updater_obs_gen_bf16_autocast():
+    g = GraphUpdaterObsGen()
+    bf16_g = GraphUpdaterObsGen(bf16_autocast=True)
+    bf16_g.load_state_dict(g.state_dict())
+    batch = [
+        {
+            "obs_word_ids": torch.randint(g.num_words, (3, 10)),
+            "obs_mask": increasing_mask(3, 10),
+            "prev_action_word_ids": torch.randint(g.num_words, (3, 4)),
+            "prev_action_mask": increasing_mask(3, 4),
+            "groundtruth_obs_word_ids": torch.randint(g.num_words, (3, 10)),
+            "step_mask": torch.ones(3),
+        }
+        for _ in range(3)
+    ]
+    losses = []
+    for model in [g, bf16_g]:
+        loss = torch.stack(model.process_batch(batch)["losses"]).mean()
+        loss.backward()
+        losses.append(loss)
+    assert losses[1].allclose(losses[0], rtol=1e-2)
+    # the parameters and their gradients stay in float32
+    for param in bf16_g.parameters():
+        assert param.dtype == torch.float
+        assert param.grad is None or param.grad.dtype == torch.float
+
+
+def test_graph_updater_obs_gen_process_batch_prev_state():
+    g = GraphUpdaterObsGen()
+    g.eval()
+    batch = [
+        {
+            "obs_word_ids": torch.randint(g.num_words, (3, 10)),
+            "obs_mask": increasing_mask(3, 10),
+            "prev_action_word_ids": torch.randint(g.num_words, (3, 4)),
+            "prev_action_mask": increasing_mask(3, 4),
+            "groundtruth_obs_word_ids": torch.randint(g.num_words, (3, 10)),
+            "step_mask": torch.ones(3),
+        }
+        for _ in range(3)
+    ]
+    h_t = torch.rand(3, g.hparams.hidden_dim)
+    with torch.no_grad():
+        results = g.process_batch(batch, h_t=h_t)
+        # the graphs of the previous steps are reused in eval, which is the same
+        # as recomputing them from the rnn hidden states
+        for episode_data, hidden, loss in zip(
+            batch, results["hiddens"], results["losses"]
+        ):
+            step_results = g(episode_data, rnn_prev_hidden=h_t)
+            h_t = step_results["h_t"]
+            assert hidden.allclose(h_t, atol=1e-6)
+            assert loss.allclose(step_results["batch_loss"].mean(), atol=1e-4)
+
+
+@pytest.mark.parametrize("training", [True, False])
+def test_graph_updater_obs_gen_time_parallel_text_encoding(training):
+    g = GraphUpdaterObsGen()
+    time_parallel_g = GraphUpdaterObsGen(time_parallel_text_encoding=True)
+    time_parallel_g.load_state_dict(g.state_dict())
+    # steps padded to different lengths
+    batch = [
+        {
+            "obs_word_ids": torch.randint(g.num_words, (3, obs_len)),
+            "obs_mask": increasing_mask(3, obs_len),
+            "prev_action_word_ids": torch.randint(g.num_words, (3, prev_action_len)),
+            "prev_action_mask": increasing_mask(3, prev_action_len),
+            "groundtruth_obs_word_ids": torch.randint(g.num_words, (3, obs_len)),
+            "step_mask": torch.tensor([1.0, 1.0, step_mask]),
+        }
+        for obs_len, prev_action_len, step_mask in [(10, 4, 1), (6, 5, 1), (12, 2, 0)]
+    ]
+    h_t = torch.rand(3, g.hparams.hidden_dim)
+    results = []
+    for model in [g, time_parallel_g]:
+        model.train(training)
+        model_results = model.process_batch(batch, h_t=h_t)
+        if training:
+            torch.stack(model_results["losses"]).mean().backward()
+        results.append(model_results)
+    for loss, time_parallel_loss in zip(results[0]["losses"], results[1]["losses"]):
+        assert time_parallel_loss.allclose(loss, atol=1e-4)
+    for hidden, time_parallel_hidden in zip(
+        results[0]["hiddens"], results[1]["hiddens"]
+    ):
+        assert time_parallel_hidden.allclose(hidden, atol=1e-5)
+    if training:
+        for param, time_parallel_param in zip(
+            g.parameters(), time_parallel_g.parameters()
+        ):
+            if param.grad is None:
+                assert time_parallel_param.grad is None
+            else:
+                assert time_parallel_param.grad.allclose(param.grad, atol=1e-4)
+
+
+@pytest.mark.parametrize("time_parallel_text_encoding", [True, False])
+def test_graph_updater_obs_gen_deferred_text_decoding(time_parallel_text_encoding):
+    g = GraphUpdaterObsGen()
+    deferred_g = GraphUpdaterObsGen(
+        deferred_text_decoding=True,
+        time_parallel_text_encoding=time_parallel_text_encoding,
+    )
+    deferred_g.load_state_dict(g.state_dict())
+    # steps padded to different lengths, and finished episodes
+    batch = [
+        {
+            "obs_word_ids": torch.randint(g.num_words, (3, obs_len)),
+            "obs_mask": increasing_mask(3, obs_len),
+            "prev_action_word_ids": torch.randint(g.num_words, (3, prev_action_len)),
+            "prev_action_mask": increasing_mask(3, prev_action_len),
+            "groundtruth_obs_word_ids": torch.randint(g.num_words, (3, obs_len)),
+            "step_mask": torch.tensor(step_mask),
+        }
+        for obs_len, prev_action_len, step_mask in [
+            (10, 4, [1.0, 1.0, 1.0]),
+            (6, 5, [1.0, 1.0, 0.0]),
+            (12, 2, [0.0, 1.0, 0.0]),
+        ]
+    ]
+    h_t = torch.rand(3, g.hparams.hidden_dim)
+    results = []
+    for model in [g, deferred_g]:
+        model.train()
+        model_results = model.process_batch(batch, h_t=h_t)
+        torch.stack(model_results["losses"]).mean().backward()
+        results.append(model_results)
+    assert len(results[1]["losses"]) == len(batch)
+    for loss, deferred_loss in zip(results[0]["losses"], results[1]["losses"]):
+        assert deferred_loss.allclose(loss, atol=1e-4)
+    for hidden, deferred_hidden in zip(results[0]["hiddens"], results[1]["hiddens"]):
+        assert deferred_hidden.allclose(hidden, atol=1e-5)
+    for param, deferred_param in zip(g.parameters(), deferred_g.parameters()):
+        if param.grad is None:
+            assert deferred_param.grad is None
+        else:
+            assert deferred_param.grad.allclose(param.grad, atol=1e-4)
+
+    # steps are decoded one by one in eval
+    deferred_g.eval()
+    with torch.no_grad():
+        eval_results = deferred_g.process_batch(batch, h_t=h_t)
+    assert len(eval_results["decoded"]) == len(batch)
+
+
+def test_graph_updater_obs_gen_distill_factorized_graph_decoder():
+    g = GraphUpdaterObsGen()
+    losses = g.distill_factorized_graph_decoder(4, relation_rank=2, num_steps=3)
+    assert len(losses) == 3
+    assert g.graph_updater.f_d_layers is None
+    assert g.hparams.graph_decoder_rank == 4
+    assert g.hparams.graph_decoder_relation_rank == 2
+
+    # the hparams are saved in the checkpoints, so they're loaded as factorized
+    factorized_g = GraphUpdaterObsGen(**g.hparams)
+    factorized_g.load_state_dict(g.state_dict())
+    assert factorized_g.graph_updater.f_d_layers is None
+
+
+def test_graph_updater_obs_gen_collect_rnn_hiddens():
+    g = GraphUpdaterObsGen()
+    g.train()
+    batch = [
+        {
+            "obs_word_ids": torch.randint(g.num_words, (3, 10)),
+            "obs_mask": increasing_mask(3, 10),
+            "prev_action_word_ids": torch.randint(g.num_words, (3, 4)),
+            "prev_action_mask": increasing_mask(3, 4),
+            "groundtruth_obs_word_ids": torch.randint(g.num_words, (3, 10)),
+            "step_mask": torch.tensor([1.0, 1.0, float(i < 2)]),
+        }
+        for i in range(3)
+    ]
+    hiddens = g.collect_rnn_hiddens([batch, batch[:1]])
+    # 8 unmasked steps of the first batch and 3 of the second
+    assert hiddens.size() == (11, g.hparams.hidden_dim)
+    assert not hiddens.requires_grad
+    assert g.training
+
+    # the hidden states are carried over the steps of the episodes
+    g.eval()
+    with torch.no_grad():
+        expected = g.process_batch(batch)["hiddens"]
+    assert hiddens[:3].allclose(expected[0])
+    assert hiddens[6:8].allclose(expected[2][:2])
+
+    g.distill_factorized_graph_decoder(4, rnn_hiddens=hiddens, num_steps=2)
+    assert g.graph_updater.f_d_layers is None
+
+
+def test_graph_updater_obs_gen_factorized_graph_decoder():
+    g = GraphUpdaterObsGen(graph_decoder_rank=4)
+    assert g.graph_updater.f_d_layers is None
+    assert g.graph_updater.factorized_graph_decoder is not None
+    batch = [
+        {
+            "obs_word_ids": torch.randint(g.num_words, (3, 10)),
+            "obs_mask": increasing_mask(3, 10),
+            "prev_action_word_ids": torch.randint(g.num_words, (3, 4)),
+            "prev_action_mask": increasing_mask(3, 4),
+            "groundtruth_obs_word_ids": torch.randint(g.num_words, (3, 10)),
+            "step_mask": torch.ones(3),
+        }
+        for _ in range(2)
+    ]
+    torch.stack(g.process_batch(batch)["losses"]).mean().backward()
+    # the factorized graph decoder is trained
+    assert all(
+        param.grad is not None
+        for param in g.graph_updater.factorized_graph_decoder.parameters()
+    )
+
+
 def test_main(tmp_path):
     with initialize(config_path="train_graph_updater_conf"):
         cfg = compose(
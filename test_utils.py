@@ -14,6 +14,8 @@ from utils import (
     batchify,
     increasing_mask,
     load_textworld_games,
+    bf16_autocast,
+    autocast_state,
 )
 
 
@@ -69,6 +71,9 @@ def test_masked_mean():
         ).float()
     )
 
+    # fully masked sequences should be zeros, not nan's
+    assert masked_mean(batched_input, torch.zeros(2, 3)).equal(torch.zeros(2, 3))
+
 
 def test_masked_softmax():
     batched_input = torch.tensor([[1, 2, 3], [1, 1, 2], [3, 2, 1]]).float()
@@ -80,6 +85,39 @@ def test_masked_softmax():
         assert output[output != 0].equal(F.softmax(input[mask == 1], dim=0))
 
 
+def test_masked_softmax_fully_masked():
+    input = torch.rand(2, 3, requires_grad=True)
+    mask = torch.tensor([[0, 0, 0], [1, 0, 1]]).float()
+    output = masked_softmax(input, mask, dim=1)
+    # fully masked rows are all zeros, not nan's
+    assert output[0].equal(torch.zeros(3))
+    assert output[1].allclose(
+        F.softmax(input[1].masked_fill(mask[1] == 0, float("-inf")), dim=0)
+    )
+    output.sum().backward()
+    assert input.grad.isfinite().all()
+
+
+@pytest.mark.parametrize("dtype", [torch.float, torch.bfloat16])
+def test_masked_softmax_bf16_autocast(dtype):
+    input = torch.rand(3, 5)
+    mask = torch.tensor([[1, 1, 0, 0, 0], [1, 1, 1, 1, 1], [0, 1, 0, 1, 1]]).float()
+    with bf16_autocast(input.device):
+        output = masked_softmax(input.to(dtype), mask, dim=1)
+    # the softmax is always calculated in float32
+    assert output.dtype == torch.float
+    assert output.allclose(masked_softmax(input, mask, dim=1), atol=1e-2)
+
+
+def test_autocast_state():
+    device = torch.device("cpu")
+    assert autocast_state(device) == (False, None)
+    with bf16_autocast(device):
+        assert autocast_state(device) == (True, torch.bfloat16)
+    with bf16_autocast(device, enabled=False):
+        assert autocast_state(device) == (False, None)
+
+
 @pytest.mark.parametrize("size", [1, 3, 5, 7])
 def test_generate_subsequent_mask(size):
     mask = generate_square_subsequent_mask(size)
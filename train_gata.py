@@ -8,6 +8,7 @@ import itertools
 import gym
 import random
 import glob
+import copy
 
 from urllib.parse import urlparse
 from omegaconf import DictConfig, OmegaConf
@@ -27,11 +28,11 @@ from typing import (
 from textworld import EnvInfos
 from torch.utils.data import IterableDataset, DataLoader, Dataset
 
-from utils import load_textworld_games
-from layers import WordNodeRelInitMixin
+from utils import load_textworld_games, bf16_autocast
+from layers import WordNodeRelInitMixin, RelationalGraphConvolution
 from action_selector import ActionSelector
-from graph_updater import GraphUpdater
-from agent import EpsilonGreedyAgent
+from graph_updater import GraphUpdater, GraphUpdaterState
+from agent import Agent, EpsilonGreedyAgent
 from optimizers import RAdam
 from train_graph_updater import GraphUpdaterObsGen
 from callbacks import EqualModelCheckpoint, RLEarlyStopping, WandbSaveCallback
@@ -434,6 +435,19 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
         epsilon_anneal_episodes: int = 20000,
         reward_discount: float = 0.9,
         ckpt_patience: int = 3,
+        basis_first: bool = False,
+        channels_last: bool = False,
+        sparse_graph_threshold: Optional[float] = None,
+        forward_half_graph: bool = False,
+        quantized_graph_dtype: Optional[str] = None,
+        precompute_first_layer_projection: bool = False,
+        packed_text_encoding: bool = False,
+        text_encoding_cache_max_bytes: int = 0,
+        fold_word_embeddings: bool = False,
+        bf16_autocast: bool = False,
+        active_node_mode: bool = False,
+        graph_decoder_rank: Optional[int] = None,
+        graph_decoder_relation_rank: Optional[int] = None,
         word_vocab_path: Optional[str] = None,
         node_vocab_path: Optional[str] = None,
         relation_vocab_path: Optional[str] = None,
@@ -476,6 +490,19 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
             "epsilon_anneal_episodes",
             "reward_discount",
             "ckpt_patience",
+            "basis_first",
+            "channels_last",
+            "sparse_graph_threshold",
+            "forward_half_graph",
+            "quantized_graph_dtype",
+            "precompute_first_layer_projection",
+            "packed_text_encoding",
+            "text_encoding_cache_max_bytes",
+            "fold_word_embeddings",
+            "bf16_autocast",
+            "active_node_mode",
+            "graph_decoder_rank",
+            "graph_decoder_relation_rank",
         )
 
         # load the test rl data
@@ -565,6 +592,8 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
             node_name_mask,
             rel_name_word_ids,
             rel_name_mask,
+            basis_first=basis_first,
+            channels_last=channels_last,
         )
         if pretrained_graph_updater is not None:
             # load the pretrained graph encoder weights
@@ -609,6 +638,8 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
             node_name_mask,
             rel_name_word_ids,
             rel_name_mask,
+            basis_first=basis_first,
+            channels_last=channels_last,
         )
         # we don't train the target action selector
         for param in self.target_action_selector.parameters():
@@ -637,15 +668,54 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
                 node_name_mask,
                 rel_name_word_ids,
                 rel_name_mask,
+                graph_decoder_rank=graph_decoder_rank,
+                graph_decoder_relation_rank=graph_decoder_relation_rank,
+                basis_first=basis_first,
+                channels_last=channels_last,
             )
         else:
             self.graph_updater = pretrained_graph_updater
+            # the pretrained graph updater comes from GraphUpdaterObsGen, and
+            # we don't need the extra outputs for pretraining
+            self.graph_updater.pretraining = False
+            # the dense graph decoder of the pretrained graph updater has to be
+            # distilled beforehand, e.g. by distill_graph_decoder.py
+            assert (
+                graph_decoder_rank is None
+                or self.graph_updater.factorized_graph_decoder is not None
+            ), "graph_decoder_rank is set, but the pretrained graph decoder is dense"
+        # if True, the graph updater only decodes the forward half of the relations
+        self.graph_updater.forward_half_graph = forward_half_graph
+        # if set, e.g. "int8" or "bfloat16", the decoded graphs are quantized
+        self.graph_updater.quantized_graph_dtype = (
+            None
+            if quantized_graph_dtype is None
+            else getattr(torch, quantized_graph_dtype)
+        )
         # we use graph updater only to get the current graph representations
         self.graph_updater.eval()
         # we don't want to train the graph updater
         for param in self.graph_updater.parameters():
             param.requires_grad = False
 
+        for encoder in [
+            self.action_selector,
+            self.target_action_selector,
+            self.graph_updater,
+        ]:
+            # sparsify the graphs before encoding them if the threshold is set
+            encoder.sparse_graph_threshold = sparse_graph_threshold
+            # project the static graph features by the first R-GCN layer only once
+            encoder.precompute_first_layer_projection = (
+                precompute_first_layer_projection
+            )
+            # skip the paddings of the text with PackedSequences
+            encoder.packed_text_encoding = packed_text_encoding
+            # cache the encoded text when the text encoder is frozen or in eval mode
+            encoder.text_encoding_cache_max_bytes = text_encoding_cache_max_bytes
+            # fold the word embeddings into lookup tables when we don't need gradients
+            encoder.fold_word_embeddings = fold_word_embeddings
+
         # loss
         self.smooth_l1_loss = nn.SmoothL1Loss(reduction="none")
 
@@ -658,6 +728,8 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
             self.hparams.epsilon_anneal_to,  # type: ignore
             self.hparams.epsilon_anneal_episodes,  # type: ignore
         )
+        self.agent.bf16_autocast = bf16_autocast
+        self.agent.active_node_mode = active_node_mode
 
         # replay buffer
         self.replay_buffer = ReplayBuffer(
@@ -711,26 +783,35 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
             'action_scores: (batch, num_action_cands),
             'rnn_curr_hidden': (batch, hidden_dim),
             'current_graph': (batch, num_relation, num_node, num_node)
+                or QuantizedAdjacency if quantized_graph_dtype is set
         }
         """
-        results = self.graph_updater(
-            obs_word_ids,
-            prev_action_word_ids,
-            obs_mask,
-            prev_action_mask,
-            rnn_prev_hidden=rnn_prev_hidden,
-        )
-        return {
-            "action_scores": self.action_selector(
+        with bf16_autocast(
+            self.device, enabled=self.hparams.bf16_autocast  # type: ignore
+        ):
+            results = self.graph_updater(
+                obs_word_ids,
+                prev_action_word_ids,
+                obs_mask,
+                prev_action_mask,
+                rnn_prev_hidden=rnn_prev_hidden,
+            )
+            action_scores = self.action_selector(
                 obs_word_ids,
                 obs_mask,
                 results["g_t"],
                 action_cand_word_ids,
                 action_cand_mask,
                 action_mask,
-            ),
-            "rnn_curr_hidden": results["h_t"],
-            "current_graph": results["g_t"],
+            )
+        current_graph = results["g_t"]
+        if isinstance(current_graph, torch.Tensor):
+            current_graph = current_graph.float()
+        # cast back to float32 for the losses
+        return {
+            "action_scores": action_scores.float(),
+            "rnn_curr_hidden": results["h_t"].float(),
+            "current_graph": current_graph,
         }
 
     @staticmethod
@@ -791,14 +872,17 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
             )
 
             # calculate the next q values using the target action selector
-            next_tgt_action_scores = self.target_action_selector(
-                batch["next_obs_word_ids"],
-                batch["next_obs_mask"],
-                next_results["current_graph"],
-                batch["next_action_cand_word_ids"],
-                batch["next_action_cand_mask"],
-                batch["next_action_mask"],
-            )
+            with bf16_autocast(
+                self.device, enabled=self.hparams.bf16_autocast  # type: ignore
+            ):
+                next_tgt_action_scores = self.target_action_selector(
+                    batch["next_obs_word_ids"],
+                    batch["next_obs_mask"],
+                    next_results["current_graph"],
+                    batch["next_action_cand_word_ids"],
+                    batch["next_action_cand_mask"],
+                    batch["next_action_mask"],
+                ).float()
             # Note: no need to mask the next Q values as
             # "done" states are not even added to the replay buffer
             next_q_values = self.get_q_values(
@@ -846,15 +930,15 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
 
     def eval_step(self, env: gym.Env) -> Dict[str, torch.Tensor]:  # type: ignore
         prev_actions: Optional[List[str]] = None
-        rnn_prev_hidden: Optional[torch.Tensor] = None
+        prev_state: Optional[GraphUpdaterState] = None
         obs, infos = env.reset()
         steps: List[int] = [0] * len(obs)
         for step in itertools.count():
-            actions, rnn_prev_hidden = self.agent.act(
+            actions, prev_state = self.agent.act_with_state(
                 obs,
                 infos["admissible_commands"],
                 prev_actions=prev_actions,
-                rnn_prev_hidden=rnn_prev_hidden,
+                prev_state=prev_state,
             )
             obs, rewards, dones, infos = env.step(actions)
             for i, done in enumerate(dones):
@@ -1048,6 +1132,8 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
             self.hparams.hidden_dim,  # type: ignore
             device=self.device,
         )
+        # the state of the graph updater to reuse the previous graph
+        prev_state = GraphUpdaterState(rnn_prev_hidden)
         prev_actions: List[str] = ["restart"] * self.train_env.batch_size
         prev_cum_rewards: List[int] = [0] * self.train_env.batch_size
         dones: List[bool] = [False] * self.train_env.batch_size
@@ -1070,7 +1156,7 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
                 obs,
                 action_cands,
                 prev_actions=prev_actions,
-                rnn_prev_hidden=rnn_prev_hidden,
+                prev_state=prev_state,
             )
 
             # select actions randomly
@@ -1117,6 +1203,7 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
             prev_actions = actions
             prev_cum_rewards = cum_rewards
             rnn_prev_hidden = rnn_curr_hidden
+            prev_state = results["state"]
             episode_end_fn()
 
         # push transitions into the buffer
@@ -1198,6 +1285,48 @@ class GATADoubleDQN(WordNodeRelInitMixin, pl.LightningModule):
         }
 
 
+def quantize_dynamic_agent(
+    gata_double_dqn: GATADoubleDQN, dtype: torch.dtype = torch.qint8
+) -> Agent:
+    """
+    Return an agent for CPU inference with copies of the graph updater and
+    action selector of the given GATADoubleDQN, whose linear layers are dynamically
+    quantized, i.e. their weights are quantized ahead of time and their inputs
+    are quantized on the fly.
+
+    The linear layers of the R-GCN's are not quantized, b/c their weights are
+    split and gathered directly, and they're small anyway.
+    """
+    quantized: List[nn.Module] = []
+    for module in [gata_double_dqn.graph_updater, gata_double_dqn.action_selector]:
+        module = copy.deepcopy(module).cpu().eval()
+        rgcn_linear_names = {
+            f"{name}.{linear_name}"
+            for name, submodule in module.named_modules()
+            if isinstance(submodule, RelationalGraphConvolution)
+            for linear_name, linear in submodule.named_modules()
+            if isinstance(linear, nn.Linear)
+        }
+        linear_names = {
+            name
+            for name, submodule in module.named_modules()
+            if isinstance(submodule, nn.Linear) and name not in rgcn_linear_names
+        }
+        quantized.append(
+            torch.ao.quantization.quantize_dynamic(module, linear_names, dtype=dtype)
+        )
+    graph_updater, action_selector = quantized
+    agent = Agent(
+        graph_updater,  # type: ignore
+        action_selector,  # type: ignore
+        gata_double_dqn.preprocessor,
+    )
+    # behave the same as the agent of gata_double_dqn
+    agent.active_node_mode = gata_double_dqn.agent.active_node_mode
+    agent.bf16_autocast = gata_double_dqn.agent.bf16_autocast
+    return agent
+
+
 @hydra.main(config_path="train_gata_conf", config_name="config")
 def main(cfg: DictConfig) -> None:
     print(f"Training with the following config:\n{OmegaConf.to_yaml(cfg)}")
@@ -1240,6 +1369,8 @@ def main(cfg: DictConfig) -> None:
                 relation_vocab_path=(
                     cfg.model.pretrained_graph_updater.relation_vocab_path
                 ),
+                basis_first=cfg.model.basis_first,
+                channels_last=cfg.model.channels_last,
             )
             lm_model_config[
                 "pretrained_graph_updater"
@@ -1,13 +1,15 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import pytorch_lightning as pl
 import hydra
 import random
 import wandb
 import math
 
+from dataclasses import dataclass, fields, replace
 from urllib.parse import urlparse
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Any, Iterable
 from omegaconf import DictConfig, OmegaConf
 from hydra.utils import instantiate, to_absolute_path
 from pytorch_lightning.callbacks import ModelCheckpoint
@@ -16,18 +18,52 @@ from torch.optim.lr_scheduler import LambdaLR
 
 from utils import (
     load_fasttext,
-    generate_square_subsequent_mask,
     calculate_seq_f1,
     batchify,
+    bf16_autocast,
 )
 from preprocessor import BOS, EOS
-from graph_updater import GraphUpdater
-from layers import PositionalEncoderTensor2Tensor, WordNodeRelInitMixin
+from graph_updater import GraphUpdater, GraphUpdaterState
+from layers import (
+    PositionalEncoderTensor2Tensor,
+    MaskedMultiheadAttention,
+    WordNodeRelInitMixin,
+    checkpoint_module,
+)
 from optimizers import RAdam
 from graph_updater_data import GraphUpdaterObsGenDataModule
 from callbacks import WandbSaveCallback
 
 
+@dataclass
+class TextDecoderBlockCache:
+    """
+    Cached projected keys and values of a TextDecoderBlock for incremental decoding.
+    The self attention keys and values grow by one position per decoding step,
+    while the ones of the nodes and previous actions don't change while decoding.
+    """
+
+    # (batch, decoded_len, hidden_dim)
+    self_attn_key: torch.Tensor
+    self_attn_value: torch.Tensor
+    # (batch, num_node, hidden_dim)
+    node_key: torch.Tensor
+    node_value: torch.Tensor
+    # (batch, prev_action_len, hidden_dim)
+    prev_action_key: torch.Tensor
+    prev_action_value: torch.Tensor
+
+    def index_select(self, ids: torch.Tensor) -> "TextDecoderBlockCache":
+        """
+        Select the rows of the batch, e.g. to drop the finished sequences.
+
+        ids: indices or boolean mask of the rows to select
+        """
+        return TextDecoderBlockCache(
+            *(getattr(self, field.name)[ids] for field in fields(self))
+        )
+
+
 class TextDecoderBlock(nn.Module):
     def __init__(self, hidden_dim: int, num_heads: int) -> None:
         super().__init__()
@@ -35,10 +71,10 @@ class TextDecoderBlock(nn.Module):
         self.num_heads = num_heads
 
         self.pos_encoder = PositionalEncoderTensor2Tensor(hidden_dim, 512)
-        self.self_attn = nn.MultiheadAttention(hidden_dim, num_heads)
+        self.self_attn = MaskedMultiheadAttention(hidden_dim, num_heads)
         self.self_attn_layer_norm = nn.LayerNorm(hidden_dim)
-        self.node_attn = nn.MultiheadAttention(hidden_dim, num_heads)
-        self.prev_action_attn = nn.MultiheadAttention(hidden_dim, num_heads)
+        self.node_attn = MaskedMultiheadAttention(hidden_dim, num_heads)
+        self.prev_action_attn = MaskedMultiheadAttention(hidden_dim, num_heads)
         self.combine_node_prev_action = nn.Sequential(
             nn.Linear(2 * hidden_dim, hidden_dim), nn.ReLU()
         )
@@ -66,64 +102,38 @@ class TextDecoderBlock(nn.Module):
 
         output: (batch, input_seq_len, hidden_dim)
         """
-        # calculate attention mask for decoding
-        # this is the mask that prevents MultiheadAttention
-        # from attending to future values
-        input_seq_len = input.size(1)
-        attn_mask = generate_square_subsequent_mask(input_seq_len).to(input.device)
-        # (input_seq_len, input_seq_len)
-
         # add the positional encodings
         pos_encoded_input = self.pos_encoder(input)
 
         # self attention layer
-        input_residual = pos_encoded_input
-        # MultiheadAttention expects batch dim to be 1 for q, k, v
-        # but 0 for key_padding_mask, so we need to transpose
-        transposed_pos_encoded_input = pos_encoded_input.transpose(0, 1)
-        input_attn, _ = self.self_attn(
-            transposed_pos_encoded_input,
-            transposed_pos_encoded_input,
-            transposed_pos_encoded_input,
-            key_padding_mask=input_mask == 0,
-            attn_mask=attn_mask,
-        )
-        input_attn = input_attn.transpose(0, 1)
+        # causal, so that the input doesn't attend to future values
+        input_attn = self.self_attn(
+            pos_encoded_input,
+            pos_encoded_input,
+            pos_encoded_input,
+            key_mask=input_mask,
+            causal=True,
+        )
         input_attn *= input_mask.unsqueeze(-1)
-        input_attn += input_residual
+        input_attn += pos_encoded_input
         # (batch, input_seq_len, hidden_dim)
 
         # calculate self attention for the nodes and previous action
-        # strictly speaking, we should calculate attention masks for these
-        # based on input_mask, but due to this bug:
-        # https://github.com/pytorch/pytorch/issues/41508
-        # it returns nan's if we apply attention masks. So let's just skip it.
-        # It's OK, b/c we apply input_mask when we combine these.
+        # the outputs for the masked input are masked by input_mask
+        # when we combine these.
         # apply layer norm to the input self attention output to calculate the query
-        query = self.self_attn_layer_norm(input_attn).transpose(0, 1)
-        # (input_seq_len, batch, hidden_dim)
+        query = self.self_attn_layer_norm(input_attn)
+        # (batch, input_seq_len, hidden_dim)
 
         # self attention for the nodes
-        # no key_padding_mask, since we use all the nodes
-        # (batch * num_heads, input_seq_len, num_node)
-        transposed_node_hidden = node_hidden.transpose(0, 1)
-        node_attn, _ = self.node_attn(
-            query, transposed_node_hidden, transposed_node_hidden
-        )
-        node_attn = node_attn.transpose(0, 1)
+        # no key_mask, since we use all the nodes
+        node_attn = self.node_attn(query, node_hidden, node_hidden)
         # (batch, input_seq_len, hidden_dim)
 
         # self attention for the previous action
-        # key_padding_mask is from prev_action_mask
-        # (batch * num_heads, input_seq_len, prev_action_len)
-        transposed_prev_action_hidden = prev_action_hidden.transpose(0, 1)
-        prev_action_attn, _ = self.prev_action_attn(
-            query,
-            transposed_prev_action_hidden,
-            transposed_prev_action_hidden,
-            key_padding_mask=prev_action_mask == 0,
-        )
-        prev_action_attn = prev_action_attn.transpose(0, 1)
+        prev_action_attn = self.prev_action_attn(
+            query, prev_action_hidden, prev_action_hidden, key_mask=prev_action_mask
+        )
         # (batch, input_seq_len, hidden_dim)
 
         # combine self attention for the previous action and nodes with
@@ -131,7 +141,8 @@ class TextDecoderBlock(nn.Module):
         combined_self_attn = self.combine_node_prev_action(
             torch.cat([prev_action_attn, node_attn], dim=-1)
         )
-        combined_self_attn *= input_mask.unsqueeze(-1)
+        # not in-place, b/c the ReLU backward needs its output
+        combined_self_attn = combined_self_attn * input_mask.unsqueeze(-1)
         combined_self_attn += input_attn
         # (batch, input_seq_len, hidden_dim)
 
@@ -143,12 +154,116 @@ class TextDecoderBlock(nn.Module):
 
         return output
 
+    def init_cache(
+        self, node_hidden: torch.Tensor, prev_action_hidden: torch.Tensor
+    ) -> TextDecoderBlockCache:
+        """
+        Project the keys and values of the nodes and previous actions,
+        and start with empty self attention keys and values.
+
+        node_hidden: (batch, num_node, hidden_dim)
+        prev_action_hidden: (batch, prev_action_len, hidden_dim)
+        """
+        node_key, node_value = self.node_attn.project_key_value(
+            node_hidden, node_hidden
+        )
+        prev_action_key, prev_action_value = self.prev_action_attn.project_key_value(
+            prev_action_hidden, prev_action_hidden
+        )
+        empty = node_key.new_empty(node_key.size(0), 0, node_key.size(2))
+        return TextDecoderBlockCache(
+            empty, empty, node_key, node_value, prev_action_key, prev_action_value
+        )
+
+    def incremental_forward(
+        self,
+        input: torch.Tensor,
+        input_mask: torch.Tensor,
+        prev_action_mask: torch.Tensor,
+        cache: TextDecoderBlockCache,
+    ) -> Tuple[torch.Tensor, TextDecoderBlockCache]:
+        """
+        Same as forward(), but only for the last position of the input, attending to
+        the cached keys and values of the previous positions. The outputs of the
+        previous positions don't change, since the self attention is causal.
+
+        input: the last position, (batch, 1, hidden_dim)
+        input_mask: the mask of all the positions so far, (batch, input_seq_len)
+        prev_action_mask: (batch, prev_action_len)
+        cache: the cache of the previous positions, see init_cache()
+
+        output: (
+            output of the last position: (batch, 1, hidden_dim),
+            updated cache,
+        )
+        """
+        # add the positional encoding of the last position
+        position = input_mask.size(1) - 1
+        pos_encoded_input = (
+            input
+            + self.pos_encoder.get_pe(position + 1, input.dtype, input.device)[position]
+        )
+        last_input_mask = input_mask[:, -1:].unsqueeze(-1)
+        # (batch, 1, 1)
+
+        # self attention layer
+        # the last position attends to all the positions, so no causal mask
+        q, k, v = F.linear(
+            pos_encoded_input,
+            self.self_attn.in_proj_weight,
+            self.self_attn.in_proj_bias,
+        ).chunk(3, dim=-1)
+        self_attn_key = torch.cat([cache.self_attn_key, k], dim=1)
+        self_attn_value = torch.cat([cache.self_attn_value, v], dim=1)
+        # (batch, input_seq_len, hidden_dim)
+        input_attn = self.self_attn.attend(
+            q, self_attn_key, self_attn_value, key_mask=input_mask
+        )
+        input_attn *= last_input_mask
+        input_attn += pos_encoded_input
+        # (batch, 1, hidden_dim)
+
+        query = self.self_attn_layer_norm(input_attn)
+        node_attn = self.node_attn.attend(
+            self.node_attn.project_query(query), cache.node_key, cache.node_value
+        )
+        prev_action_attn = self.prev_action_attn.attend(
+            self.prev_action_attn.project_query(query),
+            cache.prev_action_key,
+            cache.prev_action_value,
+            key_mask=prev_action_mask,
+        )
+        # (batch, 1, hidden_dim)
+
+        combined_self_attn = self.combine_node_prev_action(
+            torch.cat([prev_action_attn, node_attn], dim=-1)
+        )
+        combined_self_attn = combined_self_attn * last_input_mask
+        combined_self_attn += input_attn
+        # (batch, 1, hidden_dim)
+
+        output = self.linear_layer_norm(combined_self_attn)
+        output = self.linear_layers(output)
+        output += combined_self_attn
+        # (batch, 1, hidden_dim)
+
+        return output, replace(
+            cache, self_attn_key=self_attn_key, self_attn_value=self_attn_value
+        )
+
 
 class TextDecoder(nn.Module):
     def __init__(
-        self, num_dec_blocks: int, dec_block_hidden_dim: int, dec_block_num_heads: int
+        self,
+        num_dec_blocks: int,
+        dec_block_hidden_dim: int,
+        dec_block_num_heads: int,
+        gradient_checkpointing: bool = False,
     ) -> None:
         super().__init__()
+        # if True, decoder blocks are activation checkpointed during training.
+        # See checkpoint_module() for more details.
+        self.gradient_checkpointing = gradient_checkpointing
         self.dec_blocks = nn.ModuleList(
             TextDecoderBlock(dec_block_hidden_dim, dec_block_num_heads)
             for _ in range(num_dec_blocks)
@@ -174,13 +289,65 @@ class TextDecoder(nn.Module):
         # (batch_size, input_seq_len, hidden_dim)
         output = input
         for dec_block in self.dec_blocks:
-            output = dec_block(
-                output, input_mask, node_hidden, prev_action_hidden, prev_action_mask
+            output = checkpoint_module(
+                self.gradient_checkpointing,
+                dec_block,
+                output,
+                input_mask,
+                node_hidden,
+                prev_action_hidden,
+                prev_action_mask,
             )
         # (batch_size, input_seq_len, hidden_dim)
 
         return output
 
+    def init_cache(
+        self, node_hidden: torch.Tensor, prev_action_hidden: torch.Tensor
+    ) -> List[TextDecoderBlockCache]:
+        """
+        node_hidden: (batch, num_node, hidden_dim)
+        prev_action_hidden: (batch, prev_action_len, hidden_dim)
+
+        output: the caches of the decoder blocks for incremental_forward()
+        """
+        return [
+            dec_block.init_cache(node_hidden, prev_action_hidden)
+            for dec_block in self.dec_blocks
+        ]
+
+    def incremental_forward(
+        self,
+        input: torch.Tensor,
+        input_mask: torch.Tensor,
+        prev_action_mask: torch.Tensor,
+        caches: List[TextDecoderBlockCache],
+    ) -> Tuple[torch.Tensor, List[TextDecoderBlockCache]]:
+        """
+        Decode only the last position of the input.
+        See TextDecoderBlock.incremental_forward() for more details.
+
+        input: the last position, (batch, 1, hidden_dim)
+        input_mask: the mask of all the positions so far, (batch, input_seq_len)
+        prev_action_mask: (batch, prev_action_len)
+        caches: the caches of the decoder blocks, see init_cache()
+
+        output: (
+            output of the last position: (batch, 1, hidden_dim),
+            updated caches,
+        )
+        """
+        output = input
+        updated_caches: List[TextDecoderBlockCache] = []
+        for dec_block, cache in zip(self.dec_blocks, caches):
+            output, cache = dec_block.incremental_forward(
+                output, input_mask, prev_action_mask, cache
+            )
+            updated_caches.append(cache)
+        # (batch_size, 1, hidden_dim)
+
+        return output, updated_caches
+
 
 class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
     def __init__(
@@ -201,6 +368,22 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
         sample_k_gen_obs: int = 5,
         max_decode_len: int = 200,
         steps_for_lr_warmup: int = 10000,
+        basis_first: bool = False,
+        channels_last: bool = False,
+        sparse_graph_threshold: Optional[float] = None,
+        forward_half_graph: bool = False,
+        precompute_first_layer_projection: bool = False,
+        packed_text_encoding: bool = False,
+        text_encoding_cache_max_bytes: int = 0,
+        gradient_checkpointing: bool = False,
+        fold_word_embeddings: bool = False,
+        bf16_autocast: bool = False,
+        graph_decoder_rank: Optional[int] = None,
+        graph_decoder_relation_rank: Optional[int] = None,
+        time_parallel_text_encoding: bool = False,
+        deferred_text_decoding: bool = False,
+        kv_cached_greedy_decode: bool = False,
+        compact_greedy_decode: bool = False,
         pretrained_word_embedding_path: Optional[str] = None,
         word_vocab_path: Optional[str] = None,
         node_vocab_path: Optional[str] = None,
@@ -225,6 +408,22 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
             "sample_k_gen_obs",
             "max_decode_len",
             "steps_for_lr_warmup",
+            "basis_first",
+            "channels_last",
+            "sparse_graph_threshold",
+            "forward_half_graph",
+            "precompute_first_layer_projection",
+            "packed_text_encoding",
+            "text_encoding_cache_max_bytes",
+            "gradient_checkpointing",
+            "fold_word_embeddings",
+            "bf16_autocast",
+            "graph_decoder_rank",
+            "graph_decoder_relation_rank",
+            "time_parallel_text_encoding",
+            "deferred_text_decoding",
+            "kv_cached_greedy_decode",
+            "compact_greedy_decode",
         )
 
         # initialize word (preprocessor), node and relation stuff
@@ -273,12 +472,28 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
             node_name_mask,
             rel_name_word_ids,
             rel_name_mask,
+            gradient_checkpointing=gradient_checkpointing,
+            graph_decoder_rank=graph_decoder_rank,
+            graph_decoder_relation_rank=graph_decoder_relation_rank,
+            basis_first=basis_first,
+            channels_last=channels_last,
         )
         self.graph_updater.pretraining = True
+        self.graph_updater.sparse_graph_threshold = sparse_graph_threshold
+        self.graph_updater.forward_half_graph = forward_half_graph
+        self.graph_updater.precompute_first_layer_projection = (
+            precompute_first_layer_projection
+        )
+        self.graph_updater.packed_text_encoding = packed_text_encoding
+        self.graph_updater.text_encoding_cache_max_bytes = text_encoding_cache_max_bytes
+        self.graph_updater.fold_word_embeddings = fold_word_embeddings
 
         # text decoder
         self.text_decoder = TextDecoder(
-            text_decoder_num_blocks, hidden_dim, text_decoder_num_heads
+            text_decoder_num_blocks,
+            hidden_dim,
+            text_decoder_num_heads,
+            gradient_checkpointing=gradient_checkpointing,
         )
         self.target_word_prj = nn.Linear(hidden_dim, self.num_words, bias=False)
         self.ce_loss = nn.CrossEntropyLoss(
@@ -289,7 +504,11 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
         self,
         episode_data: Dict[str, torch.Tensor],
         rnn_prev_hidden: Optional[torch.Tensor] = None,
-    ) -> Dict[str, torch.Tensor]:
+        prev_state: Optional[GraphUpdaterState] = None,
+        encoded_obs: Optional[torch.Tensor] = None,
+        encoded_prev_action: Optional[torch.Tensor] = None,
+        decode: bool = True,
+    ) -> Dict[str, Any]:
         """
         episode_data:
         {
@@ -300,51 +519,75 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
             'groundtruth_obs_word_ids': tensor of shape (batch, obs_len),
         }
         rnn_prev_hidden: (batch, hidden_dim)
+        prev_state: 'state' of the output of the previous step, which can be given
+            instead of rnn_prev_hidden to reuse its decoded and encoded graph.
+        encoded_obs: (batch, obs_len, hidden_dim), if given, used instead of
+            encoding the observations.
+        encoded_prev_action: (batch, prev_action_len, hidden_dim), if given, used
+            instead of encoding the previous actions.
+        decode: if False, the text decoder is not run, and the output has
+            the decoder inputs 'prj_obs', 'h_ga' and 'h_ag' of the graph updater
+            instead of 'batch_loss', so that the steps of a truncated BPTT window
+            can be decoded at once by deferred_decode_losses(). Only for training.
 
         output:
         {
             'h_t': hidden state of the rnn cell at time t; (batch, hidden_dim),
+            'state': GraphUpdaterState of the graph updater at time t,
             'batch_loss': batch loss for this episode data. (batch),
             'pred_obs_word_ids': predicted observation word IDs. Only for eval.
                 (batch, obs_len),
             'decoded_obs_word_ids': decoded observation word IDs. Only for eval.
                 (batch, obs_len),
+            'decode_active_fraction': average active batch fraction of the greedy
+                decoding. Only for eval. See greedy_decode_with_active_fraction().
         }
         """
-        # graph updater
-        graph_updater_results = self.graph_updater(
-            episode_data["obs_word_ids"],
-            episode_data["prev_action_word_ids"],
-            episode_data["obs_mask"],
-            episode_data["prev_action_mask"],
-            rnn_prev_hidden=rnn_prev_hidden,
-        )
-
-        # decode
-        decoder_output = self.text_decoder(
-            graph_updater_results["prj_obs"],
-            episode_data["obs_mask"],
-            graph_updater_results["h_ga"],
-            graph_updater_results["h_ag"],
-            episode_data["prev_action_mask"],
-        )
-        # (batch, obs_len, hidden_dim)
-        decoder_output = self.target_word_prj(decoder_output)
-        # (batch, obs_len, num_words)
-
-        batch_size = decoder_output.size(0)
-        batch_loss = (
-            self.ce_loss(
-                decoder_output.view(-1, decoder_output.size(-1)),
-                episode_data["groundtruth_obs_word_ids"].flatten(),
+        with bf16_autocast(
+            self.device, enabled=self.hparams.bf16_autocast  # type: ignore
+        ):
+            # graph updater
+            graph_updater_results = self.graph_updater(
+                episode_data["obs_word_ids"],
+                episode_data["prev_action_word_ids"],
+                episode_data["obs_mask"],
+                episode_data["prev_action_mask"],
+                rnn_prev_hidden=rnn_prev_hidden,
+                prev_state=prev_state,
+                encoded_obs=encoded_obs,
+                encoded_prev_action=encoded_prev_action,
             )
-            .view(batch_size, -1)
-            .sum(dim=1)
+            if not decode:
+                assert self.training
+                return {
+                    "h_t": graph_updater_results["h_t"].detach().float(),
+                    "state": graph_updater_results["state"],
+                    "prj_obs": graph_updater_results["prj_obs"],
+                    "h_ga": graph_updater_results["h_ga"],
+                    "h_ag": graph_updater_results["h_ag"],
+                }
+
+            # decode
+            decoder_output = self.text_decoder(
+                graph_updater_results["prj_obs"],
+                episode_data["obs_mask"],
+                graph_updater_results["h_ga"],
+                graph_updater_results["h_ag"],
+                episode_data["prev_action_mask"],
+            )
+            # (batch, obs_len, hidden_dim)
+            decoder_output = self.target_word_prj(decoder_output)
+            # (batch, obs_len, num_words)
+        # calculate the loss in float32
+        decoder_output = decoder_output.float()
+        batch_loss = self.calculate_batch_loss(
+            decoder_output, episode_data["groundtruth_obs_word_ids"]
         )
         # (batch)
 
         results = {
-            "h_t": graph_updater_results["h_t"].detach(),
+            "h_t": graph_updater_results["h_t"].detach().float(),
+            "state": graph_updater_results["state"],
             "batch_loss": batch_loss,
         }
 
@@ -360,15 +603,119 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
             .detach()
         )
         # (batch, obs_len)
-        results["decoded_obs_word_ids"] = self.greedy_decode(
-            graph_updater_results["h_ga"],
-            graph_updater_results["h_ag"],
-            episode_data["prev_action_mask"],
-        )
+        with bf16_autocast(
+            self.device, enabled=self.hparams.bf16_autocast  # type: ignore
+        ):
+            (
+                results["decoded_obs_word_ids"],
+                results["decode_active_fraction"],
+            ) = self.greedy_decode_with_active_fraction(
+                graph_updater_results["h_ga"],
+                graph_updater_results["h_ag"],
+                episode_data["prev_action_mask"],
+            )
         # (batch, decoded_len)
 
         return results
 
+    def calculate_batch_loss(
+        self, decoder_output: torch.Tensor, groundtruth_obs_word_ids: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        decoder_output: (batch, obs_len, num_words)
+        groundtruth_obs_word_ids: (batch, obs_len)
+
+        output: (batch)
+        """
+        batch_size = decoder_output.size(0)
+        return (
+            self.ce_loss(
+                decoder_output.view(-1, decoder_output.size(-1)),
+                groundtruth_obs_word_ids.flatten(),
+            )
+            .view(batch_size, -1)
+            .sum(dim=1)
+        )
+
+    def deferred_decode_losses(
+        self,
+        batch: List[Dict[str, torch.Tensor]],
+        step_results: List[Dict[str, Any]],
+    ) -> List[torch.Tensor]:
+        """
+        Run the text decoder, the target word projection and the loss once for all
+        the steps of a truncated BPTT window, instead of once for each step.
+        The steps are concatenated along the batch dimension without the ones masked
+        by step_mask, and padded to the same lengths, which doesn't affect
+        the unmasked outputs of the decoder.
+
+        batch: the batch of process_batch()
+        step_results: the outputs of forward() with decode=False for the steps
+
+        output: [scalar masked mean batch loss, ...], the same as 'losses' of
+            process_batch()
+        """
+        row_ids = [step["step_mask"].nonzero(as_tuple=True)[0] for step in batch]
+        obs_len = max(step["obs_mask"].size(1) for step in batch)
+        prev_action_len = max(step["prev_action_mask"].size(1) for step in batch)
+
+        def pad_cat(
+            tensors: List[torch.Tensor], seq_len: int, value: float = 0
+        ) -> torch.Tensor:
+            # (batch, step_seq_len, *) => (num_rows, seq_len, *)
+            return torch.cat(
+                [
+                    F.pad(
+                        tensor[ids],
+                        (0, 0) * (tensor.dim() - 2) + (0, seq_len - tensor.size(1)),
+                        value=value,
+                    )
+                    for tensor, ids in zip(tensors, row_ids)
+                ]
+            )
+
+        obs_mask = pad_cat([step["obs_mask"] for step in batch], obs_len)
+        # (num_rows, obs_len)
+        prev_action_mask = pad_cat(
+            [step["prev_action_mask"] for step in batch], prev_action_len
+        )
+        # (num_rows, prev_action_len)
+        with bf16_autocast(
+            self.device, enabled=self.hparams.bf16_autocast  # type: ignore
+        ):
+            decoder_output = self.text_decoder(
+                pad_cat([results["prj_obs"] for results in step_results], obs_len),
+                obs_mask,
+                torch.cat(
+                    [
+                        results["h_ga"][ids]
+                        for results, ids in zip(step_results, row_ids)
+                    ]
+                ),
+                pad_cat([results["h_ag"] for results in step_results], prev_action_len),
+                prev_action_mask,
+            )
+            # (num_rows, obs_len, hidden_dim)
+            decoder_output = self.target_word_prj(decoder_output)
+            # (num_rows, obs_len, num_words)
+        # calculate the loss in float32
+        row_losses = self.calculate_batch_loss(
+            decoder_output.float(),
+            pad_cat(
+                [step["groundtruth_obs_word_ids"] for step in batch],
+                obs_len,
+                value=self.preprocessor.pad_id,
+            ),
+        )
+        # (num_rows)
+        return [
+            torch.sum(step_row_losses * step["step_mask"][ids])
+            / step["step_mask"].sum()
+            for step, ids, step_row_losses in zip(
+                batch, row_ids, row_losses.split([ids.size(0) for ids in row_ids])
+            )
+        ]
+
     def greedy_decode(
         self,
         node_hidden: torch.Tensor,
@@ -383,49 +730,118 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
 
         output: (batch, decoded_len)
         """
-        # start with bos tokens
+        return self.greedy_decode_with_active_fraction(
+            node_hidden, prev_action_hidden, prev_action_mask
+        )[0]
+
+    def greedy_decode_with_active_fraction(
+        self,
+        node_hidden: torch.Tensor,
+        prev_action_hidden: torch.Tensor,
+        prev_action_mask: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Same as greedy_decode(), but also return the average fraction of the batch
+        that hasn't reached eos over the decoding steps, i.e. the fraction of the
+        decoding work that's left when the finished sequences are dropped from
+        the working batch (compact_greedy_decode).
+
+        node_hidden: (batch, num_node, hidden_dim)
+        prev_action_hidden: (batch, prev_action_len, hidden_dim)
+        prev_action_mask: (batch, prev_action_len)
+
+        output: (
+            decoded word ids: (batch, decoded_len),
+            average active batch fraction: scalar,
+        )
+        """
         batch_size = node_hidden.size(0)
+        max_decode_len = self.hparams.max_decode_len  # type: ignore
         bos_id = self.preprocessor.word_to_id(BOS)
-        decoded_word_ids = torch.tensor(
-            [[bos_id] for _ in range(batch_size)], device=self.device
-        )
-        # (batch, 1)
         eos_id = self.preprocessor.word_to_id(EOS)
+        pad_id = self.preprocessor.pad_id
+        # start with bos tokens, and fill the rest with padding
+        # so that the sequences that have reached eos are padded.
+        decoded_word_ids = torch.full(
+            (batch_size, max_decode_len + 1),
+            pad_id,
+            dtype=torch.long,
+            device=self.device,
+        )
+        decoded_word_ids[:, 0] = bos_id
+        # (batch, max_decode_len + 1)
+        decoded_len = 1
+        # the rows of decoded_word_ids in the working batch. if compact_greedy_decode,
+        # the sequences that have reached eos are dropped from the working batch
+        # with their node and previous action hiddens and decoder caches.
+        active_ids = torch.arange(batch_size, device=self.device)
+        # (active_batch)
         eos_mask = torch.tensor([False] * batch_size, device=self.device)
-        # (batch)
-        for _ in range(self.hparams.max_decode_len):  # type: ignore
-            input = self.graph_updater.word_embeddings(decoded_word_ids)
-            # (batch, curr_decode_len, hidden_dim)
-            input_mask = decoded_word_ids.ne(self.preprocessor.pad_id).float()
-            # (batch, curr_decode_len)
-            decoder_output = self.target_word_prj(
-                self.text_decoder(
-                    input, input_mask, node_hidden, prev_action_hidden, prev_action_mask
+        # (active_batch)
+        num_active = torch.tensor(0, device=self.device)
+        if self.hparams.kv_cached_greedy_decode:  # type: ignore
+            # only decode the newest position every step, reusing the keys and
+            # values of the previous positions and the nodes and previous actions
+            caches = self.text_decoder.init_cache(node_hidden, prev_action_hidden)
+        for _ in range(max_decode_len):
+            num_active += eos_mask.logical_not().sum()
+            curr_decoded_word_ids = decoded_word_ids[active_ids, :decoded_len]
+            # (active_batch, curr_decode_len)
+            input_mask = curr_decoded_word_ids.ne(pad_id).float()
+            # (active_batch, curr_decode_len)
+            if self.hparams.kv_cached_greedy_decode:  # type: ignore
+                input = self.graph_updater.embed_words(curr_decoded_word_ids[:, -1:])
+                # (active_batch, 1, hidden_dim)
+                decoder_output, caches = self.text_decoder.incremental_forward(
+                    input, input_mask, prev_action_mask, caches
                 )
-            )
-            # (batch, curr_decode_len, num_words)
-            preds = decoder_output[:, -1].argmax(dim=-1)
-            # (batch)
+                preds = self.target_word_prj(decoder_output[:, -1]).argmax(dim=-1)
+                # (active_batch)
+            else:
+                input = self.graph_updater.embed_words(curr_decoded_word_ids)
+                # (active_batch, curr_decode_len, hidden_dim)
+                decoder_output = self.target_word_prj(
+                    self.text_decoder(
+                        input,
+                        input_mask,
+                        node_hidden,
+                        prev_action_hidden,
+                        prev_action_mask,
+                    )
+                )
+                # (active_batch, curr_decode_len, num_words)
+                preds = decoder_output[:, -1].argmax(dim=-1)
+                # (active_batch)
 
             # add new decoded words to decoded_word_ids
             # if we've hit eos, we add padding
-            decoded_word_ids = torch.cat(
-                [
-                    decoded_word_ids,
-                    preds.masked_fill(eos_mask, self.preprocessor.pad_id).unsqueeze(-1),
-                ],
-                dim=-1,
+            decoded_word_ids[active_ids, decoded_len] = preds.masked_fill(
+                eos_mask, pad_id
             )
-            # (batch, curr_decode_len + 1)
+            decoded_len += 1
 
             # update the eos_mask. once it's True b/c we hit eos, it never goes back.
             eos_mask = eos_mask.logical_or(preds == eos_id)
-            # (batch)
+            # (active_batch)
 
             # if all the sequences have reached eos, break
-            if eos_mask.all():
+            num_eos = int(eos_mask.sum())
+            if num_eos == eos_mask.size(0):
                 break
-        return decoded_word_ids
+            if self.hparams.compact_greedy_decode and num_eos > 0:  # type: ignore
+                # drop the sequences that have reached eos from the working batch
+                not_eos_mask = eos_mask.logical_not()
+                active_ids = active_ids[not_eos_mask]
+                node_hidden = node_hidden[not_eos_mask]
+                prev_action_hidden = prev_action_hidden[not_eos_mask]
+                prev_action_mask = prev_action_mask[not_eos_mask]
+                if self.hparams.kv_cached_greedy_decode:  # type: ignore
+                    caches = [cache.index_select(not_eos_mask) for cache in caches]
+                eos_mask = eos_mask[not_eos_mask]
+        return (
+            decoded_word_ids[:, :decoded_len],
+            num_active / (batch_size * (decoded_len - 1)),
+        )
 
     def process_batch(
         self,
@@ -454,6 +870,8 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
                 length == max_episode_len, eval only
             'decoded': [decoded word ids of shape (batch, decoded_len), ...],
                 length == max_episode_len, eval only
+            'decode_active_fractions': [scalar average active batch fractions
+                of the greedy decoding, ...], length == max_episode_len, eval only
             'f1s': [scalar f1 scores, ...], length <= max_episode_len * batch, eval only
         }
         """
@@ -461,13 +879,54 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
         f1s: List[torch.Tensor] = []
         preds: List[torch.Tensor] = []
         decoded: List[torch.Tensor] = []
+        decode_active_fractions: List[torch.Tensor] = []
         hiddens: List[torch.Tensor] = []
         eos_id = self.preprocessor.word_to_id(EOS)
+        encoded_texts: List[Dict[str, torch.Tensor]] = [{} for _ in batch]
+        if self.hparams.time_parallel_text_encoding:  # type: ignore
+            # only the rnn and the graphs depend on the previous steps, so encode
+            # the observations and previous actions of all the steps at once.
+            with bf16_autocast(
+                self.device, enabled=self.hparams.bf16_autocast  # type: ignore
+            ):
+                encoded = self.graph_updater.encode_text_steps(
+                    [step["obs_word_ids"] for step in batch]
+                    + [step["prev_action_word_ids"] for step in batch],
+                    [step["obs_mask"] for step in batch]
+                    + [step["prev_action_mask"] for step in batch],
+                )
+            encoded_texts = [
+                {"encoded_obs": encoded_obs, "encoded_prev_action": encoded_prev_action}
+                for encoded_obs, encoded_prev_action in zip(
+                    encoded[: len(batch)], encoded[len(batch) :]
+                )
+            ]
+        # if True, the steps are decoded at once after the recurrent pass.
+        # See deferred_decode_losses() for more details.
+        deferred_decoding = (
+            self.training and self.hparams.deferred_text_decoding  # type: ignore
+        )
+        step_results: List[Dict[str, Any]] = []
+        prev_state: Optional[GraphUpdaterState] = None
         for i, episode_data in enumerate(batch):
-            results = self(episode_data, rnn_prev_hidden=h_t)
+            if self.training or prev_state is None:
+                # we don't reuse the graphs of the previous step for training,
+                # b/c h_t is detached between the steps, but the graphs aren't.
+                results = self(
+                    episode_data,
+                    rnn_prev_hidden=h_t,
+                    decode=not deferred_decoding,
+                    **encoded_texts[i],
+                )
+            else:
+                results = self(episode_data, prev_state=prev_state, **encoded_texts[i])
+            prev_state = results["state"]
             h_t = results["h_t"]
             assert h_t is not None
             hiddens.append(h_t)
+            if deferred_decoding:
+                step_results.append(results)
+                continue
             losses.append(
                 torch.sum(results["batch_loss"] * episode_data["step_mask"])
                 / episode_data["step_mask"].sum()
@@ -475,6 +934,7 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
             if not self.training:
                 preds.append(results["pred_obs_word_ids"])
                 decoded.append(results["decoded_obs_word_ids"])
+                decode_active_fractions.append(results["decode_active_fraction"])
                 for j, (
                     padded_decoded_word_ids,
                     padded_groundtruth_word_ids,
@@ -508,12 +968,15 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
                         )
                     )
 
+        if deferred_decoding:
+            losses = self.deferred_decode_losses(batch, step_results)
         results = {"losses": losses, "hiddens": hiddens}
         if self.training:
             return results
 
         results["preds"] = preds
         results["decoded"] = decoded
+        results["decode_active_fractions"] = decode_active_fractions
         results["f1s"] = f1s
         return results
 
@@ -546,6 +1009,10 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
             sync_dist=True,
         )
         self.log(log_key_prefix + "f1", torch.stack(results["f1s"]).mean())
+        self.log(
+            log_key_prefix + "decode_active_fraction",
+            torch.stack(results["decode_active_fractions"]).mean(),
+        )
         return self.gen_decoded_groundtruth_pred_table(
             batch, results["preds"], results["decoded"]
         )
@@ -648,6 +1115,58 @@ class GraphUpdaterObsGen(WordNodeRelInitMixin, pl.LightningModule):
             "lr_scheduler": {"scheduler": scheduler, "interval": "step"},
         }
 
+    def distill_factorized_graph_decoder(
+        self, rank: int, relation_rank: Optional[int] = None, **kwargs
+    ) -> List[float]:
+        """
+        Distill the dense graph decoder of the graph updater into a low-rank
+        factorized one (see GraphUpdater.distill_factorized_graph_decoder()), and
+        set graph_decoder_rank and graph_decoder_relation_rank of the hparams,
+        so that checkpoints are loaded with the factorized graph decoder.
+        kwargs are passed to GraphUpdater.distill_factorized_graph_decoder().
+
+        output: the losses of the distillation steps
+        """
+        losses = self.graph_updater.distill_factorized_graph_decoder(
+            rank, relation_rank=relation_rank, **kwargs
+        )
+        self.hparams.graph_decoder_rank = rank  # type: ignore
+        self.hparams.graph_decoder_relation_rank = relation_rank  # type: ignore
+        return losses
+
+    @torch.no_grad()
+    def collect_rnn_hiddens(
+        self, batches: Iterable[List[Dict[str, torch.Tensor]]]
+    ) -> torch.Tensor:
+        """
+        Run the graph updater over the episodes of the batches, e.g. of the training
+        data, and collect the RNN hidden states of the steps, which can be passed
+        to distill_factorized_graph_decoder() as rnn_hiddens.
+
+        batches: batches of episodes as prepared by
+            GraphUpdaterObsGenDataModule.prepare_batch()
+
+        output: (num_steps, hidden_dim), the hidden states of the unmasked steps
+        """
+        training = self.training
+        self.eval()
+        hiddens: List[torch.Tensor] = []
+        for batch in batches:
+            prev_state: Optional[GraphUpdaterState] = None
+            for step in batch:
+                step = self.transfer_batch_to_device(step, self.device)
+                results = self.graph_updater(
+                    step["obs_word_ids"],
+                    step["prev_action_word_ids"],
+                    step["obs_mask"],
+                    step["prev_action_mask"],
+                    prev_state=prev_state,
+                )
+                prev_state = results["state"]
+                hiddens.append(results["h_t"][step["step_mask"].bool()])
+        self.train(training)
+        return torch.cat(hiddens)
+
 
 @hydra.main(config_path="train_graph_updater_conf", config_name="config")
 def main(cfg: DictConfig) -> None:
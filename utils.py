@@ -4,7 +4,7 @@ import torch.nn.functional as F
 import gym
 import textworld.gym
 
-from typing import Optional, List, Sequence, Iterator, TypeVar
+from typing import Optional, List, Sequence, Iterator, TypeVar, Tuple
 from collections import Counter
 from textworld import EnvInfos
 
@@ -35,9 +35,13 @@ def masked_mean(input: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
     """
     input: (batch, seq_len, hidden_dim)
     mask: (batch, seq_len)
-    output: (batch, hidden_dim)
+    output: (batch, hidden_dim), zeros for fully masked sequences
     """
-    return (input * mask.unsqueeze(-1)).sum(dim=1) / mask.sum(dim=1, keepdim=True)
+    mask_sum = mask.sum(dim=1, keepdim=True)
+    # (batch, 1)
+    return (input * mask.unsqueeze(-1)).sum(dim=1) / mask_sum.masked_fill(
+        mask_sum == 0, 1
+    )
 
 
 def masked_softmax(
@@ -45,9 +49,37 @@ def masked_softmax(
 ) -> torch.Tensor:
     """
     input, mask and output all have the same dimensions
+    output is zero for the masked values, and fully masked rows are all zeros.
+
+    The softmax is calculated in at least float32, even under bfloat16 autocast.
+    """
+    # replace the values to be ignored with the smallest value instead of
+    # negative infinity so that fully masked rows don't return nan's
+    # then zero them out.
+    return F.softmax(
+        input.masked_fill(mask == 0, torch.finfo(input.dtype).min),
+        dim=dim,
+        dtype=torch.promote_types(input.dtype, torch.float),
+    ).masked_fill(mask == 0, 0)
+
+
+def bf16_autocast(device: torch.device, enabled: bool = True) -> torch.autocast:
+    """
+    Autocast to bfloat16 on the given device if enabled. Numerically sensitive
+    ops, e.g. masked_softmax() and the losses, should be calculated in float32.
+    """
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def autocast_state(device: torch.device) -> Tuple[bool, Optional[torch.dtype]]:
+    """
+    Return whether autocast is enabled on the type of the given device, and its
+    dtype if so. Results computed under different autocast states have different
+    dtypes and values, so caches of them should be keyed on this.
     """
-    # replace the values to be ignored with negative infinity
-    return F.softmax(input.masked_fill(mask == 0, float("-inf")), dim=dim)
+    if not torch.is_autocast_enabled(device.type):
+        return False, None
+    return True, torch.get_autocast_dtype(device.type)
 
 
 def generate_square_subsequent_mask(size: int) -> torch.Tensor: